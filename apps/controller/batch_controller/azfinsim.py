@@ -1,19 +1,35 @@
-import argparse
+import itertools
 import math
 import os.path
 
-from . import utils
+from . import cli, local_shard, partitioner, result_cache
+
+utils = cli.lazy_import('batch_controller.utils')
+job_schedule = cli.lazy_import('batch_controller.job_schedule')
+
+DESCRIPTION = 'FinTech Risk Simulator'
+
+# task slots used by a pricing task for each algorithm; pools are configured with
+# 2 slots per core (see `apps/azfinsim/pools.bicep`) so `pvonly` tasks, which are
+# lightweight, get half a core while `deltavega` tasks get a full core.
+ALGORITHM_SLOTS = {
+    'pvonly': 1,
+    'deltavega': 2,
+}
+
+# shared directory where pricing tasks save their progress (see `local_shard`)
+CHECKPOINT_DIR = '/mnt/batch/tasks/fsmounts/trades/checkpoints'
+
+# host directories populated by the pool's start task (see `apps/azfinsim/pools.bicep`):
+# the secrets fetched by grabber and the helpers run by tasks (see `local_shard`)
+CONTAINER_RUN_OPTIONS = '-v /opt/azfinsim-secrets:/opt/secrets -v /opt/azfinsim-tools:/opt/tools:ro'
 
 def get_parser():
-    parser = argparse.ArgumentParser(description='FinTech Risk Simulator')
-    subparsers = parser.add_subparsers(title='command', description='valid commands')
+    return cli.get_app_parser(DESCRIPTION, add_commands)
 
-    poolParser = subparsers.add_parser('pool', help='pool operations')
-    poolParser.add_argument('-e', '--batch-endpoint',
-        type=str, help='batch account endpoint [REQUIRED]', required=True)
-    poolParser.add_argument('-i', '--info', action='store_true', help='print pool information')
-    poolParser.add_argument('-r','--resize', type=int, help='resize pool', metavar='SIZE', default=-1)
-    poolParser.set_defaults(command_execute=execute_pool)
+def add_commands(subparsers):
+    cli.add_pool_parser(subparsers, pool_id='azfinsim-pool', container_image=container_image,
+        container_run_options=CONTAINER_RUN_OPTIONS, slots_per_task=ALGORITHM_SLOTS['deltavega'])
 
     cacheParser = subparsers.add_parser('cache', help='cache operations')
     cacheParser.add_argument('-e', '--batch-endpoint',
@@ -32,7 +48,22 @@ def get_parser():
     jobParser.add_argument('-s','--start-trade', type=int, help='start trade number', default=0)
     jobParser.add_argument('-w','--trade-window', type=int, help='trade window i.e. total number of trades', default=0)
     jobParser.add_argument('-a','--algorithm', choices=['deltavega', 'pvonly'], default='deltavega', help='pricing algorithm')
+    jobParser.add_argument('--tasks-per-node', type=int,
+        help='plan tasks to fill the pool: overrides --tasks with nodes * TASKS_PER_NODE (use 0 to fill all task slots)')
+    jobParser.add_argument('--nodes', type=int, help='number of nodes to plan for with --tasks-per-node (default: current pool size)')
     jobParser.add_argument("--failure", type=float, default=0.0, help="inject random task failure with this probability (default: 0.0)")
+    jobParser.add_argument('--warm-start', action='store_true', help='pull container image on each node before running tasks')
+    jobParser.add_argument('--cost-file', type=str, help='JSON file with durations of earlier tasks used to balance trades across tasks')
+    jobParser.add_argument('--result-cache', type=str,
+        help='index of priced trade ranges (local file or blob url); only ranges not in the index are priced (implies --monitor)')
+    jobParser.add_argument('--image-digest', type=str,
+        help='digest (sha256:...) of the container image to run; required with --result-cache to identify cached results')
+    jobParser.add_argument('--refresh', action='store_true', help='re-price all trades, ignoring (and replacing) cached results')
+    jobParser.add_argument('-m', '--monitor', action='store_true', help='monitor the job till it completes')
+    add_checkpoint_argument(jobParser)
+    cli.add_retry_arguments(jobParser)
+    cli.add_telemetry_arguments(jobParser)
+    cli.add_simulate_arguments(jobParser, duration=estimate_duration)
     jobParser.set_defaults(command_execute=execute_job)
 
     workflowParser = subparsers.add_parser('workflow', help='workflow operations')
@@ -43,7 +74,22 @@ def get_parser():
     workflowParser.add_argument('-s','--start-trade', type=int, help='start trade number', default=0)
     workflowParser.add_argument('-w','--trade-window', type=int, help='trade window i.e. total number of trades', default=0)
     workflowParser.add_argument('-a','--algorithm', choices=['deltavega', 'pvonly'], default='deltavega', help='pricing algorithm')
+    workflowParser.add_argument('--tasks-per-node', type=int,
+        help='plan tasks to fill the pool: overrides --tasks with nodes * TASKS_PER_NODE (use 0 to fill all task slots)')
+    workflowParser.add_argument('--nodes', type=int, help='number of nodes to plan for with --tasks-per-node (default: current pool size)')
     workflowParser.add_argument("--failure", type=float, default=0.0, help="inject random task failure with this probability (default: 0.0)")
+    workflowParser.add_argument('--warm-start', action='store_true', help='pull container image on each node before running tasks')
+    workflowParser.add_argument('--cost-file', type=str, help='JSON file with durations of earlier tasks used to balance trades across tasks')
+    workflowParser.add_argument('--result-cache', type=str,
+        help='index of priced trade ranges (local file or blob url); only ranges not in the index are priced (implies --monitor)')
+    workflowParser.add_argument('--image-digest', type=str,
+        help='digest (sha256:...) of the container image to run; required with --result-cache to identify cached results')
+    workflowParser.add_argument('--refresh', action='store_true', help='re-price all trades, ignoring (and replacing) cached results')
+    workflowParser.add_argument('-m', '--monitor', action='store_true', help='monitor the workflow till it completes')
+    add_checkpoint_argument(workflowParser)
+    cli.add_retry_arguments(workflowParser)
+    cli.add_telemetry_arguments(workflowParser)
+    cli.add_simulate_arguments(workflowParser, duration=estimate_duration)
     workflowParser.set_defaults(command_execute=execute_workflow)
 
     cacheFSParser = subparsers.add_parser('cache-fs', help='file cache operations')
@@ -61,6 +107,8 @@ def get_parser():
     jobFSParser.add_argument('-a','--algorithm', choices=['deltavega', 'pvonly'], default='deltavega', help='pricing algorithm')
     jobFSParser.add_argument("--failure", type=float, default=0.0, help="inject random task failure with this probability (default: 0.0)")
     jobFSParser.add_argument('--file', type=str, help='file name', default='trades.csv')
+    cli.add_retry_arguments(jobFSParser)
+    cli.add_telemetry_arguments(jobFSParser)
     jobFSParser.set_defaults(command_execute=execute_job_fs)
 
     workflowFSParser = subparsers.add_parser('workflow-fs', help='file workflow operations')
@@ -70,79 +118,243 @@ def get_parser():
     workflowFSParser.add_argument('-t','--tasks', type=int, help='total number of tasks', default=1)
     workflowFSParser.add_argument('-w','--trade-window', type=int, help='trade window i.e. total number of trades', default=1000)
     workflowFSParser.add_argument('-a','--algorithm', choices=['deltavega', 'pvonly'], default='deltavega', help='pricing algorithm')
+    workflowFSParser.add_argument('--tasks-per-node', type=int,
+        help='plan tasks to fill the pool: overrides --tasks with nodes * TASKS_PER_NODE (use 0 to fill all task slots)')
+    workflowFSParser.add_argument('--nodes', type=int, help='number of nodes to plan for with --tasks-per-node (default: current pool size)')
     workflowFSParser.add_argument("--failure", type=float, default=0.0, help="inject random task failure with this probability (default: 0.0)")
+    workflowFSParser.add_argument('--warm-start', action='store_true', help='pull container image on each node before running tasks')
     workflowFSParser.add_argument('--file', type=str, help='file name', default='trades.csv')
+    workflowFSParser.add_argument('-m', '--monitor', action='store_true', help='monitor the workflow till it completes')
+    workflowFSParser.add_argument('--streaming', action='store_true',
+        help='generate trades in per-task shards and merge results in a tree instead of generate/split/price/merge stages')
+    workflowFSParser.add_argument('--merge-fan-in', type=int, help='number of results merged by each merge task when streaming (default=16)', default=16)
+    workflowFSParser.add_argument('--locality', action='store_true',
+        help='price each shard in node-local scratch space: pricing tasks read their byte range of the trades file '
+             '(or generate their trades when streaming) instead of shard files on the shared mount')
+    add_checkpoint_argument(workflowFSParser)
+    cli.add_retry_arguments(workflowFSParser)
+    cli.add_telemetry_arguments(workflowFSParser)
+    cli.add_simulate_arguments(workflowFSParser, duration=estimate_duration)
     workflowFSParser.set_defaults(command_execute=execute_workflow_fs)
 
+    scheduleParser = subparsers.add_parser('schedule', help='recurring incremental pricing runs using job schedules')
+    scheduleCommands = scheduleParser.add_subparsers(title='schedule command', description='valid schedule commands')
 
-    return parser
+    createParser = scheduleCommands.add_parser('create', help='price the trades appended to a trades file since the last run, every few minutes')
+    createParser.add_argument('-e', '--batch-endpoint',
+        type=str, help='batch account endpoint [REQUIRED]', required=True)
+    createParser.add_argument('-c','--container-registry-name',type=str, help='container registry url [REQUIRED]', required=True)
+    createParser.add_argument('--schedule-id', type=str, help='job schedule id (default=azfinsim-incremental)', default='azfinsim-incremental')
+    createParser.add_argument('--interval', type=int, metavar='MINUTES', help='minutes between runs (default=5)', default=5)
+    createParser.add_argument('-s','--start-trade', type=int, help='start trade number for the first run (default=0)', default=0)
+    createParser.add_argument('-w','--trade-window', type=int, help='maximum number of trades priced in a run (default=0, all new trades)', default=0)
+    createParser.add_argument('-a','--algorithm', choices=['deltavega', 'pvonly'], default='deltavega', help='pricing algorithm')
+    createParser.add_argument("--failure", type=float, default=0.0, help="inject random task failure with this probability (default: 0.0)")
+    createParser.add_argument('--file', type=str, help='file name', default='trades.csv')
+    createParser.add_argument('--max-retries', type=int, help='number of times a failed run is retried by the Batch service')
+    createParser.add_argument('--max-wall-clock', type=float, metavar='MINUTES',
+        help='maximum time a run may take, including retries, before it is terminated')
+    createParser.set_defaults(command_execute=execute_schedule_create)
+
+    listParser = scheduleCommands.add_parser('list', help='list job schedules')
+    listParser.add_argument('-e', '--batch-endpoint',
+        type=str, help='batch account endpoint [REQUIRED]', required=True)
+    listParser.set_defaults(command_execute=execute_schedule_list)
+
+    for name, description, execute_command in [
+        ('show', 'print a job schedule, its recent runs and the output of the last one', execute_schedule_show),
+        ('enable', 'resume runs of a job schedule', execute_schedule_enable),
+        ('disable', 'pause runs of a job schedule', execute_schedule_disable),
+        ('delete', 'delete a job schedule and its jobs; the watermark is kept', execute_schedule_delete)]:
+        commandParser = scheduleCommands.add_parser(name, help=description)
+        commandParser.add_argument('-e', '--batch-endpoint',
+            type=str, help='batch account endpoint [REQUIRED]', required=True)
+        commandParser.add_argument('--schedule-id', type=str, help='job schedule id (default=azfinsim-incremental)', default='azfinsim-incremental')
+        commandParser.set_defaults(command_execute=execute_command)
+
+    monitorParser = subparsers.add_parser('monitor', help='monitor a job till it completes')
+    monitorParser.add_argument('-e', '--batch-endpoint',
+        type=str, help='batch account endpoint [REQUIRED]', required=True)
+    monitorParser.add_argument('-j', '--job-id', type=str, help='job id [REQUIRED]', required=True)
+    monitorParser.add_argument('--interval', type=float, help='minimum poll interval in seconds (default=2)', default=2.0)
+    monitorParser.add_argument('--max-interval', type=float, help='maximum poll interval in seconds (default=30)', default=30.0)
+    monitorParser.add_argument('-v', '--verbose', action='store_true', help='print wall time for each task as it completes')
+    monitorParser.add_argument('--save-cost-file', type=str, help='save durations of pricing tasks to a JSON file for use with --cost-file')
+    monitorParser.add_argument('--result-cache', type=str, help='record trade ranges priced successfully in this index (local file or blob url)')
+    monitorParser.add_argument('--image-digest', type=str,
+        help='digest (sha256:...) of the container image the job ran; required with --result-cache')
+    cli.add_supervise_arguments(monitorParser)
+    cli.add_telemetry_arguments(monitorParser)
+    monitorParser.set_defaults(command_execute=execute_monitor)
+
+    cli.add_report_parser(subparsers)
+
+
+
+def add_checkpoint_argument(parser):
+    parser.add_argument('--checkpoint', type=int, metavar='TRADES',
+        help='save the progress of pricing tasks on the shared mount every TRADES trades, so that tasks '
+             'requeued after their spot node was preempted resume after the last priced trade')
+
+def checkpoint_options(args):
+    """returns `local_shard` options to save pricing progress every `--checkpoint` trades"""
+    return f' --checkpoint-dir {CHECKPOINT_DIR} --chunk-size {args.checkpoint}' if getattr(args, 'checkpoint', None) else ''
+
+def checkpointed_fs_command_line(args, path):
+    """command line for a pricing task that prices the trades file at `path` on the shared mount,
+    saving its progress every `--checkpoint` trades; the results are written next to it"""
+    return local_shard.command_line(f'--source {path} --part 0 --parts 1 --shard {os.path.basename(path)} ' + \
+           f'--output-dir {os.path.dirname(path)}' + checkpoint_options(args),
+           price=f'-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json --algorithm {args.algorithm} --failure {args.failure}')
 
 def task_command_line_generator(args):
     command = '-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json --start-trade {start} --trade-window {delta} --failure {failure} --algorithm {algorithm}'
     command_synthetic = ' --delay-start {delay_start} --mem-usage {mem_usage} --task-duration {task_duration}'
 
-    delta = args.trade_window // args.tasks
-    assert delta >= 0
-
-    counter = 0
-    for start in range(args.start_trade, args.start_trade + args.trade_window,  delta):
+    for start, delta in partitioner.partitions(args):
+        if getattr(args, 'checkpoint', None):
+            # trades are priced in chunks, each using its own --start-trade and --trade-window
+            yield local_shard.command_line(f'--start-trade {start} --trade-window {delta}' + checkpoint_options(args),
+                price=f'-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json --failure {args.failure} --algorithm {args.algorithm}')
+            continue
         cmd = command.format(start=start, delta=delta, algorithm=args.algorithm,
             failure=args.failure)
         if args.algorithm == 'synthetic':
             cmd + command_synthetic.format(delay_start=args.delay_start, mem_usage=args.mem_usage, task_duration=args.task_duration)
         yield cmd
-        counter += 1
 
 def populate_command_line_generator(args):
     command = '-m azfinsim.generator --no-color --config /opt/secrets/config.json --start-trade {start} --trade-window {delta}'
 
-    delta = args.trade_window // args.tasks
-    assert delta >= 0
-
-    counter = 0
-    for start in range(args.start_trade, args.start_trade + args.trade_window,  delta):
+    for start, delta in partitioner.partitions(args):
         cmd = command.format(start=start, delta=delta)
         yield cmd
-        counter += 1
 
 
-def execute_pool(args)->None:
-    if args.resize >= 0:
-        utils.pool_resize(endpoint=args.batch_endpoint, pool_id='azfinsim-pool', targetSize=args.resize)
-    else:
-        utils.print_pool_info(endpoint=args.batch_endpoint, pool_id='azfinsim-pool')
+def container_image(args):
+    """returns the image to run, pinned to `--image-digest` if specified"""
+    if getattr(args, 'image_digest', None):
+        return '{}.azurecr.io/azfinsim/azfinsim@{}'.format(args.container_registry_name, args.image_digest)
+    return '{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name)
+
+def job_preparation_task(args):
+    """returns a job preparation task to warm nodes if `--warm-start` was specified"""
+    if not args.warm_start:
+        return None
+    return utils.create_job_preparation_task(container_image(args),
+        container_run_options=CONTAINER_RUN_OPTIONS)
+
+def cache_image(args):
+    """returns the image identity used for cached results; a tag such as `:latest` can be
+    moved to another image, so only a digest identifies the image that priced the trades"""
+    if not args.image_digest:
+        raise RuntimeError('--image-digest is required for --result-cache')
+    if not args.image_digest.startswith('sha256:'):
+        raise RuntimeError('invalid --image-digest {} (expected sha256:...)'.format(args.image_digest))
+    return args.image_digest
+
+def plan_cached(args):
+    """limit the trades to price to the ranges missing from the result cache;
+    returns False if there's nothing left to price"""
+    if not args.result_cache:
+        return True
+    # priced ranges are recorded once the job completes, so it must be followed
+    if not getattr(args, 'supervise', False):
+        args.monitor = True
+    cache = result_cache.ResultCache(args.result_cache)
+    if args.refresh:
+        cache.invalidate(args.start_trade, args.trade_window)
+        cache.save()
+    args.ranges = cache.missing(args.start_trade, args.trade_window, args.algorithm, cache_image(args))
+    missing = sum(count for _, count in args.ranges)
+    print('result cache: {} of {} trades need pricing'.format(missing, args.trade_window))
+    return missing > 0
+
+def record_cached(args, job)->None:
+    """record trade ranges priced by the job in the result cache"""
+    if not args.result_cache:
+        return
+    cache = result_cache.ResultCache(args.result_cache)
+    added = result_cache.record_tasks(cache, job['tasks'], cache_image(args), job_id=job['job_id'])
+    cache.save()
+    print('result cache: recorded {} trade ranges'.format(added))
+
+def estimate_duration(args, task):
+    """estimate run time of a task for simulations; pricing tasks that read trades from
+    files process `trade_window / tasks` trades"""
+    from . import fake_batch
+    return fake_batch.estimate_duration(task, trades=args.trade_window / max(args.tasks, 1))
+
+def task_slots(args):
+    return ALGORITHM_SLOTS.get(args.algorithm, 1)
+
+def plan_tasks(args)->None:
+    """update the number of tasks to fill the pool when `--tasks-per-node` is specified"""
+    if args.tasks_per_node is None:
+        return
+    nodes, slots_per_node = utils.get_pool_capacity(endpoint=args.batch_endpoint, pool_id='azfinsim-pool')
+    nodes = args.nodes if args.nodes is not None else nodes
+    fit = max(1, slots_per_node // task_slots(args))
+    tasks_per_node = args.tasks_per_node if args.tasks_per_node > 0 else fit
+    if tasks_per_node > fit:
+        print('warning: only {} tasks fit on a node with {} task slots'.format(fit, slots_per_node))
+    args.tasks = max(1, nodes * tasks_per_node)
+    print('planned {} tasks ({} nodes, {} tasks per node, {} slots per task)'.format(
+        args.tasks, nodes, tasks_per_node, task_slots(args)))
 
 def execute_job(args)->None:
-    utils.submit_job(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
+    plan_tasks(args)
+    if not plan_cached(args):
+        return
+    job = utils.submit_job(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
         num_tasks=args.tasks, task_command_lines=task_command_line_generator(args),
         task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-        container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
-        job_id_prefix='azfinsim')
+        container_run_options=CONTAINER_RUN_OPTIONS,
+        job_id_prefix='azfinsim',
+        # checkpoints are saved on the shared mount
+        elevatedUser=bool(args.checkpoint),
+        required_slots=task_slots(args),
+        job_preparation_task=job_preparation_task(args),
+        **cli.retry_options(args), **cli.job_options(args))
+    result = cli.follow_job(args, job['job_id'])
+    if result:
+        record_cached(args, result)
 
 def execute_cache(args)->None:
     utils.submit_job(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
         num_tasks=args.tasks, task_command_lines=populate_command_line_generator(args),
         task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-        container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+        container_run_options=CONTAINER_RUN_OPTIONS,
         job_id_prefix='cache')
 
 def execute_workflow(args)->None:
+    plan_tasks(args)
+    if not plan_cached(args):
+        return
     # create tasks for generator
     gen_tasks = utils.create_tasks(task_command_lines=populate_command_line_generator(args),
                 task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-                container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+                container_run_options=CONTAINER_RUN_OPTIONS,
                 task_id_prefix='generator')
 
     # create tasks for pricing
     pricing_tasks = utils.create_tasks(task_command_lines=task_command_line_generator(args),
                 task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-                container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+                container_run_options=CONTAINER_RUN_OPTIONS,
                 task_id_prefix='pricing',
-                get_dependencies=lambda idx: [gen_tasks[idx].id])
-
-    utils.submit_workflow(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
-        tasks=gen_tasks + pricing_tasks,
-        job_id_prefix='workflow')
+                get_dependencies=lambda idx: [gen_tasks.task_id(idx)],
+                elevatedUser=bool(args.checkpoint),
+                required_slots=task_slots(args),
+                **cli.retry_options(args))
+
+    job = utils.submit_workflow(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
+        tasks=itertools.chain(gen_tasks, pricing_tasks),
+        job_id_prefix='workflow',
+        job_preparation_task=job_preparation_task(args),
+        **cli.job_options(args))
+    result = cli.follow_job(args, job['job_id'])
+    if result:
+        record_cached(args, result)
 
 def cache_fs_command_lines(args):
     task_cmd = f'-m azfinsim.generator --no-color --config /opt/secrets/config.json --trade-window {args.trade_window} ' + \
@@ -153,68 +365,112 @@ def execute_cache_fs(args)->None:
     utils.submit_job(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
         num_tasks=1, task_command_lines=cache_fs_command_lines(args),
         task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-        container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+        container_run_options=CONTAINER_RUN_OPTIONS,
         job_id_prefix='cache-fs',
         elevatedUser=True)
 
 def execute_fs_command_lines_generator(args):
     name, ext = os.path.splitext(args.file)
     for i in range(args.tasks):
-        task_cmd = f'-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json ' + \
+        if getattr(args, 'checkpoint', None):
+            yield checkpointed_fs_command_line(args, f'/mnt/batch/tasks/fsmounts/trades/{name}.{i}{ext}')
+            continue
+        task_cmd = '-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json ' + \
                    f'--cache-type filesystem --cache-path /mnt/batch/tasks/fsmounts/trades/{name}.{i}{ext} ' + \
                    f'--algorithm {args.algorithm} --failure {args.failure}'
         yield task_cmd
 
 def execute_job_fs(args)->None:
     args.tasks = 1
-    utils.submit_job(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
+    job = utils.submit_job(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
         num_tasks=1, task_command_lines=execute_fs_command_lines_generator(args),
         task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-        container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+        container_run_options=CONTAINER_RUN_OPTIONS,
         job_id_prefix='azfinsim-fs',
-        elevatedUser=True)
+        elevatedUser=True,
+        required_slots=task_slots(args),
+        **cli.retry_options(args), **cli.job_options(args))
+    cli.follow_job(args, job['job_id'])
 
 def execute_workflow_fs(args)->None:
+    plan_tasks(args)
+    if args.streaming:
+        return execute_streaming_workflow_fs(args)
+
     work_dir = f'tmp-{utils.unique_id()}' # create a unique work directory
 
     # create 1 task for generator
     gen_tasks = utils.create_tasks(task_command_lines=cache_fs_command_lines(args),
                 task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-                container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+                container_run_options=CONTAINER_RUN_OPTIONS,
                 task_id_prefix='generator-fs',
                 elevatedUser=True)
 
+    if args.locality:
+        # pricing tasks read their own shards, so there's no split task
+        pricing_tasks = utils.create_tasks(task_command_lines=lambda idx: local_pricing_fs_command_line(args, work_dir, idx),
+                    count=args.tasks,
+                    task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
+                    container_run_options=CONTAINER_RUN_OPTIONS,
+                    task_id_prefix='pricing-fs',
+                    get_dependencies=lambda idx: [gen_tasks.task_id(0)],
+                    elevatedUser=True,
+                    required_slots=task_slots(args),
+                    id_offset=0,
+                    **cli.retry_options(args))
+        split_tasks = []
+    else:
+        pricing_tasks, split_tasks = split_pricing_fs_tasks(args, work_dir, gen_tasks)
+
+    # create 1 task for merging
+    merge_tasks = utils.create_tasks(task_command_lines=merge_fs_command_lines(args, work_dir),
+                task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
+                container_run_options=CONTAINER_RUN_OPTIONS,
+                task_id_prefix='merge-fs',
+                get_dependencies=lambda _: pricing_tasks.depends_on_all(),
+                elevatedUser=True)
+
+    job = utils.submit_workflow(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
+        tasks=itertools.chain(gen_tasks, split_tasks, pricing_tasks, merge_tasks),
+        # tasks=merge_tasks,
+        job_id_prefix='workflow-fs',
+        job_preparation_task=job_preparation_task(args),
+        **cli.job_options(args))
+    cli.follow_job(args, job['job_id'])
+
+def split_pricing_fs_tasks(args, work_dir, gen_tasks):
+    """returns the pricing tasks and the split task writing their shards to the shared mount"""
     # create 1 task for splitting
     split_tasks = utils.create_tasks(task_command_lines=split_fs_command_lines(args, work_dir),
                 task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-                container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+                container_run_options=CONTAINER_RUN_OPTIONS,
                 task_id_prefix='split-fs',
-                get_dependencies=lambda _: [gen_tasks[0].id],
+                get_dependencies=lambda _: [gen_tasks.task_id(0)],
                 elevatedUser=True)
 
-    # create n task for pricing
+    # create n task for pricing; these use integer ids so that the merge task can
+    # depend on all of them using a single task id range
     s = args.file
     args.file = f'{work_dir}/{args.file}'
     pricing_tasks = utils.create_tasks(task_command_lines=execute_fs_command_lines_generator(args),
                 task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-                container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
+                container_run_options=CONTAINER_RUN_OPTIONS,
                 task_id_prefix='pricing-fs',
-                get_dependencies=lambda idx: [split_tasks[0].id],
-                elevatedUser=True)
+                get_dependencies=lambda idx: [split_tasks.task_id(0)],
+                elevatedUser=True,
+                required_slots=task_slots(args),
+                id_offset=0,
+                **cli.retry_options(args))
     args.file = s
+    return pricing_tasks, split_tasks
 
-    # create 1 task for merging
-    merge_tasks = utils.create_tasks(task_command_lines=merge_fs_command_lines(args, work_dir),
-                task_container_image='{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
-                container_run_options='-v /opt/azfinsim-secrets:/opt/secrets',
-                task_id_prefix='merge-fs',
-                get_dependencies=lambda _: [t.id for t in pricing_tasks],
-                elevatedUser=True)
-
-    utils.submit_workflow(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
-        tasks=gen_tasks + split_tasks + pricing_tasks + merge_tasks,
-        # tasks=merge_tasks,
-        job_id_prefix='workflow-fs')
+def local_pricing_fs_command_line(args, work_dir, index):
+    """command line for pricing task `index` reading its byte range of the trades file into
+    node-local scratch space (see `local_shard`); only its results are written to `work_dir`"""
+    name, ext = os.path.splitext(args.file)
+    return local_shard.command_line(f'--source /mnt/batch/tasks/fsmounts/trades/{args.file} --part {index} --parts {args.tasks} ' + \
+           f'--shard {name}.{index}{ext} --output-dir /mnt/batch/tasks/fsmounts/trades/{work_dir}' + checkpoint_options(args),
+           price=f'-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json --algorithm {args.algorithm} --failure {args.failure}')
 
 def split_fs_command_lines(args, work_dir):
     tasks = args.tasks
@@ -227,16 +483,159 @@ def split_fs_command_lines(args, work_dir):
 
 def merge_fs_command_lines(args, work_dir):
     name, ext = os.path.splitext(args.file)
-    task_cmd = f'-m azfinsim.concat --no-color --config /opt/secrets/config.json ' + \
+    task_cmd = '-m azfinsim.concat --no-color --config /opt/secrets/config.json ' + \
                f'--output-path /mnt/batch/tasks/fsmounts/trades/{name}.result{ext} ' + \
                f'--cache-path "/mnt/batch/tasks/fsmounts/trades/{work_dir}/{name}.[0-9]*.results{ext}"'
     return [task_cmd]
 
-def execute(args)->None:
-    if hasattr(args, 'command_execute'):
-        args.command_execute(args)
+def execute_monitor(args)->None:
+    args.monitor = True
+    result = cli.follow_job(args, args.job_id,
+        min_interval=args.interval, max_interval=args.max_interval, verbose=args.verbose)
+    if args.save_cost_file:
+        partitioner.save_history(args.save_cost_file,
+            partitioner.history_from_tasks(result['tasks'], utils.get_wall_time))
+    record_cached(args, result)
+
+def incremental_fs_command_line(args):
+    """command line for the task run by each job of a schedule: it prices the trades appended to
+    the trades file since the previous run in node-local scratch space (see `local_shard`) and
+    then advances the watermark; results and the watermark are saved in a directory named after
+    the schedule"""
+    schedule_dir = f'/mnt/batch/tasks/fsmounts/trades/{args.schedule_id}'
+    return local_shard.command_line(f'--source /mnt/batch/tasks/fsmounts/trades/{args.file} --shard {os.path.basename(args.file)} ' + \
+           f'--watermark {schedule_dir}/watermark.json --start-trade {args.start_trade} --max-trades {args.trade_window} ' + \
+           f'--output-dir {schedule_dir}',
+           price=f'-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json --algorithm {args.algorithm} --failure {args.failure}')
+
+def execute_schedule_create(args)->None:
+    if args.interval < 1:
+        raise RuntimeError('--interval must be at least 1 minute')
+    task = job_schedule.job_manager_task(incremental_fs_command_line(args),
+        task_container_image=container_image(args),
+        container_run_options=CONTAINER_RUN_OPTIONS,
+        elevatedUser=True,
+        required_slots=task_slots(args),
+        **cli.retry_options(args))
+    job_schedule.create_schedule(args.batch_endpoint, args.schedule_id, 'azfinsim-pool', task, args.interval,
+        display_name=f'incremental pricing of {args.file}')
+
+def execute_schedule_list(args)->None:
+    job_schedule.print_schedules(args.batch_endpoint)
+
+def execute_schedule_show(args)->None:
+    job_schedule.print_schedule(args.batch_endpoint, args.schedule_id)
+
+def execute_schedule_enable(args)->None:
+    job_schedule.set_enabled(args.batch_endpoint, args.schedule_id, True)
+
+def execute_schedule_disable(args)->None:
+    job_schedule.set_enabled(args.batch_endpoint, args.schedule_id, False)
+
+def execute_schedule_delete(args)->None:
+    job_schedule.delete_schedule(args.batch_endpoint, args.schedule_id)
+
+def streaming_shard_name(args, work_dir, level, index):
+    """returns the file name for a shard; shards are grouped by the merge task that consumes
+    them so that each merge task can select its inputs using a glob"""
+    name, ext = os.path.splitext(args.file)
+    return f'{work_dir}/{name}.{level}-{index // args.merge_fan_in}.{index}{ext}'
+
+def streaming_generator_fs_command_line(args, work_dir, index):
+    start, delta = partitioner.partition_at(0, args.trade_window, args.tasks, index)
+    return f'-m azfinsim.generator --no-color --config /opt/secrets/config.json --start-trade {start} --trade-window {delta} ' + \
+           f'--cache-type filesystem --cache-path /mnt/batch/tasks/fsmounts/trades/{streaming_shard_name(args, work_dir, 0, index)}'
+
+def streaming_pricing_fs_command_line(args, work_dir, index):
+    if getattr(args, 'checkpoint', None):
+        return checkpointed_fs_command_line(args, f'/mnt/batch/tasks/fsmounts/trades/{streaming_shard_name(args, work_dir, 0, index)}')
+    return '-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json ' + \
+           f'--cache-type filesystem --cache-path /mnt/batch/tasks/fsmounts/trades/{streaming_shard_name(args, work_dir, 0, index)} ' + \
+           f'--algorithm {args.algorithm} --failure {args.failure}'
+
+def streaming_local_pricing_fs_command_line(args, work_dir, index):
+    """command line for pricing task `index` generating and pricing its shard in node-local
+    scratch space (see `local_shard`); only its results are written to `work_dir`"""
+    start, delta = partitioner.partition_at(0, args.trade_window, args.tasks, index)
+    shard = streaming_shard_name(args, work_dir, 0, index)
+    return local_shard.command_line(f'--shard {os.path.basename(shard)} --output-dir /mnt/batch/tasks/fsmounts/trades/{work_dir}' + \
+           checkpoint_options(args),
+           generate=f'-m azfinsim.generator --no-color --config /opt/secrets/config.json --start-trade {start} --trade-window {delta}',
+           price=f'-m azfinsim.azfinsim --no-color --config /opt/secrets/config.json --algorithm {args.algorithm} --failure {args.failure}')
+
+def streaming_merge_fs_command_line(args, work_dir, level, groups, group):
+    """command line for merge task `group` of the `groups` tasks merging results from the previous `level`"""
+    name, ext = os.path.splitext(args.file)
+    if groups == 1:
+        output = f'{name}.result{ext}'
     else:
-        print('missing required command')
+        output, _ = os.path.splitext(streaming_shard_name(args, work_dir, level + 1, group))
+        output = f'{output}.results{ext}'
+    return '-m azfinsim.concat --no-color --config /opt/secrets/config.json ' + \
+           f'--output-path /mnt/batch/tasks/fsmounts/trades/{output} ' + \
+           f'--cache-path "/mnt/batch/tasks/fsmounts/trades/{work_dir}/{name}.{level}-{group}.[0-9]*.results{ext}"'
+
+def streaming_workflow_fs_tasks(args, work_dir):
+    """returns an iterator over all tasks for a streaming workflow; tasks are created
+    lazily while iterating"""
+    assert args.merge_fan_in > 1, 'merge fan-in must be at least 2'
+    task_options = {
+        'task_container_image': '{}.azurecr.io/azfinsim/azfinsim:latest'.format(args.container_registry_name),
+        'container_run_options': CONTAINER_RUN_OPTIONS,
+        'elevatedUser': True,
+    }
+
+    count = min(args.tasks, args.trade_window)
+    if getattr(args, 'locality', False):
+        # create n tasks, each generating and pricing its shard in node-local scratch space
+        gen_tasks = []
+        pricing_tasks = utils.create_tasks(task_command_lines=lambda idx: streaming_local_pricing_fs_command_line(args, work_dir, idx),
+                    count=count,
+                    task_id_prefix='pricing-fs',
+                    required_slots=task_slots(args), **task_options, **cli.retry_options(args))
+    else:
+        # create n tasks, each generating its own shard of trades
+        gen_tasks = utils.create_tasks(task_command_lines=lambda idx: streaming_generator_fs_command_line(args, work_dir, idx),
+                    count=count,
+                    task_id_prefix='generator-fs', **task_options)
+
+        # create n tasks for pricing, each depending only on its own shard
+        pricing_tasks = utils.create_tasks(task_command_lines=lambda idx: streaming_pricing_fs_command_line(args, work_dir, idx),
+                    count=count,
+                    task_id_prefix='pricing-fs',
+                    get_dependencies=lambda idx: [gen_tasks.task_id(idx)],
+                    required_slots=task_slots(args), **task_options, **cli.retry_options(args))
+
+    # create a tree of merge tasks, each merging at most `merge_fan_in` results
+    # from the level below; the last level has a single task
+    merge_tasks = []
+    inputs = pricing_tasks
+    level = 0
+    while True:
+        groups = math.ceil(len(inputs) / args.merge_fan_in)
+        level_tasks = utils.create_tasks(
+                task_command_lines=lambda idx, level=level, groups=groups: streaming_merge_fs_command_line(args, work_dir, level, groups, idx),
+                count=groups,
+                task_id_prefix=f'merge-fs-{level}',
+                get_dependencies=lambda idx, inputs=inputs: inputs.task_ids(idx * args.merge_fan_in, (idx + 1) * args.merge_fan_in),
+                **task_options)
+        merge_tasks.append(level_tasks)
+        if len(level_tasks) <= 1:
+            break
+        inputs = level_tasks
+        level += 1
+    return itertools.chain(gen_tasks, pricing_tasks, *merge_tasks)
+
+def execute_streaming_workflow_fs(args)->None:
+    work_dir = f'tmp-{utils.unique_id()}' # create a unique work directory
+    job = utils.submit_workflow(endpoint=args.batch_endpoint, pool_id='azfinsim-pool',
+        tasks=streaming_workflow_fs_tasks(args, work_dir),
+        job_id_prefix='workflow-fs',
+        job_preparation_task=job_preparation_task(args),
+        **cli.job_options(args))
+    cli.follow_job(args, job['job_id'])
+
+execute = cli.execute
 
 if __name__ == '__main__':
     parser = get_parser()
@@ -7,49 +7,45 @@
 # Need msrest >= 0.6.0
 # See also https://pypi.org/project/azure-identity/
 
-from azure.core.pipeline import PipelineContext, PipelineRequest
-from azure.core.pipeline.policies import BearerTokenCredentialPolicy
-from azure.core.pipeline.transport import HttpRequest
+import threading
+import time
+
 from azure.identity import DefaultAzureCredential
 from msrest.authentication import BasicTokenAuthentication
 
 
 class AzureIdentityCredentialAdapter(BasicTokenAuthentication):
-    def __init__(self, credential=None, resource_id="https://management.azure.com/.default", **kwargs):
+    def __init__(self, credential=None, resource_id="https://management.azure.com/.default",
+                 refresh_margin=300):
         """Adapt any azure-identity credential to work with SDK that needs azure.common.credentials or msrestazure.
 
         Default resource is ARM (syntax of endpoint v2)
 
         :param credential: Any azure-identity credential (DefaultAzureCredential by default)
         :param str resource_id: The scope to use to get the token (default ARM)
+        :param int refresh_margin: Seconds before expiry at which a cached token is refreshed
         """
         super(AzureIdentityCredentialAdapter, self).__init__(None)
         if credential is None:
             credential = DefaultAzureCredential()
-        self._policy = BearerTokenCredentialPolicy(credential, resource_id, **kwargs)
-
-    def _make_request(self):
-        return PipelineRequest(
-            HttpRequest(
-                "AzureIdentityCredentialAdapter",
-                "https://fakeurl"
-            ),
-            PipelineContext(None)
-        )
-
-    def set_token(self):
-        """Ask the azure-core BearerTokenCredentialPolicy policy to get a token.
-
-        Using the policy gives us for free the caching system of azure-core.
-        We could make this code simpler by using private method, but by definition
-        I can't assure they will be there forever, so mocking a fake call to the policy
-        to extract the token, using 100% public API."""
-        request = self._make_request()
-        self._policy.on_request(request)
-        # Read Authorization, and get the second part after Bearer
-        token = request.http_request.headers["Authorization"].split(" ", 1)[1]
-        self.token = {"access_token": token}
+        self._credential = credential
+        self._resource_id = resource_id
+        self._refresh_margin = refresh_margin
+        self._expires_on = 0
+        self._lock = threading.Lock()
+
+    def refresh_token(self):
+        """Get a new token, along with its expiry, directly from the credential."""
+        access_token = self._credential.get_token(self._resource_id)
+        self.token = {"access_token": access_token.token}
+        self._expires_on = access_token.expires_on
+
+    def token_needs_refresh(self):
+        return self.token is None or time.time() >= self._expires_on - self._refresh_margin
 
     def signed_session(self, session=None):
-        self.set_token()
-        return super(AzureIdentityCredentialAdapter, self).signed_session(session)
\ No newline at end of file
+        # the token is cached and only refreshed shortly before it expires
+        with self._lock:
+            if self.token_needs_refresh():
+                self.refresh_token()
+        return super(AzureIdentityCredentialAdapter, self).signed_session(session)
@@ -0,0 +1,165 @@
+import argparse
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from . import azfinsim, cli
+
+utils = cli.lazy_import('batch_controller.utils')
+
+# modules that must not be imported when building parsers / printing help
+HEAVY_MODULES = ('azure', 'msrest')
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='controller benchmarks')
+    subparsers = parser.add_subparsers(title='command', description='valid commands')
+
+    submitParser = subparsers.add_parser('submit', help='task submission throughput using a fake Batch client')
+    submitParser.add_argument('-t', '--tasks', type=int, help='total number of tasks (default=50000)', default=50000)
+    submitParser.add_argument('-w', '--workers', type=int, help='concurrent requests (default=8)', default=8)
+    submitParser.add_argument('--latency', type=float, help='simulated latency per request in seconds (default=0.05)', default=0.05)
+    submitParser.add_argument('--server-error-rate', type=float, help='probability of a server error per task (default=0.01)', default=0.01)
+    submitParser.add_argument('--serial', action='store_true', help='also run with a single worker for comparison')
+    submitParser.set_defaults(command_execute=execute_submit)
+
+    scaleParser = subparsers.add_parser('scale', help='task graph construction, submission and simulation at scale')
+    scaleParser.add_argument('-t', '--tasks', type=int, nargs='+', help='number of pricing tasks (default=1000 10000 100000)',
+        default=[1000, 10000, 100000])
+    scaleParser.add_argument('--latency', type=float, help='simulated latency per request in seconds (default=0.02)', default=0.02)
+    scaleParser.add_argument('--nodes', type=int, help='number of nodes to simulate (default=100)', default=100)
+    scaleParser.set_defaults(command_execute=execute_scale)
+
+    tailParser = subparsers.add_parser('tail', help='makespan under injected failures and stragglers, with and without supervision')
+    tailParser.add_argument('-t', '--tasks', type=int, help='number of pricing tasks (default=1000)', default=1000)
+    tailParser.add_argument('--nodes', type=int, help='number of nodes to simulate (default=50)', default=50)
+    tailParser.add_argument('--failure', type=float, help='probability that a task fails (default=0.05)', default=0.05)
+    tailParser.add_argument('--straggler-rate', type=float, help='probability that a task runs 10x slower (default=0.02)', default=0.02)
+    tailParser.add_argument('--max-retries', type=int, help='number of times a failed task is retried (default=1)', default=1)
+    tailParser.add_argument('--seed', type=int, help='random seed (default=0)', default=0)
+    tailParser.set_defaults(command_execute=execute_tail)
+
+    importParser = subparsers.add_parser('import-time', help='import time of command line applications (-X importtime)')
+    importParser.add_argument('-m', '--module', type=str, help='module to import (default=batch_controller.azfinsim)',
+        default='batch_controller.azfinsim')
+    importParser.add_argument('--top', type=int, help='number of slowest imports to print (default=10)', default=10)
+    importParser.set_defaults(command_execute=execute_import_time)
+    return parser
+
+def import_times(module):
+    """import the module and build its parser in a fresh interpreter with `-X importtime`;
+    returns a dict of module name -> cumulative import time in microseconds"""
+    code = 'import {0}; {0}.get_parser()'.format(module)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(.*)$', line)
+        if match:
+            times[match.group(3).strip()] = int(match.group(2))
+    return times
+
+def execute_import_time(args)->None:
+    times = import_times(args.module)
+    print('{}: {:.1f} ms'.format(args.module, times.get(args.module, 0) / 1000))
+    for name, us in sorted(times.items(), key=lambda x: -x[1])[:args.top]:
+        print('  {:8.1f} ms  {}'.format(us / 1000, name))
+    heavy = [name for name in times if name.split('.')[0] in HEAVY_MODULES]
+    if heavy:
+        raise RuntimeError('heavy modules imported at startup: {}'.format(', '.join(sorted(heavy))))
+
+def run(args, workers):
+    from azure.batch import models
+    from . import fake_batch
+
+    # same command lines as `azfinsim job`
+    job_args = argparse.Namespace(tasks=args.tasks, start_trade=0, trade_window=args.tasks * 10,
+        algorithm='deltavega', failure=0.0)
+    settings = models.TaskContainerSettings(image_name='fake.azurecr.io/azfinsim/azfinsim:latest',
+        container_run_options=azfinsim.CONTAINER_RUN_OPTIONS)
+    tasks = (models.TaskAddParameter(id='task_{}'.format(index), command_line=cmd, container_settings=settings)
+        for index, cmd in enumerate(azfinsim.task_command_line_generator(job_args)))
+
+    client = fake_batch.FakeBatchService(latency=args.latency, server_error_rate=args.server_error_rate)
+    client.job.add(models.JobAddParameter(id='benchmark', pool_info=models.PoolInformation(pool_id='azfinsim-pool')))
+    stats = utils.add_tasks(client, 'benchmark', tasks, max_workers=workers)
+    utils.print_submit_stats('benchmark (workers={})'.format(workers), stats)
+    assert len(client.jobs['benchmark'].tasks) == len(stats['task_ids'])
+    return stats
+
+def execute_scale(args)->None:
+    from azure.batch import models
+    from . import fake_batch
+
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>12} {:>12}'.format('pricing', 'tasks', 'build (s)', 'submit (s)',
+        'simulate (s)', 'makespan (s)', 'memory (MB)'))
+    for count in args.tasks:
+        # `workflow-fs --streaming` with `count` pricing tasks
+        wf_args = argparse.Namespace(tasks=count, trade_window=count * 100, algorithm='deltavega', failure=0.0,
+            file='trades.csv', merge_fan_in=16, container_registry_name='fake', max_retries=None, max_wall_clock=None)
+
+        # peak memory used to build the task graph and create its tasks chunk by chunk,
+        # excluding the tasks retained by the fake service
+        tracemalloc.start()
+        for chunk in utils.chunks(azfinsim.streaming_workflow_fs_tasks(wf_args, 'benchmark')):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        tasks = azfinsim.streaming_workflow_fs_tasks(wf_args, 'benchmark')
+        build = time.perf_counter() - start
+
+        service = fake_batch.FakeBatchService(nodes=args.nodes, latency=args.latency,
+            duration=lambda task: azfinsim.estimate_duration(wf_args, task))
+        pool_info = models.PoolInformation(pool_id='azfinsim-pool')
+        service.job.add(models.JobAddParameter(id='benchmark', pool_info=pool_info, uses_task_dependencies=True))
+        start = time.perf_counter()
+        stats = utils.add_tasks(service, 'benchmark', tasks)
+        submit = time.perf_counter() - start
+
+        service.job.update('benchmark', models.JobUpdateParameter(pool_info=pool_info, on_all_tasks_complete='terminateJob'))
+        start = time.perf_counter()
+        results = service.run('benchmark')
+        simulate = time.perf_counter() - start
+        print('{:>8} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f} {:>12.1f}'.format(count, len(stats['task_ids']),
+            build, submit, simulate, max(r['end'] for r in results.values()), peak / 2**20))
+
+def execute_tail(args)->None:
+    from azure.batch import models
+    from . import fake_batch, supervisor
+
+    # `workflow-fs --streaming` with `args.tasks` pricing tasks
+    wf_args = argparse.Namespace(tasks=args.tasks, trade_window=args.tasks * 100, algorithm='deltavega', failure=0.0,
+        file='trades.csv', merge_fan_in=16, container_registry_name='fake', max_retries=args.max_retries,
+        max_wall_clock=None)
+    scenarios = [
+        ('no failures', 0.0, 0.0, None),
+        ('failures', args.failure, args.straggler_rate, None),
+        ('failures, supervised', args.failure, args.straggler_rate, supervisor.StragglerPolicy()),
+    ]
+    print('{:<22} {:>12} {:>8} {:>8} {:>12} {:>12}'.format('scenario', 'makespan (s)', 'failed', 'blocked',
+        'resubmitted', 'speculative'))
+    for name, failure_rate, straggler_rate, policy in scenarios:
+        service = fake_batch.FakeBatchService(nodes=args.nodes, failure_rate=failure_rate, straggler_rate=straggler_rate,
+            policy=policy, seed=args.seed, duration=lambda task: azfinsim.estimate_duration(wf_args, task))
+        pool_info = models.PoolInformation(pool_id='azfinsim-pool')
+        service.job.add(models.JobAddParameter(id='benchmark', pool_info=pool_info, uses_task_dependencies=True))
+        stats = utils.add_tasks(service, 'benchmark', azfinsim.streaming_workflow_fs_tasks(wf_args, 'benchmark'))
+        service.job.update('benchmark', models.JobUpdateParameter(pool_info=pool_info, on_all_tasks_complete='terminateJob'))
+        results = service.run('benchmark')
+        print('{:<22} {:>12.1f} {:>8} {:>8} {:>12} {:>12}'.format(name, max(r['end'] for r in results.values()),
+            sum(1 for r in results.values() if r['exit_code'] != 0), len(stats['task_ids']) - len(results),
+            sum(1 for r in results.values() if r['resubmits']), sum(1 for r in results.values() if r['speculative'])))
+
+def execute_submit(args)->None:
+    run(args, args.workers)
+    if args.serial:
+        run(args, 1)
+
+execute = cli.execute
+
+if __name__ == '__main__':
+    parser = get_parser()
+    execute(parser.parse_args())
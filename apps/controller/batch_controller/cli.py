@@ -0,0 +1,286 @@
+"""Command line framework shared by all applications.
+
+Applications register themselves in `APPS` (or using the `batch_controller.apps`
+entry point group) and provide a `add_commands(subparsers)` function. Modules that
+import the Azure SDK are loaded lazily using `lazy_import` so that building parsers
+and printing help doesn't pay for them.
+"""
+import argparse
+import datetime
+import importlib
+import importlib.util
+import os
+import sys
+
+# built-in applications: name -> module
+APPS = {
+    'azfinsim': 'batch_controller.azfinsim',
+    'lulesh-catalyst': 'batch_controller.lulesh_catalyst',
+    'trame': 'batch_controller.trame',
+}
+
+def lazy_import(name):
+    """import a module that is only executed when one of its attributes is first accessed"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+utils = lazy_import('batch_controller.utils')
+telemetry = lazy_import('batch_controller.telemetry')
+supervisor = lazy_import('batch_controller.supervisor')
+
+def register_app(name, module):
+    """register an application; `module` is the name of a module with `add_commands(subparsers)`"""
+    APPS[name] = module
+
+def get_apps(name=None):
+    """returns all applications, including those registered using entry points, or only
+    application `name`; entry points are scanned (which is slow with many distributions
+    installed) only if `name` isn't a built-in application"""
+    if name in APPS:
+        return {name: APPS[name]}
+    apps = dict(APPS)
+    try:
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        group = eps.select(group='batch_controller.apps') if hasattr(eps, 'select') else eps.get('batch_controller.apps', [])
+        for ep in group:
+            apps.setdefault(ep.name, ep.value)
+    except ImportError:
+        pass
+    return {name: apps[name]} if name in apps else apps
+
+def add_pool_parser(subparsers, pool_id, container_image=None, container_run_options=None, slots_per_task=1):
+    """add the `pool` command for a pool; `container_image(args)`, if specified, returns the
+    image to pull when warming nodes and `slots_per_task` is the default task slots used by
+    each task when autoscaling"""
+    poolParser = subparsers.add_parser('pool', help='pool operations')
+    poolParser.add_argument('-e', '--batch-endpoint',
+        type=str, help='batch account endpoint [REQUIRED]', required=True)
+    poolParser.add_argument('-i', '--info', action='store_true', help='print pool information')
+    poolParser.add_argument('-r','--resize', type=int, help='resize pool to SIZE dedicated nodes', metavar='SIZE', default=-1)
+    poolParser.add_argument('--resize-spot', type=int, help='resize pool to SIZE spot nodes', metavar='SIZE', default=-1)
+    if container_image:
+        poolParser.add_argument('-c','--container-registry-name',type=str, help='container registry url (required for --warm)')
+        poolParser.add_argument('--warm', action='store_true', help='pull container image on all nodes in the pool')
+    add_autoscale_arguments(poolParser, slots_per_task=slots_per_task)
+    add_cost_arguments(poolParser)
+    poolParser.set_defaults(command_execute=execute_pool, pool_id=pool_id,
+        container_image=container_image, container_run_options=container_run_options)
+    return poolParser
+
+def add_autoscale_arguments(parser, slots_per_task=1):
+    """add arguments for autoscale operations to a `pool` sub-command parser"""
+    parser.add_argument('--autoscale', action='store_true', help='enable autoscaling based on pending tasks')
+    parser.add_argument('--disable-autoscale', action='store_true', help='disable autoscaling')
+    parser.add_argument('--max-dedicated', type=int, help='maximum number of dedicated nodes when autoscaling (default=4)', default=4)
+    parser.add_argument('--max-spot', type=int, help='maximum number of spot nodes when autoscaling (default=0)', default=0)
+    parser.add_argument('--dedicated-ratio', type=float,
+        help='fraction of the nodes needed to use dedicated nodes, the rest use spot nodes (default=1.0)', default=1.0)
+    parser.add_argument('--slots-per-task', type=int,
+        help='task slots used by each pending task when autoscaling (default={})'.format(slots_per_task), default=slots_per_task)
+    parser.add_argument('--interval', type=int, help='autoscale evaluation interval in minutes (default=5)', default=5)
+    parser.add_argument('--dry-run', action='store_true', help='evaluate the autoscale formula without enabling it')
+
+def add_cost_arguments(parser):
+    """add arguments to cap the hourly cost of a pool when resizing or autoscaling it"""
+    parser.add_argument('--max-cost', type=float, help='maximum cost per hour of the nodes in the pool (requires node prices)')
+    parser.add_argument('--dedicated-price', type=float, help='price per hour of a dedicated node')
+    parser.add_argument('--spot-price', type=float, help='price per hour of a spot node')
+
+def cost_options(args):
+    """returns keyword arguments for `utils.pool_resize` and `utils.autoscale_formula` with the cost cap"""
+    if args.max_cost is not None and (args.dedicated_price is None or args.spot_price is None):
+        raise RuntimeError('--dedicated-price and --spot-price are required for --max-cost')
+    return {
+        'max_cost': args.max_cost,
+        'dedicated_price': args.dedicated_price,
+        'spot_price': args.spot_price,
+    }
+
+def execute_autoscale(args, pool_id):
+    """enable, disable or evaluate autoscale for a pool using command line arguments;
+    returns False if no autoscale operation was requested"""
+    if args.disable_autoscale:
+        utils.pool_disable_autoscale(endpoint=args.batch_endpoint, pool_id=pool_id)
+        return True
+    if not args.autoscale:
+        return False
+
+    formula = utils.autoscale_formula(max_dedicated=args.max_dedicated, max_spot=args.max_spot,
+        dedicated_ratio=args.dedicated_ratio, slots_per_task=args.slots_per_task, **cost_options(args))
+    if args.dry_run:
+        print(formula)
+        utils.pool_evaluate_autoscale(endpoint=args.batch_endpoint, pool_id=pool_id, formula=formula)
+    else:
+        utils.pool_enable_autoscale(endpoint=args.batch_endpoint, pool_id=pool_id, formula=formula,
+            interval_minutes=args.interval)
+    return True
+
+def execute_pool(args)->None:
+    if execute_autoscale(args, pool_id=args.pool_id):
+        return
+    if getattr(args, 'warm', False):
+        if not args.container_registry_name:
+            raise RuntimeError('--container-registry-name is required for --warm')
+        utils.pool_warm(endpoint=args.batch_endpoint, pool_id=args.pool_id,
+            task_container_image=args.container_image(args),
+            container_run_options=args.container_run_options)
+    elif args.resize >= 0 or args.resize_spot >= 0:
+        utils.pool_resize(endpoint=args.batch_endpoint, pool_id=args.pool_id,
+            targetSize=args.resize if args.resize >= 0 else None,
+            targetSpotSize=args.resize_spot if args.resize_spot >= 0 else None, **cost_options(args))
+    else:
+        utils.print_pool_info(endpoint=args.batch_endpoint, pool_id=args.pool_id)
+
+def get_app_parser(description, add_commands):
+    """returns the parser for a single application"""
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(title='command', description='valid commands')
+    add_commands(subparsers)
+    return parser
+
+def get_parser(app=None):
+    """returns the parser for all applications, or only for application `app` if it exists"""
+    parser = argparse.ArgumentParser(prog='batch_controller', description='Azure Batch controller')
+    apps = parser.add_subparsers(title='application', description='valid applications')
+    for name, module in get_apps(app).items():
+        app = importlib.import_module(module)
+        appParser = apps.add_parser(name, help=app.DESCRIPTION, description=app.DESCRIPTION)
+        app.add_commands(appParser.add_subparsers(title='command', description='valid commands'))
+    return parser
+
+def add_retry_arguments(parser):
+    """add arguments for the retry policy of tasks and for supervising the job"""
+    parser.add_argument('--max-retries', type=int, help='number of times a failed task is retried by the Batch service')
+    parser.add_argument('--max-wall-clock', type=float, metavar='MINUTES',
+        help='maximum time a task may run, including retries, before it is terminated')
+    add_supervise_arguments(parser)
+
+def add_supervise_arguments(parser):
+    """add arguments for supervising a job (see `batch_controller.supervisor`)"""
+    parser.add_argument('--supervise', action='store_true',
+        help='monitor the job, resubmitting failed tasks and duplicating straggling tasks')
+    parser.add_argument('--straggler-factor', type=float,
+        help='duplicate tasks running this many times longer than the median of their peers (default=1.5)', default=1.5)
+    parser.add_argument('--max-resubmits', type=int, help='number of times a failed task is resubmitted (default=2)', default=2)
+
+def retry_options(args):
+    """returns keyword arguments for `utils.create_tasks` and `utils.submit_job` with the retry policy"""
+    return {
+        'max_task_retries': args.max_retries,
+        'max_wall_clock': datetime.timedelta(minutes=args.max_wall_clock) if args.max_wall_clock else None,
+    }
+
+def job_options(args):
+    """returns keyword arguments for `utils.submit_job` and `utils.submit_workflow`; supervised
+    jobs are kept active once all tasks complete so that failed tasks can be reactivated, and
+    are terminated by the supervisor"""
+    return {
+        'on_all_tasks_complete': 'noAction' if getattr(args, 'supervise', False) else 'terminateJob',
+    }
+
+def straggler_policy(args):
+    return supervisor.StragglerPolicy(straggler_factor=args.straggler_factor, max_resubmits=args.max_resubmits)
+
+def follow_job(args, job_id, **kwargs):
+    """supervise or monitor a job as requested using `--supervise` or `--monitor`, exporting
+    telemetry once it ends; returns the result or None if neither was requested"""
+    if getattr(args, 'supervise', False):
+        result = supervisor.supervise_job(endpoint=args.batch_endpoint, job_id=job_id, policy=straggler_policy(args), **kwargs)
+    elif getattr(args, 'monitor', False):
+        result = utils.monitor_job(endpoint=args.batch_endpoint, job_id=job_id, **kwargs)
+    else:
+        return None
+    export_telemetry(args, job_id)
+    return result
+
+def add_telemetry_arguments(parser):
+    """add arguments to export task timings and service call timings (see `batch_controller.telemetry`)"""
+    parser.add_argument('--telemetry-file', type=str,
+        help='save task timings to this file (CSV, or Parquet if the name ends with .parquet) once the job ends')
+    parser.add_argument('--appinsights', type=str, default=os.environ.get('APPLICATIONINSIGHTS_CONNECTION_STRING'),
+        help='Application Insights connection string or instrumentation key to send timings to once the job ends '
+             '(default: $APPLICATIONINSIGHTS_CONNECTION_STRING)')
+
+def export_telemetry(args, job_id):
+    """collect and export timings for a job that ended, if requested on the command line"""
+    path, appinsights = getattr(args, 'telemetry_file', None), getattr(args, 'appinsights', None)
+    if not path and not appinsights:
+        return None
+    records = telemetry.collect_task_times(utils.login(args.batch_endpoint), job_id)
+    telemetry.export(job_id, records, path=path, appinsights=appinsights)
+    return records
+
+def add_report_parser(subparsers):
+    """add the `report` command"""
+    reportParser = subparsers.add_parser('report',
+        help='report queue wait vs run time, node utilization and the critical path of a job')
+    reportParser.add_argument('-e', '--batch-endpoint', type=str, help='batch account endpoint (required with --job-id)')
+    reportParser.add_argument('-j', '--job-id', type=str, help='job id, to fetch task timings from the Batch service')
+    reportParser.add_argument('-i', '--input', type=str, help='read task timings saved earlier using --telemetry-file')
+    add_telemetry_arguments(reportParser)
+    reportParser.set_defaults(command_execute=execute_report)
+    return reportParser
+
+def execute_report(args)->None:
+    if args.input:
+        records = telemetry.read_records(args.input)
+        job_id = records[0]['job_id'] if records else args.input
+        calls = telemetry.read_records(telemetry.calls_path(args.input)) \
+            if os.path.exists(telemetry.calls_path(args.input)) else []
+    elif args.job_id and args.batch_endpoint:
+        job_id = args.job_id
+        records = export_telemetry(args, job_id) or \
+            telemetry.collect_task_times(utils.login(args.batch_endpoint), job_id)
+        calls = []
+    else:
+        raise RuntimeError('either --input or --batch-endpoint and --job-id are required')
+    telemetry.print_report(job_id, records, calls)
+
+def add_simulate_arguments(parser, duration=None):
+    """add arguments to simulate a command using a local fake Batch service; `duration(args, task)`,
+    if specified, estimates the run time of a task in seconds"""
+    parser.add_argument('--simulate', '--dry-run', dest='simulate', action='store_true',
+        help='do not submit; print the planned task graph, its critical path and estimated makespan')
+    parser.add_argument('--simulate-nodes', type=int, help='number of nodes to simulate (default=4)', default=4)
+    parser.add_argument('--simulate-slots', type=int, help='task slots per node to simulate (default=4)', default=4)
+    parser.add_argument('--simulate-straggler-rate', type=float,
+        help='probability that a task runs 10x slower than expected (default=0.0)', default=0.0)
+    parser.set_defaults(simulate_duration=duration)
+
+def execute(args)->None:
+    if not hasattr(args, 'command_execute'):
+        print('missing required command')
+        return
+    if not getattr(args, 'simulate', False):
+        args.command_execute(args)
+        return
+
+    from . import fake_batch
+    duration = (lambda task: args.simulate_duration(args, task)) if args.simulate_duration else fake_batch.estimate_duration
+    # the fake service applies the supervisor's policy while simulating the job
+    policy = straggler_policy(args) if getattr(args, 'supervise', False) else None
+    args.supervise = False
+    service = fake_batch.FakeBatchService(nodes=args.simulate_nodes, slots_per_node=args.simulate_slots,
+        failure_rate=getattr(args, 'failure', 0.0), duration=duration,
+        straggler_rate=args.simulate_straggler_rate, policy=policy)
+    utils.set_backend(lambda endpoint: service)
+    try:
+        args.command_execute(args)
+    finally:
+        utils.set_backend(None)
+    for job_id in service.jobs:
+        service.report(job_id)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # only the application being run needs a parser
+    app = argv[0] if argv and not argv[0].startswith('-') else None
+    execute(get_parser(app).parse_args(argv))
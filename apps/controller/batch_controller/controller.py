@@ -0,0 +1,108 @@
+import asyncio
+import functools
+import time
+
+from azure.batch import models
+
+from . import utils
+
+class BatchController:
+    """asyncio interface to submit, track and cancel jobs on one Batch account.
+
+    The Batch SDK is synchronous, so each REST call is run in a thread; `max_concurrency`
+    bounds the number of calls in flight at any time across all operations. Operations on
+    different jobs and pools can be combined using `asyncio.gather`, e.g.::
+
+        controller = BatchController(endpoint)
+        jobs = await asyncio.gather(
+            controller.submit_job('azfinsim-pool', tasks_a, job_id_prefix='risk-a'),
+            controller.submit_job('lulesh-catalyst-pool', tasks_b, job_id_prefix='lulesh'))
+        await asyncio.gather(*[controller.wait_for_job(job['job_id']) for job in jobs])
+    """
+
+    def __init__(self, endpoint, max_concurrency=16):
+        self.endpoint = endpoint
+        self.client = utils.login(endpoint)
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self.jobs = {}
+
+    async def _call(self, func, *args, **kwargs):
+        """run a blocking call in a thread, respecting the concurrency limit"""
+        if self._semaphore is None:
+            # created here so that it's bound to the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def submit_job(self, pool_id, tasks, job_id_prefix='job', job_id=None,
+                         uses_task_dependencies=False, job_preparation_task=None,
+                         on_all_tasks_complete='terminateJob'):
+        """submit a new job with tasks, an iterable of `TaskAddParameter`s; by default the
+        job terminates once all its tasks complete (use `noAction` to keep it active, e.g. so
+        that failed tasks can still be reactivated)"""
+        job_id = job_id if job_id else "{}-{}".format(job_id_prefix, utils.unique_id())
+        pool_info = models.PoolInformation(pool_id=pool_id)
+        await self._call(self.client.job.add, models.JobAddParameter(id=job_id, pool_info=pool_info,
+            uses_task_dependencies=uses_task_dependencies,
+            job_preparation_task=job_preparation_task))
+
+        stats = await self._call(utils.add_tasks, self.client, job_id, tasks)
+        utils.print_submit_stats(job_id, stats)
+
+        # once tasks are added to job, update the job to terminate the job
+        # once all tasks complete
+        await self._call(self.client.job.update, job_id=job_id,
+            job_update_parameter=models.JobUpdateParameter(on_all_tasks_complete=on_all_tasks_complete,
+            pool_info=pool_info))
+
+        job = {
+            'job_id': job_id,
+            'task_ids': stats['task_ids'],
+            'pool_id': pool_id,
+        }
+        self.jobs[job_id] = job
+        return job
+
+    async def get_job_state(self, job_id):
+        job = await self._call(self.client.job.get, job_id,
+            job_get_options=models.JobGetOptions(select='id,state'))
+        return job.state
+
+    async def get_task_counts(self, job_id):
+        return await self._call(utils.get_task_counts, self.client, job_id)
+
+    async def wait_for_job(self, job_id, min_interval=2.0, max_interval=30.0, backoff=1.5):
+        """wait till all tasks in the job complete; returns the final task counts"""
+        interval = min_interval
+        last = None
+        start = time.perf_counter()
+        while True:
+            counts, state = await asyncio.gather(self.get_task_counts(job_id), self.get_job_state(job_id))
+            summary = utils.print_task_counts(job_id, counts, time.perf_counter() - start, last)
+            interval = min_interval if summary != last else min(interval * backoff, max_interval)
+            last = summary
+            if utils.job_done(state, counts):
+                return counts
+            await asyncio.sleep(interval)
+
+    async def cancel_job(self, job_id, reason='cancelled'):
+        """terminate a job, stopping all of its running tasks"""
+        await self._call(self.client.job.terminate, job_id, terminate_reason=reason)
+
+    async def cancel_all(self, reason='cancelled'):
+        """terminate all jobs submitted by this controller"""
+        await asyncio.gather(*[self.cancel_job(job_id, reason=reason) for job_id in self.jobs])
+
+    async def pool_resize(self, pool_id, target_dedicated_nodes, target_low_priority_nodes=None):
+        await self._call(self.client.pool.resize, pool_id, models.PoolResizeParameter(
+            target_dedicated_nodes=target_dedicated_nodes,
+            target_low_priority_nodes=target_low_priority_nodes))
+
+    async def get_pool(self, pool_id):
+        return await self._call(self.client.pool.get, pool_id=pool_id)
+
+def run(coroutine):
+    """run a coroutine from synchronous code, e.g. a CLI entry point"""
+    return asyncio.run(coroutine)
@@ -0,0 +1,73 @@
+"""Index of the datasets (blobs) in the storage account used by the trame pool.
+
+Listing every blob in every container is slow for large accounts, so the index is cached
+in a local JSON file and refreshed incrementally: containers are listed concurrently, and
+only those listed more than `max_age` seconds ago are listed again. Containers that
+were deleted are dropped from the index.
+"""
+import json
+import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# default time in seconds after which the blobs in a container are listed again
+MAX_AGE = 300
+
+# default number of containers listed concurrently
+MAX_WORKERS = 8
+
+_clients = {}
+
+def get_service_client(endpoint):
+    """returns a `BlobServiceClient`, shared by all indexes for the same account"""
+    if endpoint not in _clients:
+        from azure.storage.blob import BlobServiceClient
+        from . import utils
+        _clients[endpoint] = BlobServiceClient(endpoint, credential=utils.get_credential())
+    return _clients[endpoint]
+
+class DatasetIndex:
+    """datasets in the storage account at `endpoint`, cached in the file at `path` (if any)"""
+
+    def __init__(self, endpoint, path=None, max_age=MAX_AGE, max_workers=MAX_WORKERS):
+        self.endpoint = endpoint
+        self.path = path
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.containers = self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        return data['containers'] if data.get('endpoint') == self.endpoint else {}
+
+    def save(self):
+        if self.path:
+            with open(self.path, 'w') as f:
+                json.dump({'endpoint': self.endpoint, 'containers': self.containers}, f)
+
+    def list_blobs(self, container):
+        client = get_service_client(self.endpoint).get_container_client(container)
+        return {'listed': time.time(), 'blobs': [blob.name for blob in client.list_blobs()]}
+
+    def refresh(self, force=False):
+        """list containers whose blobs were listed more than `max_age` seconds ago (or all,
+        if `force`); returns the number of containers listed"""
+        names = [c.name for c in get_service_client(self.endpoint).list_containers()]
+        now = time.time()
+        stale = [name for name in names if force or name not in self.containers or
+            now - self.containers[name]['listed'] > self.max_age]
+        containers = {name: self.containers[name] for name in names if name not in stale}
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(stale))) as executor:
+                containers.update(zip(stale, executor.map(self.list_blobs, stale)))
+        self.containers = containers
+        self.save()
+        return len(stale)
+
+    def datasets(self):
+        """returns a list of `{'name', 'container'}` for all blobs, as listed by the web server"""
+        return [{'name': name, 'container': container}
+            for container, entry in sorted(self.containers.items()) for name in entry['blobs']]
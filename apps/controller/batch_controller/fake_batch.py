@@ -0,0 +1,487 @@
+"""In-process stand-in for the Batch service.
+
+`FakeBatchService` implements the subset of `BatchServiceClient` used by the
+controller. Tasks added to a job are not executed; instead, once the job is set
+to terminate when all its tasks complete, its task graph is simulated on a pool
+of `nodes` nodes with `slots_per_node` task slots each, honouring task
+dependencies, required slots, retries and randomly injected failures.
+"""
+import collections
+import datetime
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+
+from azure.batch import models
+
+from . import partitioner
+from .supervisor import stage_name
+
+# fixed per-task overhead (container start, reading inputs etc.) in seconds
+TASK_OVERHEAD = 5.0
+
+# seconds needed to price a single trade with a relative cost of 1.0
+SECONDS_PER_TRADE = 0.01
+
+def estimate_duration(task, trades=None):
+    """estimate the duration of a task in seconds from its command line; `trades` is
+    used for pricing tasks that don't specify the number of trades on the command line"""
+    cmd = task.command_line or ''
+    window = re.search(r'--trade-window (\d+)', cmd)
+    algorithm = re.search(r'--algorithm (\w+)', cmd)
+    count = int(window.group(1)) if window else (trades or 0)
+    duration = TASK_OVERHEAD
+    # tasks using node-local scratch space (see `local_shard`) both generate and price trades
+    if 'azfinsim.generator' in cmd:
+        duration += count * SECONDS_PER_TRADE * 0.5
+    if 'azfinsim.azfinsim' in cmd:
+        cost = partitioner.ALGORITHM_COST.get(algorithm.group(1) if algorithm else None, 1.0)
+        duration += count * cost * SECONDS_PER_TRADE
+    return duration
+
+def get_dependencies(task):
+    if not task.depends_on:
+        return []
+    ids = list(task.depends_on.task_ids or [])
+    for r in task.depends_on.task_id_ranges or []:
+        ids += [str(i) for i in range(r.start, r.end + 1)]
+    return ids
+
+def get_slots(task):
+    return task.required_slots or 1
+
+def get_instances(task):
+    """returns the number of nodes a (multi-instance) task runs on"""
+    settings = task.multi_instance_settings
+    return settings.number_of_instances or 1 if settings else 1
+
+def allocate(free, slots, instances=1, avoid=None):
+    """returns the first `instances` nodes with `slots` free task slots, skipping `avoid`
+    unless it's the only node, or None if there aren't enough"""
+    candidates = (n for n in range(len(free)) if free[n] >= slots and (n != avoid or len(free) == 1))
+    nodes = tuple(itertools.islice(candidates, instances))
+    return nodes if len(nodes) == instances else None
+
+def get_max_retries(task):
+    constraints = task.constraints
+    return constraints.max_task_retry_count or 0 if constraints else 0
+
+def critical_path(tasks, duration):
+    """returns `(length in seconds, [task ids])` for the longest chain of dependent tasks,
+    ignoring resource limits"""
+    by_id = {t.id: t for t in tasks}
+    children = collections.defaultdict(list)
+    pending = {}
+    for t in tasks:
+        deps = [d for d in get_dependencies(t) if d in by_id]
+        pending[t.id] = len(deps)
+        for d in deps:
+            children[d].append(t.id)
+
+    finish, parent = {}, {}
+    queue = collections.deque(t.id for t in tasks if pending[t.id] == 0)
+    while queue:
+        tid = queue.popleft()
+        deps = [d for d in get_dependencies(by_id[tid]) if d in by_id]
+        start = max((finish[d] for d in deps), default=0.0)
+        parent[tid] = max(deps, key=lambda d: finish[d]) if deps else None
+        finish[tid] = start + duration(by_id[tid])
+        for c in children[tid]:
+            pending[c] -= 1
+            if pending[c] == 0:
+                queue.append(c)
+    if not finish:
+        return 0.0, []
+    last = max(finish, key=finish.get)
+    path = []
+    while last is not None:
+        path.append(last)
+        last = parent[last]
+    return finish[path[0]], list(reversed(path))
+
+def get_max_wall_clock(task):
+    constraints = task.constraints
+    wall = constraints.max_wall_clock_time if constraints else None
+    return wall.total_seconds() if wall is not None else None
+
+def simulate(tasks, nodes, slots_per_node, duration, failure_rate=0.0, rng=None,
+             straggler_rate=0.0, straggler_factor=10.0, policy=None, poll_interval=5.0):
+    """simulate execution of tasks on the pool; tasks are scheduled in the order they
+    were added once their dependencies succeed, packing each node before using the next.
+
+    Multi-instance tasks use `slots` on each of their nodes. Each run of a task fails with probability `failure_rate` and is slowed down by
+    `straggler_factor` with probability `straggler_rate`. Failed tasks are retried as per
+    their constraints, and tasks exceeding their maximum wall clock time are terminated.
+    If `policy` (a `supervisor.StragglerPolicy`) is specified, the job is supervised every
+    `poll_interval` seconds (the longest interval between polls of `supervisor.supervise_job`):
+    failed tasks are resubmitted and stragglers are duplicated on another node, keeping the
+    copy that succeeds first.
+
+    Returns a dict of task id -> dict with `start`, `end` (seconds), `exit_code`, `node` (the
+    primary node for multi-instance tasks),
+    `retries`, `resubmits` and `speculative` (True if a speculative copy finished first);
+    tasks that never ran (blocked by failed dependencies) are not included."""
+    rng = rng or random.Random()
+    for t in tasks:
+        # such tasks would never be scheduled, leaving the job active forever
+        if get_instances(t) > nodes or get_slots(t) > slots_per_node:
+            raise ValueError('task {} needs {} slots on each of {} nodes, the pool has {} nodes with {} slots each'.format(
+                t.id, get_slots(t), get_instances(t), nodes, slots_per_node))
+    by_id = {t.id: t for t in tasks}
+    order = {t.id: i for i, t in enumerate(tasks)}
+    children = collections.defaultdict(list)
+    pending = {}
+    for t in tasks:
+        deps = [d for d in get_dependencies(t) if d in by_id]
+        pending[t.id] = len(deps)
+        for d in deps:
+            children[d].append(t.id)
+
+    free = [slots_per_node] * nodes
+    # ready runs: (order, sequence, task id, node to avoid); the sequence orders runs of the same task
+    queued = itertools.count()
+    ready = [(order[tid], next(queued), tid, None) for tid, n in pending.items() if n == 0]
+    heapq.heapify(ready)
+    # running attempts: (end, sequence, task id, nodes, start, exit code)
+    running = []
+    # task id -> sequence -> (nodes, start, True for a speculative copy) for running attempts
+    attempts = {}
+    sequence = itertools.count()
+    first_start = {}
+    results = {}
+    retries = collections.Counter()
+    resubmits = collections.Counter()
+    speculated = set()
+    now = 0.0
+    next_poll = poll_interval
+    while ready or running:
+        # start ready tasks in submission order till the next one doesn't fit
+        while ready:
+            _, _, tid, avoid = ready[0]
+            slots = get_slots(by_id[tid])
+            used = allocate(free, slots, get_instances(by_id[tid]), avoid)
+            if used is None:
+                break
+            heapq.heappop(ready)
+            for node in used:
+                free[node] -= slots
+            first_start.setdefault(tid, now)
+            run_time = duration(by_id[tid]) * (straggler_factor if rng.random() < straggler_rate else 1.0)
+            end, exit_code = now + run_time, 1 if rng.random() < failure_rate else 0
+            deadline = get_max_wall_clock(by_id[tid])
+            if deadline is not None and end > first_start[tid] + deadline:
+                # terminated by the Batch service; such tasks are not retried
+                end, exit_code = max(now, first_start[tid] + deadline), -1
+            seq = next(sequence)
+            attempts.setdefault(tid, {})[seq] = (used, now, avoid is not None)
+            heapq.heappush(running, (end, seq, tid, used, now, exit_code))
+        if not running:
+            break
+
+        if policy is not None and next_poll < running[0][0]:
+            now = max(now, next_poll)
+            next_poll = now + poll_interval
+            for tid, runs in list(attempts.items()):
+                if len(runs) == 1 and tid not in speculated:
+                    used, start, _ = next(iter(runs.values()))
+                    if policy.is_straggler(tid, now - start):
+                        speculated.add(tid)
+                        heapq.heappush(ready, (order[tid], next(queued), tid, used[0]))
+                    continue
+                # a speculative copy that straggles as well is terminated and reactivated
+                for seq, (used, start, copy) in list(runs.items()):
+                    if copy and policy.is_straggler(tid, now - start) and policy.resubmit(tid):
+                        del runs[seq]
+                        for node in used:
+                            free[node] += get_slots(by_id[tid])
+                        resubmits[tid] += 1
+                        avoid = next((u[0] for u, _, c in runs.values() if not c), used[0])
+                        heapq.heappush(ready, (order[tid], next(queued), tid, avoid))
+                if not runs:
+                    del attempts[tid]
+            continue
+
+        now, seq, tid, used, start, exit_code = heapq.heappop(running)
+        runs = attempts.get(tid)
+        if not runs or seq not in runs:
+            # terminated when another attempt succeeded or restarted by the supervisor
+            continue
+        _, _, copy = runs.pop(seq)
+        if not runs:
+            del attempts[tid]
+        for node in used:
+            free[node] += get_slots(by_id[tid])
+        if exit_code != 0:
+            # a speculative copy runs again away from the original's node
+            avoid = next((u[0] for u, _, c in runs.values() if not c), used[0]) if copy else None
+            if exit_code > 0 and retries[tid] < get_max_retries(by_id[tid]):
+                retries[tid] += 1
+                heapq.heappush(ready, (order[tid], next(queued), tid, avoid))
+            elif policy is not None and policy.resubmit(tid):
+                # reactivated tasks start with a new retry count and wall clock; a failed
+                # attempt is reactivated even if another one is still running
+                resubmits[tid] += 1
+                retries[tid] = 0
+                if tid not in attempts:
+                    first_start.pop(tid)
+                heapq.heappush(ready, (order[tid], next(queued), tid, avoid))
+            elif tid in attempts:
+                # another attempt is still running
+                pass
+            else:
+                results[tid] = {'start': start, 'end': now, 'exit_code': exit_code, 'node': used[0],
+                    'retries': retries[tid], 'resubmits': resubmits[tid], 'speculative': False}
+            continue
+
+        results[tid] = {'start': start, 'end': now, 'exit_code': 0, 'node': used[0], 'retries': retries[tid],
+            'resubmits': resubmits[tid], 'speculative': copy}
+        for other_nodes, _, _ in attempts.pop(tid, {}).values():
+            for node in other_nodes:
+                free[node] += get_slots(by_id[tid])
+        if policy is not None:
+            policy.add_wall_time(tid, now - start)
+        for c in children[tid]:
+            pending[c] -= 1
+            if pending[c] == 0:
+                heapq.heappush(ready, (order[c], next(queued), c, None))
+    return results
+
+class FakeJob:
+    def __init__(self, params):
+        self.params = params
+        self.tasks = collections.OrderedDict()
+        # set once all tasks are added, i.e. when `on_all_tasks_complete` is updated
+        self.submitted = False
+        self.terminate_on_complete = False
+        self.terminated = False
+        self.results = None
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+
+class FakeJobOperations:
+    def __init__(self, service):
+        self.service = service
+
+    def add(self, job):
+        self.service.call()
+        with self.service.lock:
+            if job.id in self.service.jobs:
+                raise ValueError('job already exists: {}'.format(job.id))
+            self.service.jobs[job.id] = FakeJob(job)
+
+    def update(self, job_id, job_update_parameter):
+        self.service.call()
+        job = self.service.jobs[job_id]
+        job.submitted = True
+        job.terminate_on_complete = job_update_parameter.on_all_tasks_complete == 'terminateJob'
+
+    def terminate(self, job_id, terminate_reason=None):
+        self.service.call()
+        self.service.jobs[job_id].terminated = True
+
+    def get(self, job_id, job_get_options=None):
+        self.service.call()
+        job = self.service.jobs[job_id]
+        results = self.service.run(job_id)
+        done = results is not None and len(results) == len(job.tasks)
+        if job.terminated or (done and job.terminate_on_complete):
+            state = models.JobState.completed
+        else:
+            state = models.JobState.active
+        return models.CloudJob(id=job_id, state=state, pool_info=job.params.pool_info,
+            job_preparation_task=job.params.job_preparation_task)
+
+    def list_preparation_and_release_task_status(self, job_id):
+        # job preparation tasks are not simulated
+        self.service.call()
+        return []
+
+    def get_task_counts(self, job_id):
+        self.service.call()
+        job = self.service.jobs[job_id]
+        results = self.service.run(job_id) or {}
+        failed = [tid for tid, r in results.items() if r['exit_code'] != 0]
+        slots = lambda tids: sum((job.tasks[tid].required_slots or 1) * get_instances(job.tasks[tid]) for tid in tids)
+        return models.TaskCountsResult(
+            task_counts=models.TaskCounts(active=len(job.tasks) - len(results), running=0,
+                completed=len(results), succeeded=len(results) - len(failed), failed=len(failed)),
+            task_slot_counts=models.TaskSlotCounts(active=slots(tid for tid in job.tasks if tid not in results), running=0,
+                completed=slots(results), succeeded=slots(tid for tid in results if tid not in failed), failed=slots(failed)))
+
+class FakeTaskOperations:
+    def __init__(self, service):
+        self.service = service
+
+    def add_collection(self, job_id, value):
+        if len(value) > 100:
+            raise ValueError('too many tasks in a single request: {}'.format(len(value)))
+        self.service.call()
+        job = self.service.jobs[job_id]
+        results = []
+        with self.service.lock:
+            self.service.requests += 1
+            for task in value:
+                if self.service.rng.random() < self.service.server_error_rate:
+                    results.append(models.TaskAddResult(status=models.TaskAddStatus.server_error, task_id=task.id))
+                elif task.id in job.tasks:
+                    results.append(models.TaskAddResult(status=models.TaskAddStatus.client_error, task_id=task.id))
+                else:
+                    job.tasks[task.id] = task
+                    results.append(models.TaskAddResult(status=models.TaskAddStatus.success, task_id=task.id))
+        return models.TaskAddCollectionResult(value=results)
+
+    def reactivate(self, job_id, task_id):
+        # failed tasks are resubmitted by `simulate` using the supervisor's policy
+        self.service.call()
+
+    def list(self, job_id, task_list_options=None):
+        self.service.call()
+        job = self.service.jobs[job_id]
+        results = self.service.run(job_id) or {}
+        base = job.created
+        for tid, task in job.tasks.items():
+            r = results.get(tid)
+            if r is None:
+                yield models.CloudTask(id=tid, command_line=task.command_line, state=models.TaskState.active,
+                    state_transition_time=base, creation_time=base, depends_on=task.depends_on,
+                    required_slots=task.required_slots)
+                continue
+            end = base + datetime.timedelta(seconds=r['end'])
+            yield models.CloudTask(id=tid, command_line=task.command_line, state=models.TaskState.completed,
+                state_transition_time=end, creation_time=base, depends_on=task.depends_on,
+                required_slots=task.required_slots,
+                node_info=models.ComputeNodeInformation(node_id='node-{}'.format(r['node']), pool_id=job.params.pool_info.pool_id),
+                execution_info=models.TaskExecutionInformation(start_time=base + datetime.timedelta(seconds=r['start']),
+                    end_time=end, exit_code=r['exit_code'], retry_count=r['retries'], requeue_count=0))
+
+class FakeFileOperations:
+    def __init__(self, service):
+        self.service = service
+
+    def get_from_task(self, job_id, task_id, file_path):
+        # tasks are not executed, so their output files are empty
+        self.service.call()
+        return iter([b''])
+
+class FakePoolOperations:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, pool_id, pool_get_options=None):
+        self.service.call()
+        return models.CloudPool(id=pool_id, state=models.PoolState.active,
+            allocation_state=models.AllocationState.steady,
+            current_dedicated_nodes=self.service.nodes - self.service.spot_nodes,
+            target_dedicated_nodes=self.service.nodes - self.service.spot_nodes,
+            current_low_priority_nodes=self.service.spot_nodes, target_low_priority_nodes=self.service.spot_nodes,
+            task_slots_per_node=self.service.slots_per_node, enable_auto_scale=False)
+
+    def resize(self, pool_id, pool_resize_parameter):
+        self.service.call()
+        self.service.spot_nodes = pool_resize_parameter.target_low_priority_nodes or 0
+        self.service.nodes = (pool_resize_parameter.target_dedicated_nodes or 0) + self.service.spot_nodes
+
+class FakeComputeNodeOperations:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, pool_id, compute_node_list_options=None):
+        self.service.call()
+        return [models.ComputeNode(id='node-{}'.format(i), affinity_id='affinity-{}'.format(i),
+            state=models.ComputeNodeState.idle) for i in range(self.service.nodes)]
+
+class FakeBatchService:
+    """in-process fake of the Batch service with a single pool of `nodes` nodes.
+
+    `latency` adds a delay to every request, `server_error_rate` is the probability that
+    adding a task fails with a server error and `failure_rate` the probability that a task
+    fails when executed. `duration(task)` returns the simulated run time of a task. See
+    `simulate` for `straggler_rate`, `straggler_factor` and `policy`."""
+
+    def __init__(self, nodes=4, slots_per_node=4, latency=0.0, server_error_rate=0.0,
+                 failure_rate=0.0, duration=estimate_duration, seed=None,
+                 straggler_rate=0.0, straggler_factor=10.0, policy=None):
+        self.nodes = nodes
+        self.spot_nodes = 0
+        self.slots_per_node = slots_per_node
+        self.latency = latency
+        self.server_error_rate = server_error_rate
+        self.failure_rate = failure_rate
+        self.straggler_rate = straggler_rate
+        self.straggler_factor = straggler_factor
+        self.policy = policy
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.job = FakeJobOperations(self)
+        self.task = FakeTaskOperations(self)
+        self.file = FakeFileOperations(self)
+        self.pool = FakePoolOperations(self)
+        self.compute_node = FakeComputeNodeOperations(self)
+
+    def call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def run(self, job_id):
+        """simulate the job once all its tasks have been added; returns task results"""
+        job = self.jobs[job_id]
+        with self.lock:
+            if job.results is None and job.submitted:
+                job.results = simulate(list(job.tasks.values()), self.nodes, self.slots_per_node,
+                    self.duration, self.failure_rate, self.rng, straggler_rate=self.straggler_rate,
+                    straggler_factor=self.straggler_factor, policy=self.policy)
+            return job.results
+
+    def close(self):
+        pass
+
+    def report(self, job_id):
+        """print the task graph, critical path and estimated makespan for a job"""
+        job = self.jobs[job_id]
+        tasks = list(job.tasks.values())
+        print_task_graph(job_id, tasks)
+
+        length, path = critical_path(tasks, self.duration)
+        print('Critical path: {:.1f}s ({} tasks): {}'.format(length, len(path),
+            ' -> '.join(path) if len(path) <= 8 else ' -> '.join(path[:4] + ['...'] + path[-3:])))
+
+        results = self.run(job_id) or {}
+        if not results:
+            return
+        makespan = max(r['end'] for r in results.values())
+        busy = sum((r['end'] - r['start']) * get_slots(job.tasks[tid]) * get_instances(job.tasks[tid])
+            for tid, r in results.items())
+        capacity = makespan * self.nodes * self.slots_per_node
+        failed = sum(1 for r in results.values() if r['exit_code'] != 0)
+        print('Estimated makespan on {} nodes x {} slots: {:.1f}s (utilization: {:.0f}%)'.format(
+            self.nodes, self.slots_per_node, makespan, 100 * busy / capacity if capacity else 0))
+        if failed or len(results) < len(tasks):
+            print('  {} tasks failed, {} tasks blocked by failed dependencies'.format(failed, len(tasks) - len(results)))
+        if self.policy is not None:
+            print('  {} tasks resubmitted, {} tasks finished by a speculative copy'.format(
+                sum(1 for r in results.values() if r['resubmits']), sum(1 for r in results.values() if r['speculative'])))
+
+def print_task_graph(job_id, tasks):
+    """Print a summary of the task graph grouped by task id prefix"""
+    stages = collections.OrderedDict()
+    edges = collections.defaultdict(collections.Counter)
+    for t in tasks:
+        stage = stage_name(t.id)
+        stages.setdefault(stage, collections.Counter())
+        stages[stage]['tasks'] += 1
+        stages[stage]['slots'] += get_slots(t) * get_instances(t)
+        for d in get_dependencies(t):
+            edges[stage][stage_name(d)] += 1
+    print("""=============================================
+{job_id} (planned)
+=============================================
+Tasks: {count}""".format(job_id=job_id, count=len(tasks)))
+    for stage, counts in stages.items():
+        deps = ', '.join('{} ({} edges)'.format(s, n) for s, n in edges[stage].items())
+        print('  {}: {} tasks, {} slots{}'.format(stage, counts['tasks'], counts['slots'],
+            ', depends on: ' + deps if deps else ''))
@@ -0,0 +1,98 @@
+"""Recurring jobs using Batch job schedules.
+
+A job schedule creates a new job every `interval`; each job runs a single job manager task
+and terminates once that task completes. The Batch service runs at most one job of a
+schedule at a time, so if a run takes longer than the interval the next one only starts
+once it completes and runs never overlap, e.g. on a watermark they update.
+"""
+import datetime
+
+from azure.batch import models
+from azure.batch.models import BatchErrorException
+
+from . import utils
+
+JOB_MANAGER_TASK_ID = 'job-manager'
+
+def job_manager_task(command_line, task_container_image=None, container_run_options=None, elevatedUser=False,
+                     required_slots=None, max_task_retries=None, max_wall_clock=None):
+    """returns the task run by each job of a schedule; the job ends when it completes"""
+    user, settings = utils.task_settings(task_container_image, container_run_options, elevatedUser)
+    return models.JobManagerTask(id=JOB_MANAGER_TASK_ID, command_line=command_line,
+        user_identity=user, container_settings=settings,
+        constraints=utils.task_constraints(max_task_retries, max_wall_clock),
+        required_slots=required_slots,
+        kill_job_on_completion=True,
+        # only use the task's slots instead of a whole node
+        run_exclusive=False)
+
+def create_schedule(endpoint, schedule_id, pool_id, task, interval_minutes, do_not_run_after=None, display_name=None):
+    """create a job schedule running `task` (see `job_manager_task`) every `interval_minutes`"""
+    client = utils.login(endpoint)
+    schedule = models.Schedule(recurrence_interval=datetime.timedelta(minutes=interval_minutes),
+        do_not_run_after=do_not_run_after)
+    spec = models.JobSpecification(pool_info=models.PoolInformation(pool_id=pool_id),
+        display_name=display_name, job_manager_task=task)
+    try:
+        client.job_schedule.add(models.JobScheduleAddParameter(id=schedule_id, display_name=display_name,
+            schedule=schedule, job_specification=spec))
+    except BatchErrorException as e:
+        if e.error.code == 'JobScheduleExists':
+            raise RuntimeError('job schedule {} exists; delete it first or use another id'.format(schedule_id))
+        raise
+    print('{}: runs every {} minutes on {}'.format(schedule_id, interval_minutes, pool_id))
+    return {
+        'schedule_id': schedule_id,
+        'pool_id': pool_id,
+    }
+
+def list_runs(client, schedule_id, count=None):
+    """returns the jobs created by a schedule, most recent first"""
+    jobs = client.job.list_from_job_schedule(schedule_id,
+        job_list_from_job_schedule_options=models.JobListFromJobScheduleOptions(select='id,state,creationTime,executionInfo'))
+    return sorted(jobs, key=lambda j: j.creation_time, reverse=True)[:count]
+
+def print_schedules(endpoint):
+    """print all job schedules with their next run"""
+    client = utils.login(endpoint)
+    options = models.JobScheduleListOptions(select='id,state,schedule,executionInfo')
+    for s in client.job_schedule.list(job_schedule_list_options=options):
+        info = s.execution_info
+        print('{id}: {state}, every {interval}, next run {next_run}, last job {last_job}'.format(id=s.id, state=s.state,
+            interval=s.schedule.recurrence_interval if s.schedule else '<n/a>',
+            next_run=info.next_run_time if info and info.next_run_time else '<n/a>',
+            last_job=info.recent_job.id if info and info.recent_job else '<n/a>'))
+
+def print_schedule(endpoint, schedule_id, runs=5):
+    """print a job schedule, its recent runs and the output of the most recent one"""
+    client = utils.login(endpoint)
+    s = client.job_schedule.get(schedule_id)
+    info = s.execution_info
+    print("""=============================================
+{id} (display name: '{display_name}')
+=============================================
+State: {state}
+Pool: {pool_id}
+Interval: {interval}
+Next Run: {next_run}
+""".format(id=s.id, display_name=s.display_name if s.display_name else '<n/a>', state=s.state,
+    pool_id=s.job_specification.pool_info.pool_id, interval=s.schedule.recurrence_interval,
+    next_run=info.next_run_time if info and info.next_run_time else '<n/a>'))
+    jobs = list_runs(client, schedule_id, runs)
+    for job in jobs:
+        print('{}: {} (created {})'.format(job.id, job.state, job.creation_time))
+    if jobs:
+        output = utils.get_task_output(client, jobs[0].id, JOB_MANAGER_TASK_ID)
+        print('\n{} output:\n{}'.format(jobs[0].id, output if output is not None else '<n/a>'))
+
+def set_enabled(endpoint, schedule_id, enabled):
+    """enable or disable a schedule; disabling it doesn't stop a job that is running"""
+    client = utils.login(endpoint)
+    if enabled:
+        client.job_schedule.enable(schedule_id)
+    else:
+        client.job_schedule.disable(schedule_id)
+
+def delete_schedule(endpoint, schedule_id):
+    """delete a schedule along with all of its jobs"""
+    utils.login(endpoint).job_schedule.delete(schedule_id)
@@ -0,0 +1,251 @@
+"""Price a shard of trades using node-local scratch space.
+
+Used by `azfinsim workflow-fs --locality`: instead of a split task writing shard files to
+the shared mount and pricing tasks on other nodes reading them back, each pricing task
+reads its own byte range of the source CSV (or, when streaming, generates its own trades)
+into its working directory, prices the shard there and copies only the results to
+shared storage.
+
+Used by `azfinsim schedule create` with `--watermark`: each run reads the trades appended to
+the source CSV since the previous run, prices them and then advances the watermark, a small
+JSON file on the shared mount with the next start trade and its byte offset.
+
+With `--checkpoint-dir`, trades are priced `--chunk-size` at a time and progress (the number
+of trades priced and the results so far) is saved on the shared mount after each chunk, so
+a task that is requeued after its spot node was preempted resumes after the last priced
+trade instead of pricing all of its trades again. With `--trade-window`, this is used for
+pricing tasks reading trades from the cache: each chunk is priced using `--start-trade` and
+`--trade-window`.
+
+This module runs in the azfinsim container, which doesn't have `batch_controller`
+installed, so it only uses the standard library. The pool's start task copies it from the
+tools image to each node once and tasks mount it read-only at `SCRIPT` (see
+`apps/azfinsim/pools.bicep` and `azfinsim.CONTAINER_RUN_OPTIONS`).
+"""
+import argparse
+import itertools
+import json
+import os
+import os.path
+import runpy
+import shutil
+import sys
+
+# path of this module in the azfinsim container
+SCRIPT = '/opt/tools/local_shard.py'
+
+def read_range(source, output, part, parts):
+    """copy the header and the lines of part `part` of `parts` of a CSV file to `output`.
+
+    The file is split into byte ranges of equal size and each line belongs to the range it
+    starts in, so every line is copied by exactly one part and each part reads little more
+    than its own range. Returns the number of lines copied, excluding the header."""
+    size = os.path.getsize(source)
+    start, end = size * part // parts, size * (part + 1) // parts
+    count = 0
+    with open(source, 'rb') as src, open(output, 'wb') as dst:
+        header = src.readline()
+        dst.write(header)
+        if start > src.tell():
+            # skip to the first line starting at or after `start`
+            src.seek(start - 1)
+            src.readline()
+        while src.tell() < end:
+            line = src.readline()
+            if not line:
+                break
+            dst.write(line)
+            count += 1
+    return count
+
+def read_new(source, output, start_trade, offset=None, max_trades=0):
+    """copy the header and the lines after the first `start_trade` ones (starting at byte
+    `offset`, if known) of a CSV file to `output`, at most `max_trades` of them if not 0.
+
+    A last line without a line break is still being written and is left for the next run.
+    Returns a tuple `(number of lines copied, offset of the next line)`."""
+    count = 0
+    with open(source, 'rb') as src, open(output, 'wb') as dst:
+        dst.write(src.readline())
+        if offset is None:
+            for _ in range(start_trade):
+                if not src.readline().endswith(b'\n'):
+                    raise RuntimeError('{} has fewer than {} trades'.format(source, start_trade))
+        else:
+            src.seek(offset)
+        offset = src.tell()
+        while not max_trades or count < max_trades:
+            line = src.readline()
+            if not line.endswith(b'\n'):
+                break
+            dst.write(line)
+            offset += len(line)
+            count += 1
+    return count, offset
+
+def load_json(path, default):
+    """returns the document saved at `path` using `save_json`, or `default` if there's none"""
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_json(path, data):
+    """replace the document at `path` so that readers never see a partial file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+def checkpoint_path(checkpoint_dir):
+    """returns the checkpoint file of this task; a requeued task keeps its job and task id"""
+    return os.path.join(checkpoint_dir, os.environ['AZ_BATCH_JOB_ID'], os.environ['AZ_BATCH_TASK_ID'] + '.json')
+
+def run_module(argv):
+    """run `['-m', module, args...]` in this interpreter, raising if it fails"""
+    assert argv[0] == '-m', 'expected -m MODULE'
+    saved = sys.argv
+    sys.argv = [argv[1]] + argv[2:]
+    try:
+        runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+    finally:
+        sys.argv = saved
+
+def results_name(shard):
+    name, ext = os.path.splitext(shard)
+    return '{}.results{}'.format(name, ext)
+
+def price_shard(price, shard, output, checkpoint, chunk_size):
+    """price the trades in `shard`, `chunk_size` at a time, appending their results to
+    `output + '.partial'` and saving progress to `checkpoint` after each chunk; trades priced
+    before the task was restarted are skipped. The results are renamed to `output` once all
+    trades are priced."""
+    partial = output + '.partial'
+    progress = load_json(checkpoint, {'priced': 0, 'size': 0})
+    if progress['priced'] and not os.path.exists(partial) and os.path.exists(output):
+        print('all trades were priced before the task was restarted')
+        return
+    with open(partial, 'ab') as f:
+        # drop the results of a chunk priced after the last checkpoint
+        f.truncate(progress['size'])
+    if progress['priced']:
+        print('resuming after {} priced trades'.format(progress['priced']))
+
+    name, ext = os.path.splitext(shard)
+    chunk = '{}.chunk{}'.format(name, ext)
+    with open(shard, 'rb') as src:
+        header = src.readline()
+        for _ in range(progress['priced']):
+            src.readline()
+        while True:
+            lines = list(itertools.islice(src, chunk_size))
+            if not lines:
+                break
+            with open(chunk, 'wb') as f:
+                f.write(header)
+                f.writelines(lines)
+            run_module(price + ['--cache-type', 'filesystem', '--cache-path', chunk])
+            with open(results_name(chunk), 'rb') as results, open(partial, 'ab') as dst:
+                # each chunk's results have a header, only the first one is kept
+                first = results.readline()
+                if progress['size'] == 0:
+                    dst.write(first)
+                shutil.copyfileobj(results, dst)
+                size = dst.tell()
+            progress = {'priced': progress['priced'] + len(lines), 'size': size}
+            save_json(checkpoint, progress)
+            print('priced {} trades'.format(progress['priced']))
+    os.replace(partial, output)
+
+def price_window(price, start, count, checkpoint, chunk_size):
+    """price trades `[start, start + count)` from the cache, `chunk_size` at a time, saving the
+    last priced trade to `checkpoint` after each chunk; trades priced before the task was
+    restarted are skipped"""
+    progress = load_json(checkpoint, {'priced': 0})
+    if progress['priced']:
+        print('resuming after trade {}'.format(start + progress['priced'] - 1))
+    for offset in range(progress['priced'], count, chunk_size):
+        delta = min(chunk_size, count - offset)
+        run_module(price + ['--start-trade', str(start + offset), '--trade-window', str(delta)])
+        save_json(checkpoint, {'priced': offset + delta, 'last_trade': start + offset + delta - 1})
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='price a shard of trades using node-local scratch space')
+    parser.add_argument('--source', type=str, help='CSV file with all trades; the shard is a byte range of it')
+    parser.add_argument('--part', type=int, help='index of the byte range to read from --source')
+    parser.add_argument('--parts', type=int, help='number of byte ranges --source is split into')
+    parser.add_argument('--watermark', type=str,
+        help='JSON file with the next trade to price; only trades appended to --source since the last run are priced')
+    parser.add_argument('--start-trade', type=int, default=0, help='first trade to price with --trade-window, or if --watermark does not exist yet (default=0)')
+    parser.add_argument('--max-trades', type=int, default=0, help='maximum number of trades priced in a run with --watermark (default=0, no limit)')
+    parser.add_argument('--generate', type=str, metavar='COMMAND',
+        help='generator command line, e.g. --generate="-m azfinsim.generator ..."; the shard is generated instead of read from --source')
+    parser.add_argument('--trade-window', type=int,
+        help='price this many trades from --start-trade read from the cache instead of a shard (requires --checkpoint-dir)')
+    parser.add_argument('--shard', type=str, help='file name of the shard in the scratch directory')
+    parser.add_argument('--output-dir', type=str, help='shared directory to copy the results to')
+    parser.add_argument('--checkpoint-dir', type=str,
+        help='shared directory to save progress to after each --chunk-size trades, so that a requeued task resumes')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of trades priced between checkpoints (default=1000)')
+    parser.add_argument('--scratch-dir', type=str, default=os.environ.get('AZ_BATCH_TASK_WORKING_DIR', '.'),
+        help='node-local directory for the shard and its results (default: $AZ_BATCH_TASK_WORKING_DIR)')
+    parser.add_argument('--price', type=str, metavar='COMMAND', required=True,
+        help='pricing command line, e.g. --price="-m azfinsim.azfinsim ..."')
+    return parser
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    price = args.price.split()
+    if args.trade_window is not None:
+        if not args.checkpoint_dir:
+            parser.error('--trade-window requires --checkpoint-dir')
+        price_window(price, args.start_trade, args.trade_window, checkpoint_path(args.checkpoint_dir), args.chunk_size)
+        return
+    if not args.shard or not args.output_dir:
+        parser.error('--shard and --output-dir are required')
+
+    shard = os.path.join(args.scratch_dir, args.shard)
+    if args.watermark:
+        watermark = load_json(args.watermark, {'start_trade': args.start_trade, 'offset': None})
+        start = watermark['start_trade']
+        count, offset = read_new(args.source, shard, start, watermark['offset'], args.max_trades)
+        if count == 0:
+            print('no new trades after trade {} of {}'.format(start, args.source))
+            return
+        # name the shard (and so its results) after the trades it holds
+        name, ext = os.path.splitext(shard)
+        ranged = '{}.{}-{}{}'.format(name, start, start + count, ext)
+        os.replace(shard, ranged)
+        shard = ranged
+        print('read trades [{}, {}) of {}'.format(start, start + count, args.source))
+    elif args.generate:
+        run_module(args.generate.split() + ['--cache-type', 'filesystem', '--cache-path', shard])
+    else:
+        count = read_range(args.source, shard, args.part, args.parts)
+        print('read {} trades from part {} of {} of {}'.format(count, args.part, args.parts, args.source))
+    os.makedirs(args.output_dir, exist_ok=True)
+    output = os.path.join(args.output_dir, os.path.basename(results_name(shard)))
+    if args.checkpoint_dir:
+        price_shard(price, shard, output, checkpoint_path(args.checkpoint_dir), args.chunk_size)
+    else:
+        run_module(price + ['--cache-type', 'filesystem', '--cache-path', shard])
+        shutil.copy(results_name(shard), output)
+    if args.watermark:
+        # advanced only once the results are saved, so a failed run is priced again
+        save_json(args.watermark, {'start_trade': start + count, 'offset': offset})
+
+def command_line(options, generate=None, price=None):
+    """returns the task command line; `options` are the other arguments of this module,
+    e.g. `--source ... --part ... --parts ... --shard ... --output-dir ...`, and the shard and
+    its results are passed to the `generate` and `price` command lines using `--cache-path`"""
+    cmd = '{} {}'.format(SCRIPT, options)
+    if generate:
+        cmd += ' --generate="{}"'.format(generate)
+    return cmd + ' --price="{}"'.format(price)
+
+if __name__ == '__main__':
+    main()
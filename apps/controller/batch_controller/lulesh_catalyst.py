@@ -1,18 +1,44 @@
-import argparse
-from multiprocessing import pool
+import itertools
+import re
+import shlex
 
-from . import utils
+from . import cli
+
+utils = cli.lazy_import('batch_controller.utils')
+telemetry = cli.lazy_import('batch_controller.telemetry')
+
+DESCRIPTION = 'Catalyst-enabled LULESH'
+
+POOL_ID = 'lulesh-catalyst-pool'
+
+LULESH_ARGS = '-p -s {size} -i {iterations} -x /opt/input/script.py'
+
+# runs using more than one MPI rank replace the image's entrypoint with a shell so that
+# $AZ_BATCH_HOST_LIST, the nodes allocated to the multi-instance task, is expanded
+MPI_RUN_OPTIONS = '--entrypoint /bin/bash'
+MPI_COMMAND = "-c 'mpirun --allow-run-as-root --oversubscribe --host $AZ_BATCH_HOST_LIST " \
+    "--map-by ppr:{ranks_per_node}:node -np {ranks} {executable} {args}'"
+MPI_EXECUTABLE = 'lulesh2.0'
+
+# approximate time LULESH takes per zone per iteration in seconds, used by --simulate
+GRIND_TIME = 1e-6
+
+RESULT_COLUMNS = ('task_id', 'size', 'iterations', 'nodes', 'ranks', 'exit_code', 'wall',
+    'elapsed', 'grind_time', 'fom')
 
 def get_parser():
-    parser = argparse.ArgumentParser(description='Catalyst-enabled LULESH')
-    subparsers = parser.add_subparsers(title='command', description='valid commands')
+    return cli.get_app_parser(DESCRIPTION, add_commands)
 
-    poolParser = subparsers.add_parser('pool', help='pool operations')
-    poolParser.add_argument('-e', '--batch-endpoint',
-        type=str, help='batch account endpoint [REQUIRED]', required=True)
-    poolParser.add_argument('-i', '--info', action='store_true', help='print pool information')
-    poolParser.add_argument('-r','--resize', type=int, help='resize pool', metavar='SIZE', default=-1)
-    poolParser.set_defaults(command_execute=execute_pool)
+def add_mpi_arguments(parser):
+    parser.add_argument('--ranks-per-node', type=int, help='MPI ranks per node (default=1)', default=1)
+    parser.add_argument('--coordination-command', type=str,
+        help='command run on all nodes of a multi-node run before LULESH starts, e.g. to start sshd for mpirun; '
+             'like the run itself, it is passed to /bin/bash in the container')
+    parser.add_argument('--mpi-executable', type=str, help='LULESH executable in the container (default={})'.format(
+        MPI_EXECUTABLE), default=MPI_EXECUTABLE)
+
+def add_commands(subparsers):
+    cli.add_pool_parser(subparsers, pool_id=POOL_ID, container_image=container_image)
 
     jobParser = subparsers.add_parser('job', help='job operations')
     jobParser.add_argument('-e', '--batch-endpoint',
@@ -20,28 +46,160 @@ def get_parser():
     jobParser.add_argument('-c','--container-registry-name',type=str, help='container registry url [REQUIRED]', required=True)
     jobParser.add_argument('-s', '--size', help='size of the grid (default=30)', type=int, default=30)
     jobParser.add_argument('-i', '--iterations', help='number of iterations (default=50)', type=int, default=50)
+    jobParser.add_argument('-n', '--nodes', type=int, help='number of nodes to run on using MPI (default=1)', default=1)
+    add_mpi_arguments(jobParser)
+    jobParser.add_argument('--warm-start', action='store_true', help='pull container image on each node before running tasks')
+    cli.add_simulate_arguments(jobParser, duration=estimate_duration)
     jobParser.set_defaults(command_execute=execute_job)
- 
-    return parser
 
-def execute_pool(args)->None:
-    if args.resize >= 0:
-        utils.pool_resize(endpoint=args.batch_endpoint, pool_id='lulesh-catalyst-pool', targetSize=args.resize)
-    else:
-        utils.print_pool_info(endpoint=args.batch_endpoint, pool_id='lulesh-catalyst-pool')
+    sweepParser = subparsers.add_parser('sweep', help='run LULESH for all combinations of sizes, iterations and node counts')
+    sweepParser.add_argument('-e', '--batch-endpoint',
+        type=str, help='batch account endpoint [REQUIRED]', required=True)
+    sweepParser.add_argument('-c','--container-registry-name',type=str, help='container registry url [REQUIRED]', required=True)
+    sweepParser.add_argument('-s', '--sizes', type=int, nargs='+', help='sizes of the grid (default=30)', default=[30])
+    sweepParser.add_argument('-i', '--iterations', type=int, nargs='+', help='numbers of iterations (default=50)', default=[50])
+    sweepParser.add_argument('-n', '--nodes', type=int, nargs='+', help='numbers of nodes (default=1)', default=[1])
+    sweepParser.add_argument('--strong-scaling', action='store_true',
+        help='sizes are of the whole problem rather than of each MPI rank, which must divide them evenly')
+    add_mpi_arguments(sweepParser)
+    sweepParser.add_argument('-o', '--output', type=str,
+        help='save the results of all runs to this file (CSV, or Parquet if the name ends with .parquet)')
+    sweepParser.add_argument('--warm-start', action='store_true', help='pull container image on each node before running tasks')
+    cli.add_retry_arguments(sweepParser)
+    cli.add_telemetry_arguments(sweepParser)
+    cli.add_simulate_arguments(sweepParser, duration=estimate_duration)
+    sweepParser.set_defaults(command_execute=execute_sweep)
+
+def container_image(args):
+    return '{}.azurecr.io/lulesh/lulesh-catalyst:latest'.format(args.container_registry_name)
+
+def cube_root(n):
+    """returns the integer cube root of `n` or None if `n` isn't a cube"""
+    root = round(n ** (1.0 / 3))
+    return root if root ** 3 == n else None
+
+def get_ranks(args, nodes):
+    ranks = nodes * args.ranks_per_node
+    # LULESH decomposes the domain into a cube of ranks
+    if cube_root(ranks) is None:
+        raise RuntimeError('LULESH requires a cube number of MPI ranks (1, 8, 27, ...), got {} nodes x {} ranks per node'.format(
+            nodes, args.ranks_per_node))
+    return ranks
+
+def rank_size(args, size, nodes):
+    """returns the grid size of each rank; with `--strong-scaling`, `size` is that of the whole problem"""
+    if not args.strong_scaling:
+        return size
+    ranks_per_side = cube_root(get_ranks(args, nodes))
+    if size % ranks_per_side:
+        raise RuntimeError('size {} cannot be divided evenly among {}x{}x{} ranks'.format(size, *[ranks_per_side] * 3))
+    return size // ranks_per_side
+
+def command_line(args, size, iterations, nodes):
+    ranks = get_ranks(args, nodes)
+    lulesh_args = LULESH_ARGS.format(size=size, iterations=iterations)
+    if ranks == 1:
+        return lulesh_args
+    return MPI_COMMAND.format(ranks_per_node=args.ranks_per_node, ranks=ranks, executable=args.mpi_executable,
+        args=lulesh_args)
+
+def task_options(args, nodes):
+    """returns keyword arguments for `utils.submit_job` and `utils.create_tasks` to run on `nodes` nodes"""
+    if get_ranks(args, nodes) == 1:
+        return {}
+    # even single node MPI runs are multi-instance tasks so that $AZ_BATCH_HOST_LIST is set
+    return {
+        'container_run_options': MPI_RUN_OPTIONS,
+        'num_instances': nodes,
+        'coordination_command_line': '-c {}'.format(shlex.quote(args.coordination_command))
+            if args.coordination_command else None,
+    }
+
+def estimate_duration(args, task):
+    """estimate the run time of a task in seconds for --simulate"""
+    from . import fake_batch
+    size = re.search(r'-s (\d+)', task.command_line or '')
+    iterations = re.search(r'-i (\d+)', task.command_line or '')
+    if not size or not iterations:
+        return fake_batch.TASK_OVERHEAD
+    return fake_batch.TASK_OVERHEAD + int(size.group(1)) ** 3 * int(iterations.group(1)) * GRIND_TIME
+
+def parse_output(text):
+    """returns the timings reported by LULESH at the end of a run"""
+    patterns = {
+        'elapsed': r'Elapsed time\s*=\s*([-+.\deE]+)',
+        'grind_time': r'Grind time \(us/z/c\)\s*=\s*([-+.\deE]+)',
+        'fom': r'FOM\s*=\s*([-+.\deE]+)',
+    }
+    values = {}
+    for name, pattern in patterns.items():
+        match = re.search(pattern, text or '')
+        values[name] = float(match.group(1)) if match else None
+    return values
+
+def collect_results(client, job_id, tasks, runs):
+    """returns a record for each run in the sweep; `runs` is a dict of task id -> run parameters"""
+    completed = {t.id: t for t in tasks}
+    records = []
+    for task_id, run in runs.items():
+        task = completed.get(task_id)
+        info = task.execution_info if task is not None else None
+        record = dict(run, task_id=task_id, exit_code=info.exit_code if info else None,
+            wall=utils.get_wall_time(task) if task is not None else None)
+        output = utils.get_task_output(client, job_id, task_id) if info and info.exit_code == 0 else None
+        record.update(parse_output(output))
+        records.append(record)
+    return records
+
+def print_results(job_id, records):
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'
+
+    print('{}: results'.format(job_id))
+    print('{:>6} {:>10} {:>6} {:>6} {:>5} {:>10} {:>12} {:>14} {:>12}'.format('size', 'iterations', 'nodes', 'ranks',
+        'exit', 'wall (s)', 'elapsed (s)', 'grind (us/z/c)', 'FOM (z/s)'))
+    for r in records:
+        print('{:>6} {:>10} {:>6} {:>6} {:>5} {:>10} {:>12} {:>14} {:>12}'.format(r['size'], r['iterations'], r['nodes'],
+            r['ranks'], fmt(r['exit_code'], 'd'), fmt(r['wall'], '.1f'), fmt(r['elapsed'], '.2f'),
+            fmt(r['grind_time'], '.4f'), fmt(r['fom'], '.1f')))
 
 def execute_job(args)->None:
-    cmd = '-p -s {size} -i {iterations} -x /opt/input/script.py'.format(size=args.size, iterations=args.iterations)
-    utils.submit_job(endpoint=args.batch_endpoint, pool_id='lulesh-catalyst-pool',
+    cmd = command_line(args, args.size, args.iterations, args.nodes)
+    utils.submit_job(endpoint=args.batch_endpoint, pool_id=POOL_ID,
         num_tasks=1, task_command_lines=[cmd],
-        task_container_image='{}.azurecr.io/lulesh/lulesh-catalyst:latest'.format(args.container_registry_name),
-        job_id_prefix='lulesh-catalyst')
-
-def execute(args)->None:
-    if hasattr(args, 'command_execute'):
-        args.command_execute(args)
-    else:
-        print('missing required command')
+        task_container_image=container_image(args),
+        job_id_prefix='lulesh-catalyst',
+        job_preparation_task=utils.create_job_preparation_task(container_image(args)) if args.warm_start else None,
+        **task_options(args, args.nodes))
+
+def execute_sweep(args)->None:
+    groups, runs = [], {}
+    for nodes in args.nodes:
+        grid = [(rank_size(args, size, nodes), iterations) for size, iterations in itertools.product(args.sizes, args.iterations)]
+        group = utils.create_tasks([command_line(args, size, iterations, nodes) for size, iterations in grid],
+            task_id_prefix='run-n{}'.format(nodes),
+            task_container_image=container_image(args),
+            **task_options(args, nodes), **cli.retry_options(args))
+        for index, (size, iterations) in enumerate(grid):
+            runs[group.task_id(index)] = {'size': size, 'iterations': iterations, 'nodes': nodes,
+                'ranks': get_ranks(args, nodes)}
+        groups.append(group)
+
+    job = utils.submit_workflow(endpoint=args.batch_endpoint, pool_id=POOL_ID,
+        tasks=itertools.chain(*groups), job_id_prefix='lulesh-sweep',
+        job_preparation_task=utils.create_job_preparation_task(container_image(args)) if args.warm_start else None,
+        **cli.job_options(args))
+
+    # results are collected once all runs complete
+    args.monitor = True
+    result = cli.follow_job(args, job['job_id'])
+    records = collect_results(utils.login(args.batch_endpoint), job['job_id'], result['tasks'], runs)
+    print_results(job['job_id'], records)
+    if args.output:
+        telemetry.write_records(args.output, records, RESULT_COLUMNS)
+        print('saved results of {} runs to {}'.format(len(records), args.output))
+
+execute = cli.execute
 
 if __name__ == '__main__':
     parser = get_parser()
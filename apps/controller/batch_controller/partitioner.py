@@ -0,0 +1,152 @@
+"""Split trade windows into contiguous partitions, one per task.
+
+Partitions always cover the trade window exactly: every trade is assigned to
+exactly one partition. With a cost model, partitions are sized so that each
+has roughly the same estimated cost and hence tasks finish at about the same
+time.
+"""
+import bisect
+import itertools
+import json
+import re
+
+# relative cost of pricing a single trade with each algorithm
+ALGORITHM_COST = {
+    'pvonly': 1.0,
+    'deltavega': 3.0,
+}
+
+def partition(start, count, parts):
+    """split `count` trades starting at `start` into at most `parts` contiguous
+    partitions whose sizes differ by at most one; returns a list of `(start, size)`"""
+    if count <= 0:
+        return []
+    assert parts > 0, 'number of partitions must be positive'
+    parts = min(parts, count)
+    size, remainder = divmod(count, parts)
+    result = []
+    for i in range(parts):
+        n = size + 1 if i < remainder else size
+        result.append((start, n))
+        start += n
+    return result
+
+def partition_at(start, count, parts, index):
+    """returns `(start, size)` of partition `index` of `partition(start, count, parts)`
+    without computing the others"""
+    parts = min(parts, count)
+    size, remainder = divmod(count, parts)
+    return start + index * size + min(index, remainder), size + 1 if index < remainder else size
+
+def weighted_partition(start, count, parts, cost):
+    """split `count` trades starting at `start` into at most `parts` contiguous
+    partitions of roughly equal total cost; `cost(trade)` returns the estimated cost
+    of a single trade. Returns a list of `(start, size)`."""
+    if count <= 0:
+        return []
+    assert parts > 0, 'number of partitions must be positive'
+    parts = min(parts, count)
+    cumulative = list(itertools.accumulate(cost(trade) for trade in range(start, start + count)))
+    total = cumulative[-1]
+    if total <= 0:
+        return partition(start, count, parts)
+
+    result = []
+    begin = 0
+    for i in range(1, parts):
+        # end of this partition is the first trade at which the cumulative cost
+        # reaches its share, leaving at least one trade for every remaining partition
+        end = bisect.bisect_left(cumulative, total * i / parts) + 1
+        end = max(end, begin + 1)
+        end = min(end, count - (parts - i))
+        result.append((start + begin, end - begin))
+        begin = end
+    result.append((start + begin, count - begin))
+    return result
+
+class CostModel:
+    """per-trade cost estimated from the durations of earlier tasks.
+
+    `history` is a list of dicts with keys `start`, `count`, `seconds` and, optionally,
+    `algorithm`. Trades not covered by the history are assumed to cost the average.
+    Durations measured with a different algorithm are scaled using `ALGORITHM_COST`."""
+
+    def __init__(self, history, algorithm='deltavega'):
+        scale = lambda h: ALGORITHM_COST[algorithm] / ALGORITHM_COST[h.get('algorithm', algorithm)]
+        self.ranges = sorted((h['start'], h['start'] + h['count'], h['seconds'] * scale(h) / h['count'])
+            for h in history if h['count'] > 0)
+        self.starts = [r[0] for r in self.ranges]
+        trades = sum(r[1] - r[0] for r in self.ranges)
+        self.default = sum((r[1] - r[0]) * r[2] for r in self.ranges) / trades if trades else ALGORITHM_COST[algorithm]
+
+    def __call__(self, trade):
+        idx = bisect.bisect_right(self.starts, trade) - 1
+        if idx >= 0 and trade < self.ranges[idx][1]:
+            return self.ranges[idx][2]
+        return self.default
+
+    @classmethod
+    def load(cls, filename, algorithm='deltavega'):
+        with open(filename, 'r') as f:
+            return cls(json.load(f), algorithm=algorithm)
+
+def partition_ranges(ranges, parts, cost=None):
+    """split a list of disjoint `(start, count)` trade ranges into about `parts`
+    partitions in total; partitions are allotted to ranges in proportion to their
+    size (or cost, if `cost` is specified) with at least one partition per range"""
+    ranges = [r for r in ranges if r[1] > 0]
+    if not ranges:
+        return []
+    if cost is None:
+        weights = [count for _, count in ranges]
+    else:
+        weights = [sum(cost(trade) for trade in range(start, start + count)) for start, count in ranges]
+    total = sum(weights) or 1
+    parts = max(parts, len(ranges))
+    shares = [max(1, int(parts * w / total)) for w in weights]
+    # hand out any remaining partitions to the ranges with the largest weight per partition
+    while sum(shares) < parts:
+        idx = max(range(len(ranges)), key=lambda i: weights[i] / shares[i])
+        shares[idx] += 1
+
+    result = []
+    for (start, count), share in zip(ranges, shares):
+        if cost is None:
+            result += partition(start, count, share)
+        else:
+            result += weighted_partition(start, count, share, cost)
+    return result
+
+def partitions(args):
+    """returns partitions for the trade window specified by command line arguments;
+    if `args.ranges` is set, only those trade ranges are partitioned"""
+    cost_file = getattr(args, 'cost_file', None)
+    cost = CostModel.load(cost_file, algorithm=getattr(args, 'algorithm', 'deltavega')) if cost_file else None
+    ranges = getattr(args, 'ranges', None)
+    if ranges is not None:
+        return partition_ranges(ranges, args.tasks, cost)
+    if cost is not None:
+        return weighted_partition(args.start_trade, args.trade_window, args.tasks, cost)
+    return partition(args.start_trade, args.trade_window, args.tasks)
+
+def history_from_tasks(tasks, get_wall_time):
+    """build cost model history from completed pricing tasks by parsing the trade
+    range and algorithm from their command lines"""
+    history = []
+    for task in tasks:
+        seconds = get_wall_time(task)
+        cmd = task.command_line or ''
+        start = re.search(r'--start-trade (\d+)', cmd)
+        count = re.search(r'--trade-window (\d+)', cmd)
+        algorithm = re.search(r'--algorithm (\w+)', cmd)
+        if seconds is None or not start or not count or 'azfinsim.azfinsim' not in cmd:
+            continue
+        entry = {'start': int(start.group(1)), 'count': int(count.group(1)), 'seconds': seconds}
+        if algorithm and algorithm.group(1) in ALGORITHM_COST:
+            entry['algorithm'] = algorithm.group(1)
+        history.append(entry)
+    return history
+
+def save_history(filename, history):
+    with open(filename, 'w') as f:
+        json.dump(history, f, indent=2)
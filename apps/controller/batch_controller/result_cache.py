@@ -0,0 +1,130 @@
+"""Index of trade ranges that have already been priced.
+
+Each entry records a trade range priced with a specific algorithm and container
+image and is keyed by a hash of those. The index is a JSON document stored
+either in a local file or in a blob (e.g. next to `trades.csv` in the storage
+account mounted on the pool).
+"""
+import hashlib
+import json
+import os.path
+import re
+
+def entry_key(start, count, algorithm, image):
+    """content-address for a priced trade range"""
+    text = '{}:{}:{}:{}'.format(start, count, algorithm, image)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class FileStore:
+    """stores the index in a local file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, data):
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+class BlobStore:
+    """stores the index in a blob, using the blob's etag to detect concurrent updates"""
+
+    def __init__(self, url):
+        from azure.storage.blob import BlobClient
+        from . import utils
+        self.client = BlobClient.from_blob_url(url, credential=utils.get_credential())
+        self.etag = None
+
+    def load(self):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            downloader = self.client.download_blob()
+        except ResourceNotFoundError:
+            self.etag = None
+            return {}
+        self.etag = downloader.properties.etag
+        return json.loads(downloader.readall())
+
+    def save(self, data):
+        from azure.core import MatchConditions
+        if self.etag is None:
+            self.client.upload_blob(json.dumps(data, indent=2), overwrite=False)
+        else:
+            self.client.upload_blob(json.dumps(data, indent=2), overwrite=True,
+                etag=self.etag, match_condition=MatchConditions.IfNotModified)
+
+def open_store(location):
+    if re.match(r'^https://', location):
+        return BlobStore(location)
+    return FileStore(location)
+
+class ResultCache:
+    """index of priced trade ranges"""
+
+    def __init__(self, location):
+        self.store = open_store(location)
+        self.entries = self.store.load()
+
+    def covered(self, algorithm, image):
+        """returns sorted `(start, count)` ranges already priced with the algorithm and image"""
+        return sorted((e['start'], e['count']) for e in self.entries.values()
+            if e['algorithm'] == algorithm and e['image'] == image)
+
+    def missing(self, start, count, algorithm, image):
+        """returns `(start, count)` ranges in the trade window that haven't been priced"""
+        result = []
+        end = start + count
+        for c_start, c_count in self.covered(algorithm, image):
+            if c_start + c_count <= start:
+                continue
+            if c_start >= end:
+                break
+            if c_start > start:
+                result.append((start, c_start - start))
+            start = max(start, c_start + c_count)
+        if start < end:
+            result.append((start, end - start))
+        return result
+
+    def add(self, start, count, algorithm, image, job_id=None, task_id=None):
+        key = entry_key(start, count, algorithm, image)
+        self.entries[key] = {
+            'start': start,
+            'count': count,
+            'algorithm': algorithm,
+            'image': image,
+            'job_id': job_id,
+            'task_id': task_id,
+        }
+        return key
+
+    def invalidate(self, start, count):
+        """forget all entries overlapping the trade range, e.g. after trades in it changed"""
+        end = start + count
+        self.entries = {k: e for k, e in self.entries.items()
+            if e['start'] + e['count'] <= start or e['start'] >= end}
+
+    def save(self):
+        self.store.save(self.entries)
+
+def record_tasks(cache, tasks, image, job_id=None):
+    """add pricing tasks that succeeded to the cache; returns number of entries added"""
+    added = 0
+    for task in tasks:
+        info = task.execution_info
+        cmd = task.command_line or ''
+        start = re.search(r'--start-trade (\d+)', cmd)
+        count = re.search(r'--trade-window (\d+)', cmd)
+        algorithm = re.search(r'--algorithm (\w+)', cmd)
+        if info is None or info.exit_code != 0 or 'azfinsim.azfinsim' not in cmd \
+            or not start or not count or not algorithm:
+            continue
+        cache.add(int(start.group(1)), int(count.group(1)), algorithm.group(1), image,
+            job_id=job_id, task_id=task.id)
+        added += 1
+    return added
@@ -0,0 +1,255 @@
+"""Supervise running jobs, resubmitting failed tasks and speculatively duplicating stragglers.
+
+A task that failed after exhausting its retries is reactivated (so that tasks depending
+on it are not blocked forever). A task running much longer than the median wall time of
+its peers (tasks in the same stage, i.e. with the same task id prefix) is duplicated on
+another node; whichever copy succeeds first is kept and the other one is terminated. A
+copy that straggles as well is terminated and reactivated, i.e. restarted.
+Tasks that depend on a task whose duplicate won are re-added to depend on the
+duplicate instead, since Batch doesn't allow changing the dependencies of a task.
+
+The decisions are made by `StragglerPolicy`, which is also used by
+`fake_batch.simulate` to estimate the effect of supervision on a job.
+"""
+import collections
+import datetime
+import itertools
+import statistics
+
+from azure.batch import models
+from azure.batch.models import BatchErrorException
+
+from . import utils
+
+# suffix of the id of a speculative copy of a task
+SPECULATIVE_SUFFIX = '-speculative'
+
+def stage_name(task_id):
+    """returns the stage of a task, i.e. its task id prefix"""
+    task_id = original_id(task_id)
+    # tasks with integer ids are grouped together
+    return '<integer ids>' if task_id.isdigit() else task_id.rsplit('_', 1)[0]
+
+def speculative_id(task_id):
+    return task_id + SPECULATIVE_SUFFIX
+
+def original_id(task_id):
+    return task_id[:-len(SPECULATIVE_SUFFIX)] if task_id.endswith(SPECULATIVE_SUFFIX) else task_id
+
+class StragglerPolicy:
+    """decides which tasks to resubmit or duplicate.
+
+    A running task is a straggler once it has run `straggler_factor` times longer than
+    the median wall time of at least `min_peers` tasks in its stage that succeeded, or of
+    all tasks that succeeded in stages with fewer tasks.
+    Failed tasks are resubmitted at most `max_resubmits` times each."""
+
+    def __init__(self, straggler_factor=1.5, min_peers=3, max_resubmits=2):
+        self.straggler_factor = straggler_factor
+        self.min_peers = min_peers
+        self.max_resubmits = max_resubmits
+        self.wall_times = collections.defaultdict(list)
+        self.resubmits = collections.Counter()
+
+    def add_wall_time(self, task_id, wall):
+        """record the wall time of a task that succeeded"""
+        self.wall_times[stage_name(task_id)].append(wall)
+
+    def expected_wall_time(self, task_id):
+        """returns the median wall time of the task's peers, or of all tasks if too few of its
+        peers have succeeded (e.g. the last merge of a workflow), or None if too few tasks have"""
+        walls = self.wall_times[stage_name(task_id)]
+        if len(walls) < self.min_peers:
+            walls = list(itertools.chain.from_iterable(self.wall_times.values()))
+        return statistics.median(walls) if len(walls) >= self.min_peers else None
+
+    def is_straggler(self, task_id, elapsed):
+        expected = self.expected_wall_time(task_id)
+        return expected is not None and elapsed > self.straggler_factor * expected
+
+    def resubmit(self, task_id):
+        """returns True if a failed task should be resubmitted, counting the resubmission"""
+        task_id = original_id(task_id)
+        if self.resubmits[task_id] >= self.max_resubmits:
+            return False
+        self.resubmits[task_id] += 1
+        return True
+
+def succeeded(task):
+    info = task.execution_info
+    return info is not None and info.exit_code == 0 and info.result != models.TaskExecutionResult.failure
+
+def depends_on_task(depends_on, task_id):
+    if depends_on is None:
+        return False
+    if task_id in (depends_on.task_ids or []):
+        return True
+    return task_id.isdigit() and any(r.start <= int(task_id) <= r.end for r in depends_on.task_id_ranges or [])
+
+def replace_dependency(depends_on, old_id, new_id):
+    """returns `TaskDependencies` with `old_id` replaced by `new_id`, splitting task id ranges as needed"""
+    ids = [new_id if t == old_id else t for t in depends_on.task_ids or []]
+    ranges = []
+    for r in depends_on.task_id_ranges or []:
+        if old_id.isdigit() and r.start <= int(old_id) <= r.end:
+            n = int(old_id)
+            ranges += [models.TaskIdRange(start=start, end=end)
+                for start, end in ((r.start, n - 1), (n + 1, r.end)) if start <= end]
+            ids.append(new_id)
+        else:
+            ranges.append(r)
+    return models.TaskDependencies(task_ids=ids or None, task_id_ranges=ranges or None)
+
+def rewire_dependents(client, job_id, old_id, new_id):
+    """re-add tasks that haven't started yet and depend on `old_id` so that they depend on
+    `new_id` instead; returns the number of tasks re-added"""
+    count = 0
+    options = models.TaskListOptions(filter="state eq 'active'")
+    for task in list(client.task.list(job_id, task_list_options=options)):
+        if not depends_on_task(task.depends_on, old_id):
+            continue
+        client.task.delete(job_id, task.id)
+        client.task.add(job_id, utils.task_add_parameter(task,
+            depends_on=replace_dependency(task.depends_on, old_id, new_id)))
+        count += 1
+    return count
+
+def pick_other_node(client, pool_id, node_id):
+    """returns affinity for a node other than `node_id`, preferring idle nodes, or None"""
+    nodes = [n for n in client.compute_node.list(pool_id, compute_node_list_options=models.ComputeNodeListOptions(
+        select='id,affinityId,state,runningTaskSlotsCount')) if n.id != node_id]
+    usable = [n for n in nodes if n.state in (models.ComputeNodeState.idle, models.ComputeNodeState.running)]
+    if not usable:
+        return None
+    node = min(usable, key=lambda n: n.running_task_slots_count or 0)
+    return models.AffinityInformation(affinity_id=node.affinity_id)
+
+class Supervisor:
+    """applies a `StragglerPolicy` to a job in the Batch service"""
+
+    def __init__(self, client, job_id, policy, verbose=False):
+        self.client = client
+        self.job_id = job_id
+        self.policy = policy
+        self.verbose = verbose
+        self.handled = set()
+        self.restarted = set()
+        self.winners = {}
+        self.stats = collections.Counter()
+
+    def log(self, message):
+        if self.verbose:
+            print('  ' + message)
+
+    def attempts(self, tracker, task_id):
+        """returns the original task and its speculative copy, if any"""
+        return [tracker.tasks[t] for t in (task_id, speculative_id(task_id)) if t in tracker.tasks]
+
+    def completed(self, tracker, task):
+        tid = original_id(task.id)
+        if tid in self.winners:
+            return False
+        others = [t for t in self.attempts(tracker, tid) if t.id != task.id and t.state != models.TaskState.completed]
+        if succeeded(task):
+            self.winners[tid] = task.id
+            wall = utils.get_wall_time(task)
+            if wall is not None:
+                self.policy.add_wall_time(tid, wall)
+            if task.id != tid:
+                self.stats['speculative_won'] += 1
+                self.stats['rewired'] += rewire_dependents(self.client, self.job_id, tid, task.id)
+                self.log('{}: speculative copy finished first'.format(tid))
+            for other in others:
+                self.client.task.terminate(self.job_id, other.id)
+            return bool(others) or task.id != tid
+        elif self.policy.resubmit(tid):
+            # reactivating keeps the task id, so tasks depending on it are unblocked once it
+            # succeeds; a failed attempt is reactivated even if the other one is still running,
+            # e.g. a speculative copy that failed while the original straggles
+            try:
+                self.client.task.reactivate(self.job_id, task.id)
+            except BatchErrorException as e:
+                # e.g. a job submitted with `terminateJob` that is already terminating
+                self.stats['given_up'] += 1
+                self.log('{}: failed, could not be resubmitted ({})'.format(task.id, e.error.code))
+                return False
+            self.stats['resubmitted'] += 1
+            self.log('{}: failed, resubmitted'.format(task.id))
+            return True
+        return False
+
+    def running(self, tracker, task, now):
+        info = task.execution_info
+        if info is None or info.start_time is None:
+            return False
+        if not self.policy.is_straggler(task.id, (now - info.start_time).total_seconds()):
+            return False
+        if task.id != original_id(task.id):
+            # a speculative copy that straggles as well is terminated, and reactivated once it
+            # completes (see `completed`)
+            key = (task.id, info.start_time)
+            if key in self.restarted:
+                return False
+            self.restarted.add(key)
+            self.client.task.terminate(self.job_id, task.id)
+            self.log('{}: speculative copy straggling too, restarting it'.format(original_id(task.id)))
+            return True
+        if speculative_id(task.id) in tracker.tasks:
+            return False
+        full = self.client.task.get(self.job_id, task.id)
+        node = task.node_info or full.node_info
+        affinity = pick_other_node(self.client, node.pool_id, node.node_id) if node else None
+        self.client.task.add(self.job_id, utils.task_add_parameter(full, id=speculative_id(task.id),
+            depends_on=None, affinity_info=affinity))
+        # so that the copy isn't added again before the next poll lists it
+        tracker.tasks[speculative_id(task.id)] = models.CloudTask(id=speculative_id(task.id),
+            state=models.TaskState.active)
+        self.stats['speculative'] += 1
+        self.log('{}: straggling, started a speculative copy'.format(task.id))
+        return True
+
+    def step(self, tracker):
+        """act on the tasks seen by `tracker`; returns True if tasks were added, reactivated or
+        terminated"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        acted = False
+        for task in list(tracker.tasks.values()):
+            if task.state == models.TaskState.completed:
+                key = (task.id, task.state_transition_time)
+                if key not in self.handled:
+                    self.handled.add(key)
+                    acted = self.completed(tracker, task) or acted
+            elif task.state == models.TaskState.running:
+                acted = self.running(tracker, task, now) or acted
+        return acted
+
+def supervise_job(endpoint, job_id, policy=None, min_interval=2.0, max_interval=5.0, backoff=1.5, verbose=False):
+    """follow a job using `utils.monitor_job`, resubmitting failed tasks and duplicating
+    stragglers according to `policy` (a `StragglerPolicy`) after each poll. The job is
+    terminated once all its tasks complete, since supervised jobs are submitted with
+    `noAction` (see `cli.job_options`) so that the last task to fail can be reactivated.
+
+    Polls are at most `max_interval` seconds apart even when nothing changes, which is
+    typically the case while the last tasks straggle."""
+    client = utils.login(endpoint)
+    policy = policy if policy else StragglerPolicy()
+    supervisor = Supervisor(client, job_id, policy, verbose=verbose)
+    # keep the result of the attempt that won
+    result = utils.monitor_job(endpoint, job_id, min_interval=min_interval, max_interval=max_interval,
+        backoff=backoff, verbose=verbose, on_poll=supervisor.step,
+        keep=lambda t: supervisor.winners.get(original_id(t.id), t.id) == t.id)
+    terminate_job(client, job_id)
+    print('{}: resubmitted {} failed tasks ({} could not be), started {} speculative copies ({} finished first, {} dependent tasks re-added)'.format(
+        job_id, supervisor.stats['resubmitted'], supervisor.stats['given_up'], supervisor.stats['speculative'],
+        supervisor.stats['speculative_won'], supervisor.stats['rewired']))
+    tasks = result['tasks']
+    result.update(succeeded=sum(1 for t in tasks if succeeded(t)), failed=sum(1 for t in tasks if not succeeded(t)))
+    return result
+
+def terminate_job(client, job_id):
+    """terminate a job unless it already completed"""
+    try:
+        client.job.terminate(job_id)
+    except BatchErrorException as e:
+        if e.error.code not in ('JobCompleted', 'JobTerminating'):
+            raise
@@ -0,0 +1,383 @@
+"""Timings of Batch service calls and of tasks.
+
+Every call made through a client returned by `utils.login` is timed (see
+`InstrumentedClient`). Once a job ends, `collect_task_times` fetches when each of its
+tasks was created, became ready (i.e. its dependencies completed), started and ended,
+and when the job preparation task (which pulls the container image) ran on each node.
+Records can be written to a local CSV or Parquet file, sent to Application Insights
+and summarized using `print_report`.
+"""
+import collections
+import contextlib
+import csv
+import datetime
+import functools
+import os.path
+import statistics
+import threading
+import time
+
+# columns of task records
+TASK_COLUMNS = ('job_id', 'task_id', 'stage', 'node_id', 'slots', 'node_slots', 'depends_on',
+    'created', 'ready', 'start', 'end', 'queue_wait', 'run_time', 'exit_code', 'retries')
+
+# columns of service call records
+CALL_COLUMNS = ('name', 'start', 'duration', 'success')
+
+# stage of records for job preparation tasks
+JOB_PREPARATION = 'job-preparation'
+
+# Batch client operation groups that are timed
+OPERATION_GROUPS = ('application', 'account', 'certificate', 'compute_node', 'file', 'job',
+    'job_schedule', 'pool', 'task')
+
+_calls = []
+_calls_lock = threading.Lock()
+
+def record_call(name, start, duration, success):
+    with _calls_lock:
+        _calls.append({'name': name, 'start': start.isoformat(), 'duration': duration, 'success': success})
+
+@contextlib.contextmanager
+def timer(name):
+    """time a service call, recording it even if it raises"""
+    start = datetime.datetime.now(datetime.timezone.utc)
+    begin = time.perf_counter()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        record_call(name, start, time.perf_counter() - begin, success)
+
+class TimedIterator:
+    """wraps the lazy result of a list call (e.g. a `Paged` object), which fetches pages as
+    it's iterated; the time spent making the call and fetching items, excluding the time the
+    caller spends on them, is recorded as a single call once the iteration ends or fails, or
+    the results are dropped"""
+
+    def __init__(self, name, iterator, start, duration=0.0):
+        self._name = name
+        self._iterator = iterator
+        self._start = start
+        self._duration = duration
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        begin = time.perf_counter()
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            self._duration += time.perf_counter() - begin
+            self._finish(True)
+            raise
+        except Exception:
+            self._duration += time.perf_counter() - begin
+            self._finish(False)
+            raise
+        self._duration += time.perf_counter() - begin
+        return item
+
+    def __del__(self):
+        # results that weren't iterated till the end
+        self._finish(True)
+
+    def _finish(self, success):
+        if not self._done:
+            self._done = True
+            record_call(self._name, self._start, self._duration, success)
+
+def get_calls():
+    """returns records of all service calls timed in this process"""
+    with _calls_lock:
+        return list(_calls)
+
+class TimedOperations:
+    """wraps an operation group of a Batch client, timing each call.
+
+    Calls returning paged results (e.g. `task.list`) only send requests as the results are
+    iterated, so the iteration is timed instead (see `TimedIterator`)."""
+
+    def __init__(self, group, operations):
+        self._group = group
+        self._operations = operations
+
+    def __getattr__(self, name):
+        attr = getattr(self._operations, name)
+        if not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            call = '{}.{}'.format(self._group, name)
+            start = datetime.datetime.now(datetime.timezone.utc)
+            begin = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                record_call(call, start, time.perf_counter() - begin, False)
+                raise
+            if hasattr(result, '__next__'):
+                return TimedIterator(call, result, start, time.perf_counter() - begin)
+            record_call(call, start, time.perf_counter() - begin, True)
+            return result
+        return timed
+
+class InstrumentedClient:
+    """wraps a Batch client, timing each call made through its operation groups"""
+
+    def __init__(self, client):
+        self._client = client
+        for group in OPERATION_GROUPS:
+            if hasattr(client, group):
+                setattr(self, group, TimedOperations(group, getattr(client, group)))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+def instrument(client):
+    return client if isinstance(client, InstrumentedClient) else InstrumentedClient(client)
+
+def stage_name(task_id):
+    from .supervisor import stage_name
+    return stage_name(task_id)
+
+def format_dependencies(depends_on):
+    """returns task dependencies as a string of space separated task ids and `start..end` ranges"""
+    if depends_on is None:
+        return ''
+    return ' '.join(list(depends_on.task_ids or []) +
+        ['{}..{}'.format(r.start, r.end) for r in depends_on.task_id_ranges or []])
+
+def parse_dependencies(text):
+    ids = []
+    for token in (text or '').split():
+        if '..' in token:
+            start, end = token.split('..')
+            ids += [str(i) for i in range(int(start), int(end) + 1)]
+        else:
+            ids.append(token)
+    return ids
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+def seconds(start, end):
+    return (end - start).total_seconds() if start is not None and end is not None else None
+
+def collect_task_times(client, job_id):
+    """returns records with timings of all tasks of a job, and of its job preparation task on each node"""
+    from azure.batch import models
+
+    job = client.job.get(job_id)
+    node_slots = None
+    if job.pool_info is not None and job.pool_info.pool_id:
+        pool = client.pool.get(job.pool_info.pool_id, pool_get_options=models.PoolGetOptions(select='id,taskSlotsPerNode'))
+        node_slots = pool.task_slots_per_node
+
+    records = []
+    options = models.TaskListOptions(select='id,creationTime,dependsOn,requiredSlots,executionInfo,nodeInfo')
+    for task in client.task.list(job_id, task_list_options=options):
+        info = task.execution_info
+        records.append({
+            'job_id': job_id,
+            'task_id': task.id,
+            'stage': stage_name(task.id),
+            'node_id': task.node_info.node_id if task.node_info else None,
+            'slots': task.required_slots or 1,
+            'node_slots': node_slots,
+            'depends_on': format_dependencies(task.depends_on),
+            'created': task.creation_time,
+            'start': info.start_time if info else None,
+            'end': info.end_time if info else None,
+            'exit_code': info.exit_code if info else None,
+            'retries': info.retry_count if info else None,
+        })
+
+    # a task is ready once it's created and all its dependencies have completed
+    ends = {r['task_id']: r['end'] for r in records}
+    for r in records:
+        deps = [ends.get(d) for d in parse_dependencies(r['depends_on'])]
+        r['ready'] = max([r['created']] + [e for e in deps if e is not None]) if r['created'] else None
+        r['queue_wait'] = seconds(r['ready'], r['start'])
+        r['run_time'] = seconds(r['start'], r['end'])
+
+    if job.job_preparation_task is not None:
+        for status in client.job.list_preparation_and_release_task_status(job_id):
+            info = status.job_preparation_task_execution_info
+            if info is None:
+                continue
+            records.append({'job_id': job_id, 'task_id': '{}@{}'.format(JOB_PREPARATION, status.node_id),
+                'stage': JOB_PREPARATION, 'node_id': status.node_id, 'slots': None, 'node_slots': node_slots,
+                'depends_on': '', 'created': None, 'ready': None, 'start': info.start_time, 'end': info.end_time,
+                'queue_wait': None, 'run_time': seconds(info.start_time, info.end_time),
+                'exit_code': info.exit_code, 'retries': info.retry_count})
+
+    for r in records:
+        for column in ('created', 'ready', 'start', 'end'):
+            r[column] = r[column].isoformat() if r[column] is not None else None
+    return records
+
+def calls_path(path):
+    """returns the file name used for service call records saved along with task records in `path`"""
+    name, ext = os.path.splitext(path)
+    return '{}.calls{}'.format(name, ext)
+
+def write_records(path, records, columns):
+    """write records to a Parquet file if `path` ends with `.parquet`, else to a CSV file"""
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('writing Parquet files requires pyarrow (pip install pyarrow)')
+        table = pyarrow.Table.from_pydict({c: [r.get(c) for r in records] for c in columns})
+        pyarrow.parquet.write_table(table, path)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+
+def read_records(path):
+    """read records written by `write_records`"""
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('reading Parquet files requires pyarrow (pip install pyarrow)')
+        return pyarrow.parquet.read_table(path).to_pylist()
+    with open(path, newline='') as f:
+        return [{k: parse_value(k, v) for k, v in r.items()} for r in csv.DictReader(f)]
+
+def parse_value(column, value):
+    """convert a value read from a CSV file to the type of its column"""
+    if value == '':
+        return None
+    if column in ('slots', 'node_slots', 'exit_code', 'retries'):
+        return int(value)
+    if column in ('queue_wait', 'run_time', 'duration'):
+        return float(value)
+    if column == 'success':
+        return value == 'True'
+    return value
+
+def get_telemetry_client(connection):
+    """returns an Application Insights client for a connection string or an instrumentation key"""
+    try:
+        from applicationinsights import TelemetryClient
+    except ImportError:
+        raise RuntimeError('exporting to Application Insights requires applicationinsights (pip install applicationinsights)')
+    settings = dict(item.split('=', 1) for item in connection.split(';') if '=' in item)
+    return TelemetryClient(settings.get('InstrumentationKey', connection))
+
+def export_appinsights(connection, records, calls=()):
+    """send task records as `batch_task` events and service calls as dependencies to Application Insights"""
+    client = get_telemetry_client(connection)
+    for r in records:
+        client.track_event('batch_task',
+            properties={k: str(r[k]) for k in ('job_id', 'task_id', 'stage', 'node_id', 'start', 'end', 'exit_code')},
+            measurements={k: r[k] for k in ('queue_wait', 'run_time', 'slots', 'retries') if r.get(k) is not None})
+    for c in calls:
+        client.track_dependency(c['name'], c['name'], type='Azure Batch',
+            duration=int(c['duration'] * 1000), success=c['success'])
+    client.flush()
+
+def export(job_id, records, path=None, appinsights=None):
+    """save task records and service calls to `path` and/or send them to Application Insights"""
+    calls = get_calls()
+    if path:
+        write_records(path, records, TASK_COLUMNS)
+        write_records(calls_path(path), calls, CALL_COLUMNS)
+        print('{}: saved {} task records to {} and {} service calls to {}'.format(job_id, len(records), path,
+            len(calls), calls_path(path)))
+    if appinsights:
+        export_appinsights(appinsights, records, calls)
+        print('{}: sent {} task records and {} service calls to Application Insights'.format(job_id,
+            len(records), len(calls)))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+def critical_path(records):
+    """returns tasks on the critical path, i.e. following the dependency that completed last
+    back from the task that ended last"""
+    by_id = {r['task_id']: r for r in records if r['end']}
+    if not by_id:
+        return []
+    task = max(by_id.values(), key=lambda r: parse_time(r['end']))
+    path = []
+    while task is not None:
+        path.append(task)
+        deps = [by_id[d] for d in parse_dependencies(task['depends_on']) if d in by_id]
+        task = max(deps, key=lambda r: parse_time(r['end'])) if deps else None
+    return list(reversed(path))
+
+def print_call_summary(calls):
+    if not calls:
+        return
+    by_name = collections.OrderedDict()
+    for c in calls:
+        by_name.setdefault(c['name'], []).append(c)
+    print('Service calls:')
+    print('  {:<40} {:>7} {:>10} {:>10} {:>10} {:>7}'.format('call', 'count', 'total (s)', 'mean (s)', 'max (s)', 'failed'))
+    for name, items in by_name.items():
+        durations = [c['duration'] for c in items]
+        print('  {:<40} {:>7} {:>10.2f} {:>10.3f} {:>10.3f} {:>7}'.format(name, len(items), sum(durations),
+            statistics.mean(durations), max(durations), sum(1 for c in items if not c['success'])))
+
+def print_report(job_id, records, calls=()):
+    """print queue wait vs run time per stage, node utilization, image pull time and the critical path"""
+    tasks = [r for r in records if r['stage'] != JOB_PREPARATION and r['start'] and r['end']]
+    if not tasks:
+        print('{}: no timing information available'.format(job_id))
+        return
+    begin = min(parse_time(r['created'] or r['start']) for r in tasks)
+    end = max(parse_time(r['end']) for r in tasks)
+    span = (end - begin).total_seconds()
+    print("""=============================================
+{job_id}
+=============================================
+Tasks: {count}
+Elapsed: {span:.1f}s""".format(job_id=job_id, count=len(tasks), span=span))
+
+    stages = collections.OrderedDict()
+    for r in tasks:
+        stages.setdefault(r['stage'], []).append(r)
+    print('Queue wait vs run time (median / p95 / max, in seconds):')
+    for stage, items in stages.items():
+        waits = [r['queue_wait'] for r in items if r['queue_wait'] is not None]
+        runs = [r['run_time'] for r in items]
+        print('  {:<20} {:>6} tasks  wait {:7.1f} / {:7.1f} / {:7.1f}  run {:7.1f} / {:7.1f} / {:7.1f}'.format(stage,
+            len(items), percentile(waits, 0.5), percentile(waits, 0.95), max(waits, default=0.0),
+            percentile(runs, 0.5), percentile(runs, 0.95), max(runs)))
+
+    pulls = [r['run_time'] for r in records if r['stage'] == JOB_PREPARATION and r['run_time'] is not None]
+    if pulls:
+        print('Job preparation (image pull) on {} nodes: median {:.1f}s, max {:.1f}s'.format(len(pulls),
+            percentile(pulls, 0.5), max(pulls)))
+
+    nodes = collections.defaultdict(float)
+    for r in tasks:
+        nodes[r['node_id']] += r['run_time'] * (r['slots'] or 1)
+    node_slots = next((r['node_slots'] for r in tasks if r['node_slots']), None)
+    if node_slots and span > 0:
+        utilization = sorted(100 * busy / (span * node_slots) for busy in nodes.values())
+        print('Node utilization on {} nodes x {} slots (min / median / max): {:.0f}% / {:.0f}% / {:.0f}%'.format(
+            len(nodes), node_slots, utilization[0], percentile(utilization, 0.5), utilization[-1]))
+
+    path = critical_path(tasks)
+    print('Critical path ({} tasks):'.format(len(path)))
+    segments = collections.OrderedDict()
+    for r in path:
+        segment = segments.setdefault(r['stage'], collections.Counter())
+        segment['tasks'] += 1
+        segment['wait'] += r['queue_wait'] or 0.0
+        segment['run'] += r['run_time']
+    for stage, segment in segments.items():
+        print('  {:<20} {:>6} tasks  wait {:7.1f}s  run {:7.1f}s'.format(stage, segment['tasks'],
+            segment['wait'], segment['run']))
+    print_call_summary(calls)
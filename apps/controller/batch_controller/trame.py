@@ -1,35 +1,76 @@
-import argparse
-import datetime
-import io
-import time
+import json
 
-from multiprocessing import pool
-from . import utils
+from . import cli
+
+utils = cli.lazy_import('batch_controller.utils')
+standby = cli.lazy_import('batch_controller.trame_standby')
+
+DESCRIPTION = 'trame: web visualization'
 
 def get_parser():
-    parser = argparse.ArgumentParser(description='trame: web visualization')
-    subparsers = parser.add_subparsers(title='command', description='valid commands')
+    return cli.get_app_parser(DESCRIPTION, add_commands)
+
+def add_commands(subparsers):
+    cli.add_pool_parser(subparsers, pool_id='trame-pool')
+
+    standbyParser = subparsers.add_parser('standby', help='keep standby trame servers running so that sessions start in seconds')
+    standbyParser.add_argument('-e', '--batch-endpoint',
+        type=str, help='batch account endpoint [REQUIRED]', required=True)
+    standbyParser.add_argument('-c','--container-registry-name',type=str, help='container registry url [REQUIRED]', required=True)
+    standbyParser.add_argument('-n', '--size', type=int, help='number of unclaimed standby servers to keep (default=2)', default=2)
+    standbyParser.add_argument('--interval', type=float, help='seconds between replenishing standby servers (default=30)', default=30.0)
+    standbyParser.add_argument('--once', action='store_true', help='replenish standby servers once and exit')
+    standbyParser.set_defaults(command_execute=execute_standby)
 
-    poolParser = subparsers.add_parser('pool', help='pool operations')
-    poolParser.add_argument('-e', '--batch-endpoint',
+    sessionParser = subparsers.add_parser('session', help='start a visualization session on a standby trame server')
+    sessionParser.add_argument('-e', '--batch-endpoint',
         type=str, help='batch account endpoint [REQUIRED]', required=True)
-    poolParser.add_argument('-i', '--info', action='store_true', help='print pool information')
-    poolParser.add_argument('-r','--resize', type=int, help='resize pool', metavar='SIZE', default=-1)
-    poolParser.set_defaults(command_execute=execute_pool)
+    sessionParser.add_argument('-c','--container-registry-name',type=str, help='container registry url [REQUIRED]', required=True)
+    sessionParser.add_argument('-d', '--dataset', type=str, action='append', required=True, metavar='CONTAINER/NAME',
+        help='dataset to load, may be repeated [REQUIRED]')
+    sessionParser.add_argument('--crop', action='store_true', help='show the crop view')
+    sessionParser.add_argument('--link-views', action='store_true', help='link interactions across views')
+    sessionParser.add_argument('--no-wait', action='store_true', help='do not wait for the server to be ready')
+    sessionParser.set_defaults(command_execute=execute_session)
 
-    return parser
+    datasetsParser = subparsers.add_parser('datasets', help='list datasets in the storage account')
+    datasetsParser.add_argument('-s', '--blob-storage-endpoint', type=str, help='blob storage account endpoint [REQUIRED]', required=True)
+    datasetsParser.add_argument('--index', type=str, help='cache the index in this file (default=.trame-datasets.json)',
+        default='.trame-datasets.json')
+    datasetsParser.add_argument('--max-age', type=float, help='seconds after which a container is listed again (default=300)', default=300)
+    datasetsParser.add_argument('--refresh', action='store_true', help='list all containers again')
+    datasetsParser.set_defaults(command_execute=execute_datasets)
 
-def execute_pool(args)->None:
-    if args.resize >= 0:
-        utils.pool_resize(endpoint=args.batch_endpoint, pool_id='trame-pool', targetSize=args.resize)
+def execute_standby(args)->None:
+    image = standby.container_image(args.container_registry_name)
+    if args.once:
+        changed = standby.replenish(utils.login(args.batch_endpoint), image, args.size)
+        print('{}: {:+d} standby servers'.format(standby.JOB_ID, changed))
     else:
-        utils.print_pool_info(endpoint=args.batch_endpoint, pool_id='trame-pool')
+        standby.maintain(args.batch_endpoint, image, args.size, interval=args.interval)
 
-def execute(args)->None:
-    if hasattr(args, 'command_execute'):
-        args.command_execute(args)
-    else:
-        print('missing required command')
+def execute_session(args)->None:
+    client = utils.login(args.batch_endpoint)
+    datasets = [d.split('/', 1) for d in args.dataset]
+    if any(len(d) != 2 for d in datasets):
+        raise RuntimeError('datasets must be specified as CONTAINER/NAME')
+    session = standby.claim_server(client, standby.container_image(args.container_registry_name),
+        standby.session_command_line(datasets, crop=args.crop, link_views=args.link_views))
+    if session is None:
+        raise RuntimeError('no standby server is running; use the standby command to start some')
+    standby.confirm_node(client, session)
+    if not args.no_wait:
+        session['host'] = standby.wait_for_server(client, session['job_id'], session['task_id'])
+    print(json.dumps(session, indent=2))
+
+def execute_datasets(args)->None:
+    from .dataset_index import DatasetIndex
+    index = DatasetIndex(args.blob_storage_endpoint, path=args.index, max_age=args.max_age)
+    index.refresh(force=args.refresh)
+    for d in index.datasets():
+        print('{}/{}'.format(d['container'], d['name']))
+
+execute = cli.execute
 
 if __name__ == '__main__':
     parser = get_parser()
@@ -0,0 +1,196 @@
+"""Standby trame servers that are handed out to visualization sessions.
+
+Starting a session on its own job waits for the task to be scheduled and, if the pool has
+no free node, for a node to be allocated and the container image to be pulled, which takes
+minutes. Instead, `replenish` keeps a number of standby tasks running in a long-lived job:
+each one holds a task slot and a host port on a node that has already pulled the image.
+`claim_server` terminates a standby task and starts the session's trame server in its place,
+on the same node and port, so the session only waits for the container to start. Node
+affinity is only a preference, though: the session may be scheduled on another node, in which
+case `confirm_node` reports the node it actually runs on.
+
+vizer (the trame application) reads its datasets from the command line, so a standby task
+can't become a session itself; standby tasks simply sleep. Claims are made with the standby
+task's ETag, so concurrent claims (e.g. from the web server, see
+`apps/trame/webserver/utils.cjs`) never hand out the same task twice.
+"""
+import random
+import time
+
+from azure.batch import models
+from azure.batch.models import BatchErrorException
+
+from . import utils
+
+POOL_ID = 'trame-pool'
+
+# job holding standby tasks and the sessions that claimed them
+JOB_ID = 'trame-standby'
+
+STANDBY_PREFIX = 'standby'
+SESSION_PREFIX = 'session'
+
+# host ports used by standby tasks (and the sessions that replace them); sessions started
+# without a standby task use ports in [8000, 9000)
+PORTS_RANGE = (9000, 10000)
+
+# the trame server listens on this port in the container
+CONTAINER_PORT = 8080
+
+# file created by vizer once the server accepts connections
+SERVER_READY_FILE = 'server-ready.txt'
+
+def container_image(container_registry_name):
+    return '{}.azurecr.io/vizer/vizer:latest'.format(container_registry_name)
+
+def task_port(task_id):
+    """returns the host port of a standby or session task from its id"""
+    return int(task_id.split('-')[1])
+
+def is_standby(task_id):
+    return task_id.startswith(STANDBY_PREFIX + '-')
+
+def ensure_job(client):
+    """create the job for standby tasks unless it exists"""
+    try:
+        client.job.add(models.JobAddParameter(id=JOB_ID, display_name='trame standby servers',
+            pool_info=models.PoolInformation(pool_id=POOL_ID)))
+    except BatchErrorException as e:
+        if e.error.code != 'JobExists':
+            raise
+    job = client.job.get(JOB_ID, job_get_options=models.JobGetOptions(select='id,state'))
+    if job.state != models.JobState.active:
+        raise RuntimeError('job {} is {}; delete it to start over'.format(JOB_ID, job.state))
+
+def list_servers(client):
+    """returns standby and session tasks that haven't completed"""
+    options = models.TaskListOptions(filter="state ne 'completed'", select='id,state,eTag,nodeInfo')
+    return list(client.task.list(JOB_ID, task_list_options=options))
+
+def free_port(used):
+    ports = [p for p in range(*PORTS_RANGE) if p not in used]
+    if not ports:
+        raise RuntimeError('no free port in {}-{}'.format(*PORTS_RANGE))
+    return ports[0]
+
+def standby_task(image, port):
+    """a task that holds a task slot and a host port till it's claimed"""
+    user, settings = utils.task_settings(image, '-p {}:{} --entrypoint /bin/sh'.format(port, CONTAINER_PORT), True)
+    # task ids can't be reused in a job, even after the task completed
+    return models.TaskAddParameter(id='{}-{}-{}'.format(STANDBY_PREFIX, port, utils.unique_id()),
+        display_name='standby trame server on {}'.format(port),
+        command_line="-c 'sleep infinity'",
+        user_identity=user, container_settings=settings)
+
+def replenish(client, image, size):
+    """add or terminate standby tasks so that `size` of them are unclaimed; returns the
+    number of tasks added (negative if tasks were terminated)"""
+    ensure_job(client)
+    tasks = list_servers(client)
+    used = set(task_port(t.id) for t in tasks)
+    standby = [t for t in tasks if is_standby(t.id)]
+    if len(standby) > size:
+        # terminate those that haven't started first
+        extra = sorted(standby, key=lambda t: t.state == models.TaskState.running)[:len(standby) - size]
+        for t in extra:
+            client.task.terminate(JOB_ID, t.id)
+        return -len(extra)
+
+    added = []
+    for _ in range(size - len(standby)):
+        port = free_port(used)
+        used.add(port)
+        added.append(standby_task(image, port))
+    for chunk in utils.chunks(added):
+        client.task.add_collection(JOB_ID, chunk)
+    return len(added)
+
+def session_command_line(datasets, crop=False, link_views=False):
+    """returns the vizer command line for `datasets`, a list of `(container, blob name)`"""
+    cmd = ['--create-on-server-ready', '{AZ_BATCH_TASK_WORKING_DIR}/' + SERVER_READY_FILE]
+    for container, name in datasets:
+        cmd += ['--dataset', '{{AZ_BATCH_NODE_MOUNTS_DIR}}/{}/{}'.format(container, name)]
+    if crop:
+        cmd += ['--force-view', 'crop']
+    if link_views:
+        cmd.append('--link-views')
+    return ' '.join(cmd)
+
+def claim_server(client, image, command_line):
+    """hand out a running standby task: it's terminated and a session running `command_line`
+    is started on the same node and port. Returns a dict with `job_id`, `task_id`, `port`,
+    `pool_id` and `node_id`, or None if no standby task is running."""
+    standby = [t for t in list_servers(client) if is_standby(t.id) and t.state == models.TaskState.running]
+    # spread concurrent claims across standby tasks
+    random.shuffle(standby)
+    for t in standby:
+        try:
+            client.task.terminate(JOB_ID, t.id, task_terminate_options=models.TaskTerminateOptions(if_match=t.e_tag))
+        except BatchErrorException as e:
+            if e.error.code in ('ConditionNotMet', 'TaskCompleted'):
+                # claimed by someone else
+                continue
+            raise
+        port = task_port(t.id)
+        user, settings = utils.task_settings(image, '-p {}:{}'.format(port, CONTAINER_PORT), True)
+        task_id = '{}-{}-{}'.format(SESSION_PREFIX, port, utils.unique_id())
+        client.task.add(JOB_ID, models.TaskAddParameter(id=task_id,
+            display_name='trame session on {}'.format(port),
+            command_line=command_line, user_identity=user, container_settings=settings,
+            affinity_info=models.AffinityInformation(affinity_id=t.node_info.affinity_id)))
+        return {
+            'job_id': JOB_ID,
+            'task_id': task_id,
+            'port': port,
+            'pool_id': t.node_info.pool_id,
+            'node_id': t.node_info.node_id,
+        }
+    return None
+
+def confirm_node(client, session, timeout=120, interval=1.0):
+    """wait till the session's task is scheduled and update `node_id` in `session` to the node
+    it runs on, which may differ from the claimed standby task's node since affinity is only a
+    preference; sets `moved` in `session` if it does. The port stays valid on any node: ports
+    are unique across the tasks of the standby job."""
+    deadline = time.time() + timeout
+    options = models.TaskGetOptions(select='id,state,nodeInfo')
+    while True:
+        task = client.task.get(session['job_id'], session['task_id'], task_get_options=options)
+        if task.state != models.TaskState.active and task.node_info is not None:
+            break
+        if time.time() >= deadline:
+            raise RuntimeError('timed out waiting for {} to be scheduled'.format(session['task_id']))
+        time.sleep(interval)
+    session['moved'] = task.node_info.node_id != session['node_id']
+    if session['moved']:
+        print('{}: scheduled on {} instead of the standby node {}'.format(session['task_id'],
+            task.node_info.node_id, session['node_id']))
+    session.update(pool_id=task.node_info.pool_id, node_id=task.node_info.node_id)
+    return session
+
+def wait_for_server(client, job_id, task_id, timeout=600, interval=2.0):
+    """wait till the trame server of a session accepts connections; returns the address of
+    the node it runs on"""
+    deadline = time.time() + timeout
+    options = models.FileListFromTaskOptions(filter="startswith(name, 'wd/{}')".format(SERVER_READY_FILE))
+    while time.time() < deadline:
+        task = client.task.get(job_id, task_id)
+        if task.state == models.TaskState.completed:
+            raise RuntimeError('task {} completed before the server was ready'.format(task_id))
+        if task.state == models.TaskState.running and \
+            list(client.file.list_from_task(job_id, task_id, recursive=True, file_list_from_task_options=options)):
+            return client.compute_node.get(task.node_info.pool_id, task.node_info.node_id).ip_address
+        time.sleep(interval)
+    raise RuntimeError('timed out waiting for the server of {}'.format(task_id))
+
+def maintain(endpoint, image, size, interval=30.0):
+    """replenish standby tasks every `interval` seconds till interrupted"""
+    client = utils.login(endpoint)
+    while True:
+        changed = replenish(client, image, size)
+        tasks = list_servers(client)
+        standby = [t for t in tasks if is_standby(t.id)]
+        print('{}: {} standby ({} running), {} sessions{}'.format(time.strftime('%H:%M:%S'), len(standby),
+            sum(1 for t in standby if t.state == models.TaskState.running), len(tasks) - len(standby),
+            ', {:+d} standby'.format(changed) if changed else ''))
+        time.sleep(interval)
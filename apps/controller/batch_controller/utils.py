@@ -1,23 +1,183 @@
+import datetime
+import functools
+import itertools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 from azure.batch import BatchServiceClient, models
+from azure.batch.models import BatchErrorException
 from azure.identity import DefaultAzureCredential
 
-from . import azure_identity_credential_adapter
+from . import azure_identity_credential_adapter, telemetry
+
+# Batch service accepts at most 100 tasks per `add_collection` call
+MAX_TASKS_PER_REQUEST = 100
+
+# default number of concurrent `add_collection` requests
+MAX_SUBMIT_WORKERS = 8
+
+# number of times tasks that failed with a server error are resubmitted
+MAX_SUBMIT_RETRIES = 3
+
+
+# authenticated clients, keyed by batch account endpoint, shared by all
+# helpers in this process
+_clients = {}
+_clients_lock = threading.Lock()
+_credential = None
+_backend = None
 
+def get_credential():
+    """returns the credential shared by all clients in this process"""
+    global _credential
+    with _clients_lock:
+        if _credential is None:
+            _credential = DefaultAzureCredential()
+        return _credential
+
+def set_backend(factory=None):
+    """use `factory(endpoint)` to create clients instead of connecting to the Batch service,
+    e.g. to use `fake_batch.FakeBatchService`; pass None to restore the default"""
+    global _backend
+    logout()
+    _backend = factory
 
 def login(endpoint):
-    credentials = DefaultAzureCredential()
-    wrapper = azure_identity_credential_adapter.AzureIdentityCredentialAdapter(credentials, resource_id='https://batch.core.windows.net/')
-    batch_client = BatchServiceClient(wrapper, batch_url="https://{}".format(endpoint))
-    return batch_client
+    """returns an authenticated client for the endpoint, reusing an existing one if possible;
+    calls made using the client are timed (see `telemetry`)"""
+    if _backend is not None:
+        with _clients_lock:
+            if endpoint not in _clients:
+                _clients[endpoint] = telemetry.instrument(_backend(endpoint))
+            return _clients[endpoint]
+
+    credential = get_credential()
+    with _clients_lock:
+        if endpoint not in _clients:
+            with telemetry.timer('login'):
+                wrapper = azure_identity_credential_adapter.AzureIdentityCredentialAdapter(credential, resource_id='https://batch.core.windows.net/')
+                batch_client = BatchServiceClient(wrapper, batch_url="https://{}".format(endpoint))
+                # keep the HTTP session (and its connection pool) alive across requests
+                batch_client.config.keep_alive = True
+                _clients[endpoint] = telemetry.instrument(batch_client)
+        return _clients[endpoint]
+
+def logout(endpoint=None):
+    """close and forget cached clients, for the endpoint if specified, else all of them"""
+    with _clients_lock:
+        endpoints = [endpoint] if endpoint is not None else list(_clients.keys())
+        for e in endpoints:
+            client = _clients.pop(e, None)
+            if client is not None:
+                client.close()
 
 def unique_id():
-    import time
-    return time.strftime("%Y%m%d-%H%M%S")
+    """returns an id for jobs, tasks and work directories that sorts by creation time; the
+    random suffix keeps ids created in the same second (e.g. by concurrent submissions) distinct"""
+    return "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+
+def cost_capped_targets(dedicated, spot, max_cost=None, dedicated_price=None, spot_price=None):
+    """returns `(dedicated, spot)` node counts that cost at most `max_cost` per hour, given the
+    price per node-hour of dedicated and spot nodes; dedicated nodes are kept first since
+    spot nodes may be preempted"""
+    if max_cost is None:
+        return dedicated, spot
+    if dedicated_price is None or spot_price is None:
+        raise RuntimeError('dedicated and spot node prices are required for a cost cap')
+    # the small margin keeps e.g. 3.0 / 0.1 from rounding down to 29
+    dedicated = min(dedicated, int(max_cost / dedicated_price + 1e-9)) if dedicated_price > 0 else dedicated
+    budget = max_cost - dedicated * dedicated_price
+    spot = min(spot, int(budget / spot_price + 1e-9)) if spot_price > 0 else spot
+    return dedicated, spot
+
+def pool_resize(endpoint, pool_id, targetSize=None, targetSpotSize=None, max_cost=None, dedicated_price=None, spot_price=None):
+    """Resize a pool to `targetSize` dedicated and `targetSpotSize` spot nodes, keeping the
+    current target for either if not specified, and within `max_cost` per hour if specified
+    (see `cost_capped_targets`)"""
+    client = login(endpoint)
+    info = client.pool.get(pool_id=pool_id, pool_get_options=models.PoolGetOptions(
+        select='id,enableAutoScale,targetDedicatedNodes,targetLowPriorityNodes'))
+    dedicated = targetSize if targetSize is not None else (info.target_dedicated_nodes or 0)
+    spot = targetSpotSize if targetSpotSize is not None else (info.target_low_priority_nodes or 0)
+    capped = cost_capped_targets(dedicated, spot, max_cost, dedicated_price, spot_price)
+    if capped != (dedicated, spot):
+        print('{}: capped at {} dedicated and {} spot nodes to cost at most {} per hour'.format(pool_id, *capped, max_cost))
+    if info.enable_auto_scale:
+        # a pool can only be resized manually once autoscale is disabled
+        client.pool.disable_auto_scale(pool_id)
+    client.pool.resize(pool_id, models.PoolResizeParameter(target_dedicated_nodes=capped[0],
+        target_low_priority_nodes=capped[1]))
 
-def pool_resize(endpoint, pool_id, targetSize):
-    """Resize a pool"""
+def get_pool_capacity(endpoint, pool_id):
+    """returns a tuple `(nodes, task slots per node)` for a pool where nodes is the
+    current target size of the pool (dedicated and spot)"""
     client = login(endpoint)
-    client.pool.resize(pool_id, models.PoolResizeParameter(target_dedicated_nodes=targetSize))
+    info = client.pool.get(pool_id=pool_id, pool_get_options=models.PoolGetOptions(
+        select='id,targetDedicatedNodes,targetLowPriorityNodes,taskSlotsPerNode'))
+    return ((info.target_dedicated_nodes or 0) + (info.target_low_priority_nodes or 0),
+        info.task_slots_per_node or 1)
+
+def autoscale_formula(max_dedicated, max_spot=0, dedicated_ratio=1.0, sample_minutes=5,
+                      max_cost=None, dedicated_price=None, spot_price=None, slots_per_task=1):
+    """returns an autoscale formula that sizes the pool to the backlog of tasks.
+
+    The pool is sized to fit all pending tasks (`$PendingTasks` counts both `$ActiveTasks` and
+    running tasks), using the larger of the latest sample and the average over the last
+    `sample_minutes`, and `slots_per_task` task slots per task (`$PendingTasks` counts tasks, not
+    slots). `dedicated_ratio` of the nodes needed are dedicated nodes (up to `max_dedicated`)
+    and the remainder spot nodes (up to `max_spot`). Nodes are only removed once their running
+    tasks complete. With `max_cost`, the targets are also capped so that the nodes cost at most
+    that much per hour (see `cost_capped_targets`)."""
+    assert 0.0 <= dedicated_ratio <= 1.0, 'dedicated ratio must be between 0 and 1'
+    # the cost cap bounds the maximum node counts and the spot nodes that fit in the budget
+    # left after the dedicated ones
+    max_dedicated, max_spot = cost_capped_targets(max_dedicated, max_spot, max_cost, dedicated_price, spot_price)
+    spot_budget = '' if max_cost is None or not spot_price else \
+        ', floor(({} - $dedicated * {}) / {})'.format(max_cost, dedicated_price, spot_price)
+    return """$samples = $PendingTasks.GetSamplePercent(TimeInterval_Minute * {sample_minutes});
+$pending = $samples < 70 ? max(0, $PendingTasks.GetSample(1)) : max($PendingTasks.GetSample(1), avg($PendingTasks.GetSample(TimeInterval_Minute * {sample_minutes})));
+$nodes = ceil($pending * {slots_per_task} / $TaskSlotsPerNode);
+$dedicated = min({max_dedicated}, ceil($nodes * {dedicated_ratio}));
+$TargetDedicatedNodes = $dedicated;
+$TargetLowPriorityNodes = min({max_spot}, max(0, $nodes - $dedicated){spot_budget});
+$NodeDeallocationOption = taskcompletion;""".format(max_dedicated=max_dedicated,
+        max_spot=max_spot, dedicated_ratio=dedicated_ratio, sample_minutes=sample_minutes, spot_budget=spot_budget,
+        slots_per_task=slots_per_task)
+
+def pool_enable_autoscale(endpoint, pool_id, formula, interval_minutes=5):
+    """Enable autoscale on a pool using the formula"""
+    client = login(endpoint)
+    client.pool.enable_auto_scale(pool_id, auto_scale_formula=formula,
+        auto_scale_evaluation_interval=datetime.timedelta(minutes=interval_minutes))
+
+def pool_disable_autoscale(endpoint, pool_id):
+    """Disable autoscale on a pool"""
+    client = login(endpoint)
+    client.pool.disable_auto_scale(pool_id)
+
+def pool_evaluate_autoscale(endpoint, pool_id, formula):
+    """Evaluate the formula against the current state of the pool (autoscale must be enabled
+    on the pool) and print the computed values"""
+    client = login(endpoint)
+    try:
+        run = client.pool.evaluate_auto_scale(pool_id, auto_scale_formula=formula)
+    except BatchErrorException as e:
+        if e.error.code == 'AutoScalingNotEnabled':
+            raise RuntimeError('autoscale is not enabled on {}; the formula can only be evaluated on an autoscaling pool'.format(pool_id))
+        raise
+    print_autoscale_run(pool_id, run)
+    return run
+
+def print_autoscale_run(pool_id, run):
+    """Print results of an autoscale evaluation"""
+    print('{} autoscale evaluation:'.format(pool_id))
+    if run.error:
+        print('  error: {} ({})'.format(run.error.message, run.error.code))
+    for result in (run.results or '').split(';'):
+        if result:
+            print('  {}'.format(result))
 
 def print_pool_info(endpoint, pool_id):
     """Print information about a pool"""
@@ -27,85 +187,450 @@ def print_pool_info(endpoint, pool_id):
 {id} (display name: '{display_name}')
 =============================================
 State: {state} (allocation state: {allocation_state})
-Current Dedicated Size: {size}
-Current Spot Size: {spot_size}
-""".format(id=info.id, 
+Current Dedicated Size: {size} (target: {target_size})
+Current Spot Size: {spot_size} (target: {target_spot_size})
+Autoscale: {autoscale}
+""".format(id=info.id, autoscale='enabled' if info.enable_auto_scale else 'disabled',
     display_name=info.display_name if info.display_name else '<n/a>',
     state=info.state, size=info.current_dedicated_nodes,
     spot_size=info.current_low_priority_nodes,
+    target_size=info.target_dedicated_nodes, target_spot_size=info.target_low_priority_nodes,
     allocation_state=info.allocation_state))
 
 def submit_job(endpoint, pool_id, num_tasks, task_command_lines, task_container_image=None,
     container_run_options=None, job_id_prefix='job',
-    elevatedUser=False):
-    """submit a new job"""
-    client = login(endpoint)
-    job_id = "{}-{}".format(job_id_prefix, unique_id())
-
-    pool_info=models.PoolInformation(pool_id=pool_id)
-    client.job.add(models.JobAddParameter(id=job_id, pool_info=pool_info))
+    elevatedUser=False, required_slots=None, job_preparation_task=None,
+    max_task_retries=None, max_wall_clock=None, num_instances=None, coordination_command_line=None,
+    on_all_tasks_complete='terminateJob'):
+    """submit a new job; `num_instances` runs each task on that many nodes (see
+    `multi_instance_settings`)"""
+    from .controller import BatchController, run
 
-    user = models.UserIdentity(\
-        auto_user=models.AutoUserSpecification(scope='pool',
-            elevation_level='admin')) if elevatedUser else None
-
-    task_container_settings = models.TaskContainerSettings(image_name=task_container_image,
-        container_run_options=container_run_options) if task_container_image else None
-    tasks = [models.TaskAddParameter(id="task_{}".format(index),
+    user, task_container_settings = task_settings(task_container_image, container_run_options, elevatedUser)
+    constraints = task_constraints(max_task_retries, max_wall_clock)
+    mi_settings = multi_instance_settings(num_instances, coordination_command_line)
+    tasks = (models.TaskAddParameter(id="task_{}".format(index),
                 command_line=cmd,
                 user_identity=user,
-                container_settings=task_container_settings) for index, cmd in enumerate(task_command_lines)]
-    res = client.task.add_collection(job_id, tasks)
-    # print(res)
+                container_settings=task_container_settings,
+                constraints=constraints,
+                multi_instance_settings=mi_settings,
+                required_slots=required_slots) for index, cmd in enumerate(task_command_lines))
+    return run(BatchController(endpoint).submit_job(pool_id, tasks, job_id_prefix=job_id_prefix,
+        job_preparation_task=job_preparation_task, on_all_tasks_complete=on_all_tasks_complete))
 
-    # once tasks are added to job, update the job to terminate the job
-    # once all tasks complete
-    client.job.update(job_id=job_id,
-        job_update_parameter=models.JobUpdateParameter(on_all_tasks_complete='terminateJob',
-        pool_info=pool_info))
+def submit_workflow(endpoint, pool_id, tasks,
+                    job_id_prefix='workflow', job_preparation_task=None, on_all_tasks_complete='terminateJob'):
+    """submit a new workflow; `tasks` may be any iterable of tasks, e.g. `TaskGroup`s
+    chained using `itertools.chain`, and is consumed one submission chunk at a time"""
+    from .controller import BatchController, run
 
-    return {
-        'job_id': job_id,
-        'task_ids': ['task_{}'.format(index) for index in range(num_tasks)],
-        'pool_id': pool_id,
-    }
+    return run(BatchController(endpoint).submit_job(pool_id, tasks, job_id_prefix=job_id_prefix,
+        uses_task_dependencies=True, job_preparation_task=job_preparation_task,
+        on_all_tasks_complete=on_all_tasks_complete))
+
+def warmup_container_settings(task_container_image, container_run_options=None):
+    """container settings for a task that only pulls the image and checks that a
+    container can be started from it"""
+    options = '--entrypoint true'
+    if container_run_options:
+        options = '{} {}'.format(container_run_options, options)
+    return models.TaskContainerSettings(image_name=task_container_image, container_run_options=options)
+
+def create_job_preparation_task(task_container_image, container_run_options=None):
+    """create a job preparation task that pulls and verifies the container image once
+    on each node before any of the job's tasks run on that node"""
+    return models.JobPreparationTask(id='warmup',
+        command_line='warmup',
+        container_settings=warmup_container_settings(task_container_image, container_run_options),
+        wait_for_success=True,
+        rerun_on_node_reboot_after_success=False)
 
-def submit_workflow(endpoint, pool_id, tasks: list,
-                    job_id_prefix='workflow'):
-    """submit a new workflow"""
+def pool_warm(endpoint, pool_id, task_container_image, container_run_options=None, job_id_prefix='warmup'):
+    """warm nodes in a pool by pulling the container image on each of them; submits a job
+    with one task per node, each with affinity to its node"""
     client = login(endpoint)
-    job_id = "{}-{}".format(job_id_prefix, unique_id())
+    nodes = list(client.compute_node.list(pool_id, compute_node_list_options=models.ComputeNodeListOptions(
+        select='id,affinityId,state')))
+    if not nodes:
+        print('{}: no nodes to warm'.format(pool_id))
+        return None
 
-    pool_info=models.PoolInformation(pool_id=pool_id)
-    client.job.add(models.JobAddParameter(id=job_id, pool_info=pool_info, uses_task_dependencies=True))
+    job_id = "{}-{}".format(job_id_prefix, unique_id())
+    pool_info = models.PoolInformation(pool_id=pool_id)
+    client.job.add(models.JobAddParameter(id=job_id, pool_info=pool_info,
+        job_preparation_task=create_job_preparation_task(task_container_image, container_run_options)))
 
-    res = client.task.add_collection(job_id, tasks)
+    settings = warmup_container_settings(task_container_image, container_run_options)
+    tasks = (models.TaskAddParameter(id='warmup_{}'.format(index),
+                command_line='warmup',
+                container_settings=settings,
+                affinity_info=models.AffinityInformation(affinity_id=node.affinity_id)) for index, node in enumerate(nodes))
+    stats = add_tasks(client, job_id, tasks)
+    print_submit_stats(job_id, stats)
 
-    # once tasks are added to job, update the job to terminate the job
-    # once all tasks complete
     client.job.update(job_id=job_id,
         job_update_parameter=models.JobUpdateParameter(on_all_tasks_complete='terminateJob',
         pool_info=pool_info))
 
     return {
         'job_id': job_id,
+        'task_ids': stats['task_ids'],
         'pool_id': pool_id,
     }
 
-def create_tasks(task_command_lines,
-                 task_id_prefix='task',
-                 task_container_image=None, container_run_options=None, elevatedUser=False,
-                 get_dependencies=None):
-    """create a list of tasks"""
+@functools.lru_cache(maxsize=None)
+def task_settings(task_container_image=None, container_run_options=None, elevatedUser=False):
+    """returns `(user_identity, container_settings)` for tasks; the models are interned so
+    that all tasks with the same settings share a single instance"""
     user = models.UserIdentity(\
         auto_user=models.AutoUserSpecification(scope='pool',
             elevation_level='admin')) if elevatedUser else None
     task_container_settings = models.TaskContainerSettings(image_name=task_container_image,
         container_run_options=container_run_options) if task_container_image else None
+    return user, task_container_settings
+
+@functools.lru_cache(maxsize=None)
+def task_constraints(max_task_retries=None, max_wall_clock=None):
+    """returns interned `TaskConstraints`; `max_task_retries` is the number of times a task
+    that exits with a non-zero exit code is retried and `max_wall_clock` (a `timedelta`) the
+    maximum time a task may run, including retries, before it's terminated"""
+    if max_task_retries is None and max_wall_clock is None:
+        return None
+    return models.TaskConstraints(max_task_retry_count=max_task_retries, max_wall_clock_time=max_wall_clock)
+
+@functools.lru_cache(maxsize=None)
+def multi_instance_settings(num_instances=None, coordination_command_line=None):
+    """returns interned `MultiInstanceSettings` to run each task on `num_instances` nodes, e.g.
+    for MPI applications. `coordination_command_line`, if specified, runs on all the nodes
+    (e.g. to start daemons used by the MPI launcher) before the task's command line runs on
+    the primary node. The pool must have inter-node communication enabled."""
+    if num_instances is None:
+        return None
+    return models.MultiInstanceSettings(number_of_instances=num_instances,
+        coordination_command_line=coordination_command_line)
+
+def task_add_parameter(task, **kwargs):
+    """returns a `TaskAddParameter` to add a copy of a `CloudTask`; `kwargs` override its properties"""
+    properties = {name: getattr(task, name, None) for name in ('id', 'display_name', 'command_line',
+        'container_settings', 'exit_conditions', 'resource_files', 'output_files', 'environment_settings',
+        'affinity_info', 'constraints', 'required_slots', 'user_identity', 'multi_instance_settings',
+        'depends_on', 'application_package_references', 'authentication_token_settings')}
+    properties.update(kwargs)
+    return models.TaskAddParameter(**properties)
 
-    return [models.TaskAddParameter(id="{}_{}".format(task_id_prefix, index),
-            command_line=cmd,
-            user_identity=user,
-            container_settings=task_container_settings,
-            depends_on=models.TaskDependencies(task_ids=get_dependencies(index)) if get_dependencies else None) \
-                for index, cmd in enumerate(task_command_lines)]
+class TaskGroup:
+    """compact description of a group of similar tasks.
+
+    `task_command_lines` is either a sequence of command lines or a function returning
+    the command line for a task index, in which case `count` is the number of tasks and
+    nothing is stored per task. Task ids are derived from the index of
+    the task, either as `{task_id_prefix}_{index}` or, if `id_offset` is specified, as the
+    integer `id_offset + index` so that other tasks can depend on the whole group using a
+    single task id range. Settings are shared by all tasks in the group and
+    `TaskAddParameter`s are only created while iterating, i.e. one submission chunk at a
+    time.
+
+    `get_dependencies(index)` returns a list of task ids or a `TaskDependencies`.
+    `max_task_retries` and `max_wall_clock` set the retry policy (see `task_constraints`) and
+    `num_instances` and `coordination_command_line` make each task a multi-instance task (see
+    `multi_instance_settings`)."""
+
+    def __init__(self, task_command_lines, task_id_prefix='task',
+                 task_container_image=None, container_run_options=None, elevatedUser=False,
+                 get_dependencies=None, required_slots=None, id_offset=None, count=None,
+                 max_task_retries=None, max_wall_clock=None,
+                 num_instances=None, coordination_command_line=None):
+        if callable(task_command_lines):
+            assert count is not None, 'count is required when command lines are generated'
+            self.command_line = task_command_lines
+            self.count = count
+        else:
+            command_lines = list(task_command_lines)
+            self.command_line = command_lines.__getitem__
+            self.count = len(command_lines)
+        self.task_id_prefix = task_id_prefix
+        self.user, self.container_settings = task_settings(task_container_image, container_run_options, elevatedUser)
+        self.constraints = task_constraints(max_task_retries, max_wall_clock)
+        self.multi_instance_settings = multi_instance_settings(num_instances, coordination_command_line)
+        self.get_dependencies = get_dependencies
+        self.required_slots = required_slots
+        self.id_offset = id_offset
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.task(index) for index in range(len(self)))
+
+    def task_id(self, index):
+        if index < 0:
+            index += len(self)
+        if self.id_offset is not None:
+            return str(self.id_offset + index)
+        return "{}_{}".format(self.task_id_prefix, index)
+
+    def task_ids(self, start=0, stop=None):
+        """returns ids of tasks in `[start, stop)`"""
+        return [self.task_id(index) for index in range(*slice(start, stop).indices(len(self)))]
+
+    def depends_on_all(self):
+        """returns `TaskDependencies` on all tasks in the group"""
+        if self.id_offset is not None and len(self) > 0:
+            return models.TaskDependencies(task_id_ranges=[
+                models.TaskIdRange(start=self.id_offset, end=self.id_offset + len(self) - 1)])
+        return models.TaskDependencies(task_ids=self.task_ids())
+
+    def task(self, index):
+        """create the `TaskAddParameter` for a task"""
+        depends_on = self.get_dependencies(index) if self.get_dependencies else None
+        if depends_on is not None and not isinstance(depends_on, models.TaskDependencies):
+            depends_on = models.TaskDependencies(task_ids=depends_on)
+        return models.TaskAddParameter(id=self.task_id(index),
+            command_line=self.command_line(index),
+            user_identity=self.user,
+            container_settings=self.container_settings,
+            constraints=self.constraints,
+            required_slots=self.required_slots,
+            multi_instance_settings=self.multi_instance_settings,
+            depends_on=depends_on)
+
+def create_tasks(task_command_lines,
+                 task_id_prefix='task',
+                 task_container_image=None, container_run_options=None, elevatedUser=False,
+                 get_dependencies=None, required_slots=None, id_offset=None, count=None,
+                 max_task_retries=None, max_wall_clock=None,
+                 num_instances=None, coordination_command_line=None):
+    """create a group of tasks; see `TaskGroup`"""
+    return TaskGroup(task_command_lines, task_id_prefix=task_id_prefix,
+        task_container_image=task_container_image, container_run_options=container_run_options,
+        elevatedUser=elevatedUser, get_dependencies=get_dependencies,
+        required_slots=required_slots, id_offset=id_offset, count=count,
+        max_task_retries=max_task_retries, max_wall_clock=max_wall_clock,
+        num_instances=num_instances, coordination_command_line=coordination_command_line)
+
+def chunks(iterable, size=MAX_TASKS_PER_REQUEST):
+    """yield lists of at most `size` items from `iterable` without materializing it"""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _add_chunk(client, job_id, tasks, max_retries):
+    """add a chunk of tasks, resubmitting only the tasks that failed with server errors;
+    returns a tuple `(added task ids, failed task add results, number of requests)`"""
+    added, failed, requests = [], [], 0
+    pending = tasks
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        try:
+            requests += 1
+            res = client.task.add_collection(job_id, pending)
+        except BatchErrorException as e:
+            if e.error.code == 'RequestBodyTooLarge' and len(pending) > 1:
+                # too many bytes in the request, retry as two halves
+                half = len(pending) // 2
+                for part in (pending[:half], pending[half:]):
+                    a, f, r = _add_chunk(client, job_id, part, max_retries - attempt)
+                    added += a
+                    failed += f
+                    requests += r
+                return added, failed, requests
+            raise
+
+        by_id = {t.id: t for t in pending}
+        pending = []
+        for result in res.value:
+            if result.status == models.TaskAddStatus.success:
+                added.append(result.task_id)
+            elif result.status == models.TaskAddStatus.server_error and attempt < max_retries:
+                pending.append(by_id[result.task_id])
+            else:
+                failed.append(result)
+    return added, failed, requests
+
+def add_tasks(client, job_id, tasks, chunk_size=MAX_TASKS_PER_REQUEST,
+              max_workers=MAX_SUBMIT_WORKERS, max_retries=MAX_SUBMIT_RETRIES):
+    """add tasks to a job in chunks of `chunk_size` using a bounded pool of
+    `max_workers` threads.
+
+    `tasks` can be any iterable (including a generator); only about `2 * max_workers`
+    chunks are held in memory at any time. Returns a dict with submission statistics."""
+    start = time.perf_counter()
+    stats = { 'task_ids': [], 'failures': [], 'requests': 0 }
+
+    def collect(futures):
+        for f in futures:
+            added, failed, requests = f.result()
+            stats['task_ids'] += added
+            stats['failures'] += failed
+            stats['requests'] += requests
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        for chunk in chunks(tasks, chunk_size):
+            if len(in_flight) >= 2 * max_workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(_add_chunk, client, job_id, chunk, max_retries))
+        collect(wait(in_flight).done)
+
+    stats['elapsed'] = time.perf_counter() - start
+    return stats
+
+def print_submit_stats(job_id, stats):
+    """Print task submission statistics"""
+    count = len(stats['task_ids'])
+    elapsed = stats['elapsed']
+    print('{job_id}: submitted {count} tasks in {elapsed:.2f}s ({rate:.0f} tasks/s, {requests} requests)'.format(
+        job_id=job_id, count=count, elapsed=elapsed, requests=stats['requests'],
+        rate=count / elapsed if elapsed > 0 else 0))
+    for result in stats['failures']:
+        print('  failed to add {}: {}'.format(result.task_id,
+            result.error.message.value if result.error and result.error.message else result.status))
+
+def get_task_counts(client, job_id):
+    """returns task counts (active, running, completed, succeeded, failed) for a job"""
+    res = client.job.get_task_counts(job_id)
+    # newer SDKs wrap the counts in a `TaskCountsResult`
+    return getattr(res, 'task_counts', res)
+
+def list_changed_tasks(client, job_id, since=None):
+    """list tasks whose state changed at or after `since` (a datetime), fetching only the
+    properties needed for monitoring"""
+    select = 'id,state,stateTransitionTime,lastModified,commandLine,executionInfo,nodeInfo'
+    task_filter = "stateTransitionTime ge datetime'{}'".format(
+        since.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')) if since else None
+    return client.task.list(job_id, task_list_options=models.TaskListOptions(
+        filter=task_filter, select=select))
+
+def get_wall_time(task):
+    """returns task wall time in seconds or None if the task hasn't finished"""
+    info = task.execution_info
+    if info is None or info.start_time is None or info.end_time is None:
+        return None
+    return (info.end_time - info.start_time).total_seconds()
+
+def get_task_output(client, job_id, task_id, file_path='stdout.txt'):
+    """returns the contents of a file in the task's directory (by default, its stdout; for
+    multi-instance tasks, that of the primary task) or None if it can't be read"""
+    try:
+        return b''.join(client.file.get_from_task(job_id, task_id, file_path)).decode('utf-8', errors='replace')
+    except BatchErrorException:
+        return None
+
+class TaskTracker:
+    """tracks task state across polls, remembering the latest state transition seen"""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.since = None
+        self.states = {}
+        self.tasks = {}
+        self.completed = {}
+
+    def poll(self, client, job_id):
+        """fetch tasks changed since the last poll; returns True if any task changed state"""
+        changed = False
+        for task in list_changed_tasks(client, job_id, self.since):
+            if self.since is None or task.state_transition_time > self.since:
+                self.since = task.state_transition_time
+            # tasks that transitioned at `since` are listed again by the next poll
+            if self.states.get(task.id) == (task.state, task.state_transition_time):
+                continue
+            self.states[task.id] = (task.state, task.state_transition_time)
+            self.tasks[task.id] = task
+            changed = True
+            if task.state != models.TaskState.completed:
+                # e.g. a task that was reactivated
+                self.completed.pop(task.id, None)
+            else:
+                self.completed[task.id] = task
+                if self.verbose:
+                    wall = get_wall_time(task)
+                    print('  {id}: completed in {wall} (exit code: {exit_code})'.format(id=task.id,
+                        wall='{:.1f}s'.format(wall) if wall is not None else 'n/a',
+                        exit_code=task.execution_info.exit_code if task.execution_info else 'n/a'))
+        return changed
+
+def print_task_counts(job_id, counts, elapsed, last_summary=None):
+    """print the task counts of a job unless they are the same as `last_summary`; returns
+    the summary to pass on the next call"""
+    summary = (counts.active, counts.running, counts.completed, counts.succeeded, counts.failed)
+    if summary != last_summary:
+        print('[{elapsed:7.1f}s] {job_id}: active={0} running={1} completed={2} (succeeded={3} failed={4})'.format(
+            *summary, elapsed=elapsed, job_id=job_id))
+    return summary
+
+def job_done(state, counts):
+    """returns True if a job in `state` with `counts` task counts has no more tasks to run"""
+    return state in (models.JobState.completed, models.JobState.terminating) or \
+        (counts.active == 0 and counts.running == 0 and counts.completed > 0)
+
+def monitor_job(endpoint, job_id, min_interval=2.0, max_interval=30.0, backoff=1.5, verbose=False,
+                on_poll=None, keep=None):
+    """follow a job till all its tasks complete, printing progress as it goes.
+
+    Each poll fetches the job's task counts and only the tasks whose state changed
+    since the previous poll. The poll interval grows by `backoff` (up to `max_interval`)
+    while nothing changes and drops back to `min_interval` when something does.
+
+    `on_poll(tracker)`, if specified, is called with the `TaskTracker` after each poll and
+    returns True if it changed the job (e.g. reactivated or added tasks), in which case the job
+    isn't considered done till the next poll. `keep(task)`, if specified, selects the
+    completed tasks that are reported and returned."""
+    client = login(endpoint)
+    start = time.perf_counter()
+    tracker = TaskTracker(verbose=verbose)
+    interval = min_interval
+    last_summary = None
+    while True:
+        changed = tracker.poll(client, job_id)
+        acted = on_poll(tracker) if on_poll else False
+        changed = changed or acted
+
+        counts = get_task_counts(client, job_id)
+        summary = print_task_counts(job_id, counts, time.perf_counter() - start, last_summary)
+        changed = changed or summary != last_summary
+        last_summary = summary
+
+        job = client.job.get(job_id, job_get_options=models.JobGetOptions(select='id,state'))
+        if not acted and job_done(job.state, counts):
+            break
+
+        interval = min_interval if changed else min(interval * backoff, max_interval)
+        time.sleep(interval)
+
+    # pick up tasks that completed after the last poll
+    tracker.poll(client, job_id)
+    tasks = [t for t in tracker.completed.values() if keep is None or keep(t)]
+    print_task_times(job_id, tasks)
+    return {
+        'job_id': job_id,
+        'tasks': tasks,
+        'succeeded': counts.succeeded,
+        'failed': counts.failed,
+    }
+
+def print_task_times(job_id, tasks):
+    """Print wall time and throughput statistics for completed tasks"""
+    tasks = [t for t in tasks if get_wall_time(t) is not None]
+    if not tasks:
+        print('{}: no timing information available'.format(job_id))
+        return
+    walls = sorted(get_wall_time(t) for t in tasks)
+    span = (max(t.execution_info.end_time for t in tasks) -
+        min(t.execution_info.start_time for t in tasks)).total_seconds()
+    print("""=============================================
+{job_id}
+=============================================
+Tasks: {count}
+Wall time (min/median/max): {min:.1f}s / {median:.1f}s / {max:.1f}s
+Total task time: {total:.1f}s
+Elapsed: {span:.1f}s
+Throughput: {rate:.2f} tasks/s
+""".format(job_id=job_id, count=len(walls), min=walls[0], median=walls[len(walls) // 2],
+        max=walls[-1], total=sum(walls), span=span, rate=len(walls) / span if span > 0 else 0))
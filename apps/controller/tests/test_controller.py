@@ -0,0 +1,53 @@
+"""Tests for the asyncio `BatchController` against the fake Batch service."""
+import asyncio
+
+import pytest
+
+pytest.importorskip('azure.batch')
+
+from azure.batch import models
+
+from batch_controller import controller, fake_batch, utils
+
+@pytest.fixture
+def service():
+    service = fake_batch.FakeBatchService(nodes=4, seed=0)
+    utils.set_backend(lambda endpoint: service)
+    yield service
+    utils.set_backend(None)
+
+def make_tasks(count):
+    return [models.TaskAddParameter(id=str(i), command_line='echo {}'.format(i)) for i in range(count)]
+
+def test_submit_and_wait(service):
+    async def submit_all(batch):
+        jobs = await asyncio.gather(*[batch.submit_job('azfinsim-pool', make_tasks(count), job_id_prefix='job-{}'.format(count))
+            for count in (5, 120, 250)])
+        counts = await asyncio.gather(*[batch.wait_for_job(job['job_id'], min_interval=0) for job in jobs])
+        return jobs, counts
+
+    batch = controller.BatchController('fake', max_concurrency=4)
+    jobs, counts = controller.run(submit_all(batch))
+    assert len(set(job['job_id'] for job in jobs)) == 3
+    assert sorted(batch.jobs) == sorted(job['job_id'] for job in jobs)
+    for job, count, expected in zip(jobs, counts, (5, 120, 250)):
+        assert len(job['task_ids']) == expected
+        assert len(service.jobs[job['job_id']].tasks) == expected
+        assert count.completed == expected and count.active == 0
+
+def test_cancel_job(service):
+    async def submit_and_cancel(batch):
+        job = await batch.submit_job('azfinsim-pool', make_tasks(10), job_id_prefix='cancel',
+            on_all_tasks_complete='noAction')
+        # the job stays active once its tasks complete, till it's cancelled
+        before = await batch.get_job_state(job['job_id'])
+        await batch.cancel_job(job['job_id'])
+        counts = await batch.wait_for_job(job['job_id'], min_interval=0)
+        return job, before, await batch.get_job_state(job['job_id']), counts
+
+    batch = controller.BatchController('fake')
+    job, before, after, counts = controller.run(submit_and_cancel(batch))
+    assert before == models.JobState.active
+    assert after == models.JobState.completed
+    assert service.jobs[job['job_id']].terminated
+    assert counts.active == 0
@@ -0,0 +1,136 @@
+"""Unit tests for reading and pricing shards of trades on the node (see `local_shard`)."""
+import shutil
+
+import pytest
+
+from batch_controller import local_shard
+
+HEADER = b'id,value\n'
+
+def write_trades(path, first, count, partial=b''):
+    with open(path, 'ab') as f:
+        if f.tell() == 0:
+            f.write(HEADER)
+        f.writelines('{},{}\n'.format(i, i * 10).encode() for i in range(first, first + count))
+        f.write(partial)
+
+def read_lines(path):
+    with open(path, 'rb') as f:
+        return f.read().splitlines(keepends=True)
+
+class FakePricer:
+    """stands in for `local_shard.run_module`: the results of a shard are a copy of it;
+    fails once `fail_after` shards were priced"""
+
+    def __init__(self, fail_after=None):
+        self.calls = []
+        self.fail_after = fail_after
+
+    def __call__(self, argv):
+        if self.fail_after is not None and len(self.calls) >= self.fail_after:
+            raise RuntimeError('preempted')
+        self.calls.append(argv)
+        if '--cache-path' in argv:
+            path = argv[argv.index('--cache-path') + 1]
+            shutil.copy(path, local_shard.results_name(path))
+
+@pytest.mark.parametrize('parts', [1, 2, 3, 7, 50])
+def test_read_range(tmp_path, parts):
+    source = str(tmp_path / 'trades.csv')
+    # the last line has no line break
+    write_trades(source, 0, 20, partial=b'20,200')
+    lines = []
+    for part in range(parts):
+        output = str(tmp_path / 'shard.{}.csv'.format(part))
+        count = local_shard.read_range(source, output, part, parts)
+        shard = read_lines(output)
+        assert shard[0] == HEADER and len(shard) == count + 1
+        lines += shard[1:]
+    # every line is read by exactly one part
+    assert lines == read_lines(source)[1:]
+
+def test_read_new(tmp_path):
+    source = str(tmp_path / 'trades.csv')
+    output = str(tmp_path / 'new.csv')
+    write_trades(source, 0, 5, partial=b'5,5')
+    # a partial last line is still being written and is left for the next run
+    count, offset = local_shard.read_new(source, output, 0)
+    assert count == 5 and read_lines(output) == read_lines(source)[:-1]
+    write_trades(source, 6, 0, partial=b'0\n')
+    write_trades(source, 6, 2)
+    # the offset and counting lines give the same result
+    for known in (offset, None):
+        count, end = local_shard.read_new(source, output, 5, known)
+        assert count == 3 and read_lines(output) == [HEADER, b'5,50\n', b'6,60\n', b'7,70\n']
+    # nothing new at the end of the file
+    assert local_shard.read_new(source, output, 8, end) == (0, end)
+    assert local_shard.read_new(source, output, 8) == (0, end)
+    assert read_lines(output) == [HEADER]
+    with pytest.raises(RuntimeError):
+        local_shard.read_new(source, output, 9)
+    assert local_shard.read_new(source, output, 0, max_trades=2)[0] == 2
+
+def test_watermark(tmp_path, monkeypatch):
+    source = str(tmp_path / 'trades.csv')
+    watermark = str(tmp_path / 'shared' / 'watermark.json')
+    output_dir = tmp_path / 'shared' / 'results'
+    pricer = FakePricer()
+    monkeypatch.setattr(local_shard, 'run_module', pricer)
+    argv = ['--source', source, '--watermark', watermark, '--shard', 'trades.csv', '--output-dir', str(output_dir),
+        '--scratch-dir', str(tmp_path / 'scratch'), '--price=-m azfinsim.azfinsim']
+    (tmp_path / 'scratch').mkdir()
+
+    write_trades(source, 0, 4, partial=b'4,4')
+    local_shard.main(argv)
+    assert local_shard.load_json(watermark, None)['start_trade'] == 4
+    assert len(read_lines(str(output_dir / 'trades.0-4.results.csv'))) == 5
+    # the watermark is at the end of the file, nothing is priced
+    local_shard.main(argv)
+    assert len(pricer.calls) == 1
+    # the partial last line is priced once it's complete
+    write_trades(source, 5, 0, partial=b'0\n')
+    write_trades(source, 5, 2)
+    local_shard.main(argv)
+    assert read_lines(str(output_dir / 'trades.4-7.results.csv')) == [HEADER, b'4,40\n', b'5,50\n', b'6,60\n']
+    # a failed run doesn't advance the watermark
+    write_trades(source, 7, 1)
+    monkeypatch.setattr(local_shard, 'run_module', FakePricer(fail_after=0))
+    with pytest.raises(RuntimeError):
+        local_shard.main(argv)
+    assert local_shard.load_json(watermark, None)['start_trade'] == 7
+
+def test_price_shard_resume(tmp_path, monkeypatch):
+    shard = str(tmp_path / 'shard.csv')
+    output = str(tmp_path / 'shard.results.csv')
+    checkpoint = str(tmp_path / 'checkpoints' / 'task.json')
+    write_trades(shard, 0, 10)
+    # the task is preempted after pricing two chunks
+    monkeypatch.setattr(local_shard, 'run_module', FakePricer(fail_after=2))
+    with pytest.raises(RuntimeError):
+        local_shard.price_shard(['-m', 'azfinsim.azfinsim'], shard, output, checkpoint, 3)
+    assert local_shard.load_json(checkpoint, None)['priced'] == 6
+    # results of a chunk priced after the last checkpoint are dropped
+    with open(output + '.partial', 'ab') as f:
+        f.write(b'6,60\n')
+
+    pricer = FakePricer()
+    monkeypatch.setattr(local_shard, 'run_module', pricer)
+    local_shard.price_shard(['-m', 'azfinsim.azfinsim'], shard, output, checkpoint, 3)
+    assert len(pricer.calls) == 2
+    # the results have a single header and every trade once
+    assert read_lines(output) == read_lines(shard)
+    # a task restarted after it finished doesn't price anything again
+    local_shard.price_shard(['-m', 'azfinsim.azfinsim'], shard, output, checkpoint, 3)
+    assert len(pricer.calls) == 2
+
+def test_price_window_resume(tmp_path, monkeypatch):
+    checkpoint = str(tmp_path / 'task.json')
+    monkeypatch.setattr(local_shard, 'run_module', FakePricer(fail_after=1))
+    with pytest.raises(RuntimeError):
+        local_shard.price_window(['-m', 'azfinsim.azfinsim'], 100, 10, checkpoint, 4)
+    assert local_shard.load_json(checkpoint, None) == {'priced': 4, 'last_trade': 103}
+    pricer = FakePricer()
+    monkeypatch.setattr(local_shard, 'run_module', pricer)
+    local_shard.price_window(['-m', 'azfinsim.azfinsim'], 100, 10, checkpoint, 4)
+    assert [c[-4:] for c in pricer.calls] == [['--start-trade', '104', '--trade-window', '4'],
+        ['--start-trade', '108', '--trade-window', '2']]
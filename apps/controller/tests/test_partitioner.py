@@ -0,0 +1,90 @@
+"""Unit tests for splitting trade windows into partitions."""
+import random
+
+import pytest
+
+from batch_controller import partitioner
+
+def assert_covers(result, start, count):
+    """partitions are contiguous, don't overlap and cover the window exactly"""
+    for s, n in result:
+        assert s == start and n > 0
+        start += n
+    assert sum(n for _, n in result) == count
+
+@pytest.mark.parametrize('count,parts', [(10, 3), (10, 10), (100, 7), (1, 1), (5, 8)])
+def test_partition(count, parts):
+    result = partitioner.partition(1000, count, parts)
+    assert_covers(result, 1000, count)
+    # fewer trades than partitions gives one trade per partition
+    assert len(result) == min(count, parts)
+    sizes = [n for _, n in result]
+    assert max(sizes) - min(sizes) <= 1
+    assert [partitioner.partition_at(1000, count, parts, i) for i in range(len(result))] == result
+
+def test_partition_empty():
+    assert partitioner.partition(0, 0, 4) == []
+    assert partitioner.weighted_partition(0, 0, 4, lambda trade: 1.0) == []
+    assert partitioner.partition_ranges([], 4) == []
+    assert partitioner.partition_ranges([(0, 0), (10, 0)], 4) == []
+
+def test_weighted_partition_balance():
+    rng = random.Random(0)
+    costs = [rng.choice([1.0, 1.0, 5.0]) for _ in range(1000)]
+    cost = lambda trade: costs[trade - 500]
+    for parts in (1, 3, 16, 100):
+        result = partitioner.weighted_partition(500, 1000, parts, cost)
+        assert_covers(result, 500, 1000)
+        assert len(result) == parts
+        # each partition exceeds its share by at most the cost of one trade
+        share = sum(costs) / parts
+        for start, size in result:
+            assert sum(cost(t) for t in range(start, start + size)) <= share + max(costs)
+
+def test_weighted_partition_zero_weights():
+    # without any cost, trades are split evenly
+    assert partitioner.weighted_partition(0, 10, 3, lambda trade: 0.0) == partitioner.partition(0, 10, 3)
+    # trades without cost don't count towards the balance
+    result = partitioner.weighted_partition(0, 100, 2, lambda trade: 1.0 if trade >= 50 else 0.0)
+    assert_covers(result, 0, 100)
+    assert result[1][0] >= 50
+
+def test_weighted_partition_fewer_trades():
+    result = partitioner.weighted_partition(0, 3, 5, lambda trade: 1.0)
+    assert result == [(0, 1), (1, 1), (2, 1)]
+
+def test_cost_model():
+    model = partitioner.CostModel([
+        {'start': 0, 'count': 100, 'seconds': 300.0},
+        {'start': 100, 'count': 100, 'seconds': 100.0, 'algorithm': 'pvonly'},
+        {'start': 200, 'count': 0, 'seconds': 5.0},
+    ])
+    assert model(50) == 3.0
+    # pvonly durations are scaled to deltavega
+    assert model(150) == 3.0
+    assert model(1000) == model.default == 3.0
+    # empty history assumes the cost of the algorithm
+    assert partitioner.CostModel([], algorithm='pvonly')(0) == partitioner.ALGORITHM_COST['pvonly']
+
+def test_partition_ranges():
+    ranges = [(0, 10), (100, 90), (500, 1)]
+    result = partitioner.partition_ranges(ranges, 10)
+    assert sum(n for _, n in result) == 101
+    for start, count in ranges:
+        inside = [(s, n) for s, n in result if start <= s < start + count]
+        # every range gets at least one partition and partitions stay within their range
+        assert inside
+        assert_covers(inside, start, count)
+    assert len(result) == 10
+    # every range gets at least one partition, so there may be up to one extra per range
+    for parts in (1, 2, 4):
+        result = partitioner.partition_ranges(ranges, parts)
+        assert parts <= len(result) <= max(parts, len(ranges)) + len(ranges)
+        assert sum(n for _, n in result) == 101
+
+def test_partition_ranges_cost():
+    ranges = [(0, 100), (100, 100)]
+    # the second range is 9 times as expensive, so gets most partitions
+    result = partitioner.partition_ranges(ranges, 10, cost=lambda trade: 9.0 if trade >= 100 else 1.0)
+    assert len([s for s, _ in result if s >= 100]) == 9
+    assert_covers(result, 0, 200)
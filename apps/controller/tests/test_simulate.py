@@ -0,0 +1,159 @@
+"""Smoke tests running the benchmarks and simulated commands against the fake Batch service.
+
+These use the real Batch SDK models, so they catch models constructed with missing required
+arguments that the fake service would otherwise accept.
+"""
+import subprocess
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('azure.batch')
+
+from azure.batch import models
+
+from batch_controller import (azfinsim, benchmark, cli, fake_batch, lulesh_catalyst, result_cache, supervisor, telemetry,
+    trame_standby, utils)
+
+def run(parser, argv):
+    cli.execute(parser.parse_args(argv))
+
+def test_benchmark_submit(capsys):
+    run(benchmark.get_parser(), ['submit', '--tasks', '250', '--latency', '0', '--server-error-rate', '0.1'])
+    assert 'submitted 250 tasks' in capsys.readouterr().out
+
+def test_benchmark_scale(capsys):
+    run(benchmark.get_parser(), ['scale', '--tasks', '10', '100', '--latency', '0', '--nodes', '4'])
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines[1:]] == ['10', '100']
+
+def test_simulate_monitor(capsys):
+    run(azfinsim.get_parser(), ['job', '-e', 'fake', '-c', 'fake', '--tasks', '4', '--trade-window', '400',
+        '--simulate', '--monitor'])
+    out = capsys.readouterr().out
+    assert 'completed=4' in out
+    assert 'Estimated makespan' in out
+
+def test_benchmark_tail(capsys):
+    run(benchmark.get_parser(), ['tail', '--tasks', '50', '--nodes', '4'])
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(',')[0].split()[0] for line in lines[1:]] == ['no', 'failures', 'failures']
+
+def test_supervised_tail(capsys):
+    # with the default policy, supervision keeps the makespan within 30% of the run without
+    # failures or stragglers, while the unsupervised run takes about 50% longer
+    run(benchmark.get_parser(), ['tail', '--tasks', '300', '--nodes', '20'])
+    lines = capsys.readouterr().out.splitlines()
+    baseline, unsupervised, supervised = [float(line[22:].split()[0]) for line in lines[1:]]
+    assert supervised <= 1.3 * baseline
+    assert unsupervised >= 1.4 * baseline
+
+def test_supervise_job(capsys):
+    # supervised jobs are submitted with `noAction`, the supervisor terminates them
+    service = fake_batch.FakeBatchService(failure_rate=0.5, seed=0)
+    utils.set_backend(lambda endpoint: service)
+    try:
+        job = utils.submit_job(endpoint='fake', pool_id='azfinsim-pool', num_tasks=8,
+            task_command_lines=('echo {}'.format(i) for i in range(8)), task_container_image='fake',
+            job_id_prefix='supervised', on_all_tasks_complete='noAction')
+        result = supervisor.supervise_job(endpoint='fake', job_id=job['job_id'], min_interval=0)
+    finally:
+        utils.set_backend(None)
+    assert len(result['tasks']) == 8
+    assert service.jobs[job['job_id']].terminated
+    assert 'resubmitted {} failed tasks'.format(result['failed']) in capsys.readouterr().out
+
+def test_simulate_result_cache(capsys, tmp_path):
+    # recording priced ranges needs the job to be followed, even without --monitor
+    argv = ['job', '-e', 'fake', '-c', 'fake', '--tasks', '4', '--trade-window', '400',
+        '--result-cache', str(tmp_path / 'cache.json'), '--image-digest', 'sha256:1234', '--simulate']
+    run(azfinsim.get_parser(), argv)
+    assert 'result cache: recorded' in capsys.readouterr().out
+    # a tag doesn't identify the image that priced the trades
+    with pytest.raises(RuntimeError, match='--image-digest'):
+        run(azfinsim.get_parser(), argv[:-3] + ['--simulate'])
+    run(azfinsim.get_parser(), argv)
+    assert 'result cache: 0 of 400 trades need pricing' in capsys.readouterr().out
+
+def test_timed_list_calls():
+    # list calls return lazy results, the requests are only sent as they are iterated
+    service = fake_batch.FakeBatchService(latency=0.05)
+    client = telemetry.instrument(service)
+    client.job.add(models.JobAddParameter(id='timed', pool_info=models.PoolInformation(pool_id='azfinsim-pool')))
+    count = len(telemetry.get_calls())
+    tasks = client.task.list('timed')
+    assert len(telemetry.get_calls()) == count
+    assert list(tasks) == []
+    calls = telemetry.get_calls()[count:]
+    assert [c['name'] for c in calls] == ['task.list']
+    assert calls[0]['duration'] >= 0.05
+
+def test_simulate_sweep(tmp_path):
+    output = tmp_path / 'sweep.csv'
+    run(lulesh_catalyst.get_parser(), ['sweep', '-e', 'fake', '-c', 'fake', '-s', '10', '20', '-n', '1', '8',
+        '-o', str(output), '--simulate', '--simulate-nodes', '8'])
+    rows = output.read_text().splitlines()
+    assert len(rows) == 5
+    with pytest.raises(ValueError, match='needs 1 slots on each of 8 nodes'):
+        run(lulesh_catalyst.get_parser(), ['sweep', '-e', 'fake', '-c', 'fake', '-n', '8', '-o', str(output), '--simulate'])
+
+@pytest.mark.parametrize('module,argv', [
+    ('batch_controller', ['--help']),
+    ('batch_controller', ['azfinsim', 'job', '--help']),
+    ('batch_controller.azfinsim', ['--help']),
+    ('batch_controller.lulesh_catalyst', ['--help']),
+    ('batch_controller.trame', ['pool', '--help']),
+])
+def test_help_skips_sdk(module, argv):
+    # printing help must not import the Batch SDK (see `cli.lazy_import`)
+    code = '\n'.join([
+        'import runpy, sys',
+        'sys.argv = [{!r}] + {!r}'.format(module, argv),
+        'try:',
+        '    runpy.run_module({!r}, run_name="__main__", alter_sys=True)'.format(module),
+        'except SystemExit:',
+        '    pass',
+        'print(" ".join(m for m in sys.modules if m.split(".")[0] in {!r}))'.format(benchmark.HEAVY_MODULES),
+    ])
+    proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    assert proc.stdout.splitlines()[-1].split() == []
+
+def test_result_cache(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    cache = result_cache.ResultCache(path)
+    assert cache.missing(0, 100, 'pvonly', 'sha256:a') == [(0, 100)]
+    cache.add(10, 20, 'pvonly', 'sha256:a')
+    cache.add(50, 10, 'pvonly', 'sha256:a')
+    cache.add(0, 100, 'deltavega', 'sha256:a')
+    cache.save()
+    cache = result_cache.ResultCache(path)
+    assert cache.missing(0, 100, 'pvonly', 'sha256:a') == [(0, 10), (30, 20), (60, 40)]
+    assert cache.missing(15, 10, 'pvonly', 'sha256:a') == []
+    assert cache.missing(25, 30, 'pvonly', 'sha256:a') == [(30, 20)]
+    # results of another algorithm or image don't count
+    assert cache.missing(0, 100, 'deltavega', 'sha256:a') == []
+    assert cache.missing(0, 100, 'pvonly', 'sha256:b') == [(0, 100)]
+    # adding the same range again replaces the entry
+    cache.add(10, 20, 'pvonly', 'sha256:a', job_id='job')
+    assert len(cache.entries) == 3
+    cache.invalidate(55, 50)
+    assert cache.missing(0, 100, 'pvonly', 'sha256:a') == [(0, 10), (30, 70)]
+    assert cache.missing(0, 100, 'deltavega', 'sha256:a') == [(0, 100)]
+    cache.invalidate(30, 20)
+    assert len(cache.entries) == 1
+
+def test_confirm_node(capsys):
+    # affinity is only a preference, so a session may be scheduled on another node
+    states = iter([models.TaskState.active, models.TaskState.running])
+    def get(job_id, task_id, task_get_options=None):
+        state = next(states)
+        node = models.ComputeNodeInformation(node_id='node-1', pool_id='trame-pool') \
+            if state != models.TaskState.active else None
+        return models.CloudTask(id=task_id, state=state, node_info=node)
+    client = types.SimpleNamespace(task=types.SimpleNamespace(get=get))
+    session = {'job_id': trame_standby.JOB_ID, 'task_id': 'session-9000-x', 'port': 9000,
+        'pool_id': 'trame-pool', 'node_id': 'node-0'}
+    trame_standby.confirm_node(client, session, interval=0)
+    assert session['node_id'] == 'node-1' and session['moved']
+    assert 'instead of the standby node node-0' in capsys.readouterr().out
@@ -8,9 +8,17 @@ parser.add_argument('-o', '--output', help="output file name")
 parser.add_argument('-f', '--format', help='output format', choices=['json', 'pickle', 'raw'], default='raw')
 parser.add_argument('-p', '--print', help='print secrets to stdout', action='store_true', default=False)
 parser.add_argument('-k', '--key', help='print value for a specific secret')
+parser.add_argument('-w', '--workers', help='number of secrets fetched concurrently (default: %(default)s)',
+    type=int, default=kv.MAX_WORKERS)
+parser.add_argument('-c', '--cache', help='node-local cache file; only secrets that changed are fetched again')
+parser.add_argument('--cache-ttl', help='seconds for which cached secrets are used as-is (default: %(default)s)',
+    type=float, default=kv.CACHE_TTL)
+parser.add_argument('--cache-key-file', help='file with the key used to encrypt the cache; a new key is saved to it if it does not exist')
 
 args = parser.parse_args()
-secrets = kv.read_secrets(args.key_vault_uri, key=args.key)
+cache_key = kv.load_cache_key(args.cache_key_file) if args.cache_key_file else None
+cache = kv.SecretCache(args.cache, ttl=args.cache_ttl, key=cache_key) if args.cache else None
+secrets = kv.read_secrets(args.key_vault_uri, key=args.key, max_workers=args.workers, cache=cache)
 
 if args.format == 'json':
     import json
@@ -1,13 +1,152 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import HttpResponseError
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
+# default number of concurrent `get_secret` requests
+MAX_WORKERS = 8
+
+# number of times a throttled (HTTP 429) request is retried
+MAX_RETRIES = 5
+
+# default time in seconds for which cached secrets are used without contacting the key vault
+CACHE_TTL = 3600
+
+# environment variable with a key (see `cryptography.fernet.Fernet.generate_key`) to encrypt the cache
+CACHE_KEY_VARIABLE = 'GRABBER_CACHE_KEY'
+
+_credential = None
+_clients = {}
+_lock = threading.Lock()
+
+def get_credential():
+    """returns the credential shared by all clients in this process"""
+    global _credential
+    with _lock:
+        if _credential is None:
+            _credential = DefaultAzureCredential()
+        return _credential
 
 def login(kv_uri):
-    return SecretClient(vault_url=kv_uri, credential=DefaultAzureCredential())
+    credential = get_credential()
+    with _lock:
+        if kv_uri not in _clients:
+            _clients[kv_uri] = SecretClient(vault_url=kv_uri, credential=credential)
+        return _clients[kv_uri]
+
+def retry_after(error, attempt, backoff=1.0):
+    """returns seconds to wait before retrying a throttled request: the `Retry-After` sent by the
+    key vault if any, else exponential backoff; jitter spreads out retries from many nodes"""
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        delay = float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        delay = backoff * 2 ** attempt
+    return delay * random.uniform(1.0, 1.5)
+
+def get_secret(client, name, version=None, max_retries=MAX_RETRIES):
+    """get a secret, retrying if the request is throttled"""
+    for attempt in range(max_retries + 1):
+        try:
+            return client.get_secret(name, version=version)
+        except HttpResponseError as e:
+            if e.status_code != 429 or attempt == max_retries:
+                raise
+            time.sleep(retry_after(e, attempt))
+
+def get_secrets(client, names, max_workers=MAX_WORKERS):
+    """get secrets concurrently using at most `max_workers` threads; returns a dict of
+    name -> `KeyVaultSecret`"""
+    if not names:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(names))) as executor:
+        return dict(zip(names, executor.map(lambda name: get_secret(client, name), names)))
+
+class SecretCache:
+    """node-local cache of secrets and their versions, stored in a file readable only by its owner
+    and encrypted if a key is specified (or set in $GRABBER_CACHE_KEY)"""
+
+    def __init__(self, path, ttl=CACHE_TTL, key=None):
+        self.path = path
+        self.ttl = ttl
+        self.key = key if key else os.environ.get(CACHE_KEY_VARIABLE)
 
-def read_secrets(kv_uri, key=None):
+    def fernet(self):
+        from cryptography.fernet import Fernet
+        return Fernet(self.key)
+
+    def load(self, kv_uri):
+        """returns the cached entry for the key vault or None"""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        try:
+            data = json.loads(self.fernet().decrypt(data) if self.key else data)
+        except Exception:
+            # unreadable, e.g. written with a different key; fetch all secrets again
+            return None
+        return data if data.get('vault') == kv_uri else None
+
+    def fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched'] < self.ttl
+
+    def save(self, kv_uri, secrets):
+        """save secrets, a dict of name -> `{'version', 'value'}`"""
+        data = json.dumps({'vault': kv_uri, 'fetched': time.time(), 'secrets': secrets}).encode('utf-8')
+        if self.key:
+            data = self.fernet().encrypt(data)
+        fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+def load_cache_key(path):
+    """returns the cache key saved in `path`, first saving a new key to it (readable only by its
+    owner) if it doesn't exist"""
+    if not os.path.exists(path):
+        from cryptography.fernet import Fernet
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(Fernet.generate_key())
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+def secret_version(properties):
+    """returns a string that changes whenever a new version of the secret is created; listing
+    secrets doesn't return their versions, so the time the secret was last updated is used"""
+    if properties.version:
+        return properties.version
+    return properties.updated_on.isoformat() if properties.updated_on else None
+
+def read_secrets(kv_uri, key=None, max_workers=MAX_WORKERS, cache=None):
+    """returns a dict of secret name -> value for all enabled secrets in the key vault, or the
+    value of the secret named `key`.
+
+    If `cache` (a `SecretCache`) is specified, cached secrets are returned as-is till they
+    are older than its TTL; after that, only secrets whose version changed are fetched again."""
     client = login(kv_uri)
-    if key is None:
-        return dict([ (secret.name, client.get_secret(secret.name).value,) \
-                   for secret in client.list_properties_of_secrets()])
-    return client.get_secret(key).value
\ No newline at end of file
+    if key is not None:
+        return get_secret(client, key).value
+
+    entry = cache.load(kv_uri) if cache else None
+    if cache and cache.fresh(entry):
+        return {name: s['value'] for name, s in entry['secrets'].items()}
+
+    cached = entry['secrets'] if entry else {}
+    versions = {p.name: secret_version(p) for p in client.list_properties_of_secrets() if p.enabled is not False}
+    changed = [name for name, version in versions.items()
+        if name not in cached or cached[name]['version'] != version]
+    fetched = get_secrets(client, changed, max_workers=max_workers)
+
+    secrets = {name: {'version': version,
+        'value': fetched[name].value if name in fetched else cached[name]['value']} for name, version in versions.items()}
+    if cache:
+        cache.save(kv_uri, secrets)
+    return {name: s['value'] for name, s in secrets.items()}
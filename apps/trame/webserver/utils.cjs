@@ -19,37 +19,123 @@ const GLOBALS = {
     },
 
     PORTS: new Set(),
-    PORTS_RANGE: [8000,9000]
+    PORTS_RANGE: [8000,9000],
 
+    // standby trame servers kept running by `python -m batch_controller.trame standby`
+    // (see batch_controller/trame_standby.py); they use ports in [9000, 10000)
+    STANDBY_JOB_ID: 'trame-standby',
+
+    // seconds after which the blobs in a container are listed again
+    DATASETS_MAX_AGE: 300,
+}
+
+// credentials and clients are created once and shared by all requests
+const CACHE = {
+    credentials: null,
+    batchCredentials: null,
+    batchClients: new Map(),
+    blobClients: new Map(),
+    // container name -> { listed, blobs }
+    datasets: new Map(),
+    datasetsRefresh: null,
 }
 
 function getCredentials() {
-    let opts = args.opts()
-    return new DefaultAzureCredential({
-        managedIdentityClientId: opts.managedIdentityClientId
-    })
+    if (!CACHE.credentials) {
+        let opts = args.opts()
+        CACHE.credentials = new DefaultAzureCredential({
+            managedIdentityClientId: opts.managedIdentityClientId
+        })
+    }
+    return CACHE.credentials
 }
 
 async function getBatchCredentials() {
-    let opts = args.opts()
-    if (opts.managedIdentityClientId) {
-       return await loginWithAppServiceMSI(
-        { resource: "https://batch.core.windows.net/", clientId: opts.managedIdentityClientId })
-    } else {
-          return await AzureCliCredentials.create({ resource: "https://batch.core.windows.net/" });
+    if (!CACHE.batchCredentials) {
+        let opts = args.opts()
+        if (opts.managedIdentityClientId) {
+            CACHE.batchCredentials = loginWithAppServiceMSI(
+                { resource: "https://batch.core.windows.net/", clientId: opts.managedIdentityClientId })
+        } else {
+            CACHE.batchCredentials = AzureCliCredentials.create({ resource: "https://batch.core.windows.net/" });
+        }
+        // don't cache failures
+        CACHE.batchCredentials.catch(() => { CACHE.batchCredentials = null })
+    }
+    return await CACHE.batchCredentials
+}
+
+async function getBatchClient(batchEndpoint) {
+    if (!CACHE.batchClients.has(batchEndpoint)) {
+        CACHE.batchClients.set(batchEndpoint, new BatchServiceClient(await getBatchCredentials(), batchEndpoint))
+    }
+    return CACHE.batchClients.get(batchEndpoint)
+}
+
+function getBlobServiceClient(blobStorageEndpoint) {
+    if (!CACHE.blobClients.has(blobStorageEndpoint)) {
+        CACHE.blobClients.set(blobStorageEndpoint, new BlobServiceClient(blobStorageEndpoint, getCredentials()))
+    }
+    return CACHE.blobClients.get(blobStorageEndpoint)
+}
+
+async function listBlobs(blobServiceClient, containerName) {
+    let blobs = []
+    for await (const blob of blobServiceClient.getContainerClient(containerName).listBlobsFlat()) {
+        blobs.push(blob.name)
     }
+    return { listed: Date.now(), blobs: blobs }
 }
 
+/**
+ * Updates the dataset index: containers are listed concurrently and only those listed
+ * more than DATASETS_MAX_AGE seconds ago are listed again.
+ */
+async function refreshDatasets(blobStorageEndpoint) {
+    const blobServiceClient = getBlobServiceClient(blobStorageEndpoint)
+    let names = []
+    for await (const container of blobServiceClient.listContainers()) {
+        names.push(container.name)
+    }
+
+    const now = Date.now()
+    const stale = names.filter(name => !CACHE.datasets.has(name) ||
+        now - CACHE.datasets.get(name).listed > GLOBALS.DATASETS_MAX_AGE * 1000)
+    const listings = await Promise.all(stale.map(name => listBlobs(blobServiceClient, name)))
+
+    let datasets = new Map()
+    for (let name of names) {
+        datasets.set(name, CACHE.datasets.get(name))
+    }
+    stale.forEach((name, index) => datasets.set(name, listings[index]))
+    CACHE.datasets = datasets
+}
+
+/**
+ * Returns the datasets from the index; the index is refreshed in the background so
+ * only the first request waits for the storage account to be listed.
+ */
 async function getDatasets(blobStorageEndpoint) {
-    const blobServiceClient = new BlobServiceClient(blobStorageEndpoint, getCredentials())
+    if (!CACHE.datasetsRefresh) {
+        CACHE.datasetsRefresh = refreshDatasets(blobStorageEndpoint).finally(() => {
+            CACHE.datasetsRefresh = null
+        })
+        if (CACHE.datasets.size === 0) {
+            await CACHE.datasetsRefresh
+        } else {
+            // errors are reported by the next request that waits for a refresh
+            CACHE.datasetsRefresh.catch(error => console.log(`error: dataset refresh failed: ${error.message}`))
+        }
+    } else if (CACHE.datasets.size === 0) {
+        await CACHE.datasetsRefresh
+    }
 
     let result = []
-    for await (const container of blobServiceClient.listContainers()) {
-        const containerClient = blobServiceClient.getContainerClient(container.name)
-        for await (const blob of containerClient.listBlobsFlat()) {
+    for (let [container, entry] of CACHE.datasets) {
+        for (let name of entry.blobs) {
             result.push({
-                name: blob.name,
-                container: container.name,
+                name: name,
+                container: container,
             })
         }
     }
@@ -59,8 +145,8 @@ async function getDatasets(blobStorageEndpoint) {
 function getUniqueId() {
     let d = new Date();
     // batch job/task names can only have alphanumerics, -, and _. So we remove
-    // : and .
-    return d.toISOString().replaceAll(':','-').replaceAll('.','-')
+    // : and .; the random suffix keeps ids of concurrent requests distinct
+    return d.toISOString().replaceAll(':','-').replaceAll('.','-') + '-' + Math.random().toString(16).slice(2, 10)
 }
 
 function getRandomInt(min, max) {
@@ -81,17 +167,7 @@ function pickPort() {
     throw Error('failed to find free port!')
 }
 
-async function submitJob(datasets, options, batchEndpoint, containerRegistryLoginServer, prefix) {
-    let batchServiceClient = new BatchServiceClient(await getBatchCredentials(),
-        batchEndpoint)
-
-    let label = `trame (${datasets[0].name}:${datasets[0].container}) (count=${datasets.length})`
-    const jobConfig = {
-        id: `${prefix||'trame'}-${getUniqueId()}`,
-        displayName: label,
-        poolInfo: GLOBALS.TRAME_POOL_INFO,
-    }
-
+function getCommandLine(datasets, options) {
     let commandLine = ['--create-on-server-ready',
         '{AZ_BATCH_TASK_WORKING_DIR}/server-ready.txt']
 
@@ -108,6 +184,95 @@ async function submitJob(datasets, options, batchEndpoint, containerRegistryLogi
     if (options.link_interactions) {
         commandLine.push('--link-views')
     }
+    return commandLine.join(' ')
+}
+
+function getErrorCode(error) {
+    return error.code || (error.body && error.body.code)
+}
+
+/**
+ * Hands out a running standby trame server: the standby task is terminated (using its
+ * ETag, so that concurrent claims can't get the same one) and the session is started in
+ * its place on the same node and port. Returns null if no standby server is running.
+ *
+ * Node affinity is only a preference, so the session may be scheduled on another node;
+ * `getComputeNode` checks the node the session actually runs on against `nodeId`. The port
+ * stays valid on any node since ports are unique across the tasks of the standby job.
+ */
+async function claimStandbyServer(batchServiceClient, label, commandLine, containerRegistryLoginServer) {
+    let tasks
+    try {
+        tasks = await batchServiceClient.task.list(GLOBALS.STANDBY_JOB_ID, {
+            taskListOptions: {
+                filter: "state eq 'running'",
+                select: 'id,state,eTag,nodeInfo',
+            }
+        })
+        // sessions claimed earlier run in the same job
+        tasks = tasks.filter(task => task.id.startsWith('standby-'))
+    } catch (error) {
+        if (getErrorCode(error) === 'JobNotFound') {
+            return null
+        }
+        throw error
+    }
+
+    // spread concurrent claims across standby tasks
+    tasks.sort(() => Math.random() - 0.5)
+    for (let standby of tasks) {
+        try {
+            await batchServiceClient.task.terminate(GLOBALS.STANDBY_JOB_ID, standby.id,
+                { taskTerminateOptions: { ifMatch: standby.eTag } })
+        } catch (error) {
+            if (['ConditionNotMet', 'TaskCompleted'].includes(getErrorCode(error))) {
+                continue // claimed by someone else
+            }
+            throw error
+        }
+
+        const port = parseInt(standby.id.split('-')[1])
+        const taskConfig = {
+            id: `session-${port}-${getUniqueId()}`,
+            displayName: `${label} on ${port}`,
+            userIdentity: GLOBALS.TASK_USER_IDENTITY,
+            containerSettings: {
+                containerRunOptions: `-p ${port}:8080`,
+                imageName: `${containerRegistryLoginServer}/vizer/vizer:latest`,
+            },
+            affinityInfo: { affinityId: standby.nodeInfo.affinityId },
+            commandLine: commandLine,
+        }
+        await batchServiceClient.task.add(GLOBALS.STANDBY_JOB_ID, taskConfig)
+        return {
+            poolId: standby.nodeInfo.poolId,
+            nodeId: standby.nodeInfo.nodeId,
+            jobId: GLOBALS.STANDBY_JOB_ID,
+            taskId: taskConfig.id,
+            port: port,
+            standby: true,
+        }
+    }
+    return null
+}
+
+async function submitJob(datasets, options, batchEndpoint, containerRegistryLoginServer, prefix) {
+    let batchServiceClient = await getBatchClient(batchEndpoint)
+
+    let label = `trame (${datasets[0].name}:${datasets[0].container}) (count=${datasets.length})`
+    const commandLine = getCommandLine(datasets, options)
+
+    const session = await claimStandbyServer(batchServiceClient, label, commandLine, containerRegistryLoginServer)
+    if (session) {
+        return session
+    }
+
+    // no standby server, start the server in a new job
+    const jobConfig = {
+        id: `${prefix||'trame'}-${getUniqueId()}`,
+        displayName: label,
+        poolInfo: GLOBALS.TRAME_POOL_INFO,
+    }
 
     const port = pickPort();
     await batchServiceClient.job.add(jobConfig)
@@ -120,7 +285,7 @@ async function submitJob(datasets, options, batchEndpoint, containerRegistryLogi
             containerRunOptions: `-p ${port}:8080`,
             imageName: `${containerRegistryLoginServer}/vizer/vizer:latest`,
         },
-       commandLine: commandLine.join(' ')
+       commandLine: commandLine
     }
 
     // add task to the job
@@ -159,7 +324,7 @@ async function trameServerReady(batchServiceClient, jobId, taskId, timeout) {
 }
 
 async function getComputeNode(jobInfo, batchEndpoint, timeout) {
-    let batchServiceClient = new BatchServiceClient(await getBatchCredentials(), batchEndpoint)
+    let batchServiceClient = await getBatchClient(batchEndpoint)
 
     const expiration = dayjs().add(timeout || 5, 'minute')
     while (dayjs() < expiration) {
@@ -169,11 +334,16 @@ async function getComputeNode(jobInfo, batchEndpoint, timeout) {
         } else if (task.state === 'completed') {
             throw Error('task has completed!')
         } else {
+            if (jobInfo.nodeId && task.nodeInfo.nodeId !== jobInfo.nodeId) {
+                // affinity to the claimed standby server's node is only a preference
+                console.log(`${jobInfo.taskId}: scheduled on ${task.nodeInfo.nodeId} instead of the standby node ${jobInfo.nodeId}`)
+            }
             let nodeInfo = await batchServiceClient.computeNode.get(task.nodeInfo.poolId, task.nodeInfo.nodeId)
             await trameServerReady(batchServiceClient, jobInfo.jobId, jobInfo.taskId)
             return {
                 host: nodeInfo.ipAddress,
-                port: jobInfo.port
+                port: jobInfo.port,
+                nodeId: task.nodeInfo.nodeId,
             }
         }
     }
@@ -181,16 +351,19 @@ async function getComputeNode(jobInfo, batchEndpoint, timeout) {
 }
 
 async function terminateJob(jobInfo, batchEndpoint) {
-    let batchServiceClient = new BatchServiceClient(await getBatchCredentials(), batchEndpoint)
+    let batchServiceClient = await getBatchClient(batchEndpoint)
     
     // explicitly terminate task to otherwise status doesn't change for active tasks
     // when job is terminated.
     await batchServiceClient.task.terminate(jobInfo.jobId, jobInfo.taskId)
-    await batchServiceClient.job.terminate(jobInfo.jobId)
+    if (!jobInfo.standby) {
+        // the standby job is shared by all sessions started on standby servers
+        await batchServiceClient.job.terminate(jobInfo.jobId)
+    }
 }
 
 async function testBatch(batchEndpoint) {
-    let batchServiceClient = new BatchServiceClient(await getBatchCredentials(), batchEndpoint)
+    let batchServiceClient = await getBatchClient(batchEndpoint)
     let pools = await batchServiceClient.pool.list()
     return pools.length
 }